@@ -0,0 +1,88 @@
+# Copyright (c) 2023 42dot. All rights reserved.
+import argparse
+import time
+
+import torch
+
+from utils.photometric import compute_photometric_loss, compute_fused_photometric_loss, compute_ssim_stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='VFDepth photometric loss benchmark script')
+    parser.add_argument('--batch_size', default = 2, type=int, help='Batch size')
+    parser.add_argument('--num_cams', default = 6, type=int, help='Number of cameras')
+    parser.add_argument('--num_pairs', default = 5, type=int, help='Number of predicted images per target image')
+    parser.add_argument('--height', default = 384, type=int, help='Image height')
+    parser.add_argument('--width', default = 640, type=int, help='Image width')
+    parser.add_argument('--device', default = 'cuda' if torch.cuda.is_available() else 'cpu', type=str, help='Benchmark device')
+    parser.add_argument('--num_iters', default = 10, type=int, help='Number of timed iterations')
+    args = parser.parse_args()
+    return args
+
+
+def make_inputs(args):
+    """
+    This function returns random predicted images [pairs, b*cam, 3, h, w] and target images [b*cam, 3, h, w].
+    """
+    g = torch.Generator().manual_seed(0)
+    target = torch.rand(args.batch_size * args.num_cams, 3, args.height, args.width, generator=g)
+    pred = (target + 0.1 * torch.randn(args.num_pairs, *target.shape, generator=g)).clamp(0, 1)
+    return pred.to(args.device), target.to(args.device)
+
+
+def run(loss_fn, pred, target):
+    """
+    This function runs the forward and backward pass of a photometric loss function,
+    and returns the loss, the gradient of the predicted images and the bytes of the tensors saved for backward.
+    """
+    saved = {}
+    def pack(t):
+        saved[t.data_ptr()] = t.numel() * t.element_size()
+        return t
+
+    pred = pred.detach().requires_grad_()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        loss = loss_fn(pred, target, compute_ssim_stats(target))
+    loss.mean().backward()
+    return loss.detach(), pred.grad, sum(saved.values())
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def benchmark(args):
+    pred, target = make_inputs(args)
+    loss_fns = {
+        'reference': compute_photometric_loss,
+        'fused': compute_fused_photometric_loss,
+    }
+
+    # numerical parity against the reference implementation
+    ref_loss, ref_grad, _ = run(loss_fns['reference'], pred, target)
+    fused_loss, fused_grad, _ = run(loss_fns['fused'], pred, target)
+    print(f'Max abs difference (loss): {(ref_loss - fused_loss).abs().max().item():.3e}')
+    print(f'Max abs difference (grad): {(ref_grad - fused_grad).abs().max().item():.3e}')
+
+    for name, loss_fn in loss_fns.items():
+        run(loss_fn, pred, target) # warm up
+        if torch.device(args.device).type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(args.device)
+        synchronize(args.device)
+
+        start = time.time()
+        for _ in range(args.num_iters):
+            _, _, saved_bytes = run(loss_fn, pred, target)
+        synchronize(args.device)
+        duration = (time.time() - start) / args.num_iters * 1000
+
+        memory = f'saved for backward: {saved_bytes / 2**20:.1f} MB'
+        if torch.device(args.device).type == 'cuda':
+            memory += f', peak allocated: {torch.cuda.max_memory_allocated(args.device) / 2**20:.1f} MB'
+        print(f'{name:>10s}: {duration:.1f} ms/iter, {memory}')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    benchmark(args)
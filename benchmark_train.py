@@ -0,0 +1,80 @@
+# Copyright (c) 2023 42dot. All rights reserved.
+import argparse
+import itertools
+import time
+
+import torch
+
+import utils
+from models import VFDepthAlgo
+from trainer import VFDepthTrainer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='VFDepth training throughput benchmark script')
+    parser.add_argument('--config_file', default ='./configs/ddad/ddad_surround_fusion.yaml', type=str, help='Config yaml file')
+    parser.add_argument('--num_warmup', default = 20, type=int, help='Number of untimed warm-up batches')
+    parser.add_argument('--num_steps', default = 200, type=int, help='Number of timed batches')
+    args = parser.parse_args()
+    return args
+
+
+class Batches:
+    """
+    The next batches of a data loader iterator, which can be passed to VFDepthTrainer.train as a data loader.
+    """
+    def __init__(self, batches, n_batches):
+        self.batches = batches
+        self.n_batches = n_batches
+
+    def __len__(self):
+        return self.n_batches
+
+    def __iter__(self):
+        return itertools.islice(self.batches, self.n_batches)
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def run_steps(model, trainer, batches, n_batches):
+    """
+    This function runs the training loop of the trainer on the next batches, and returns its duration.
+    """
+    synchronize()
+    start = time.time()
+    trainer.train(model, Batches(batches, n_batches), start)
+    synchronize()
+    return time.time() - start
+
+
+def benchmark(cfg, args):
+    """
+    This function measures the steps per second of the training loop, without log checkpoints and validation.
+    It only relies on VFDepthAlgo and VFDepthTrainer.train, so that it can be run on earlier versions of the training loop.
+    """
+    # log checkpoints are moved beyond the benchmark, step 0 is always a checkpoint
+    cfg['logging']['early_phase'] = 0
+    cfg['logging']['late_log_frequency'] = args.num_warmup + args.num_steps + 2
+    model = VFDepthAlgo(cfg, 0)
+    trainer = VFDepthTrainer(cfg, 0, use_tb=False)
+    trainer.epoch, trainer.step = 0, 1
+    trainer.running_losses = {}
+    trainer.last_log_time, trainer.last_log_step = time.time(), 1
+
+    batches = iter(model.train_dataloader())
+    run_steps(model, trainer, batches, args.num_warmup)
+    duration = run_steps(model, trainer, batches, args.num_steps)
+
+    grad_accum_steps = cfg['training'].get('grad_accum_steps', 1)
+    print(f'{args.num_steps} batches in {duration:.1f} s | batches/s: {args.num_steps / duration:.3f} | ' + \
+          f'steps/s: {args.num_steps / grad_accum_steps / duration:.3f} | ' + \
+          f'examples/s: {args.num_steps * cfg["training"]["batch_size"] / duration:.2f}')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cfg = utils.get_config(args.config_file, mode='train')
+    benchmark(cfg, args)
@@ -1,4 +1,7 @@
 # Copyright (c) 2023 42dot. All rights reserved.
 from .base_dataset import construct_dataset
+from .data_util import collate_sparse_depth
+from .packed_dataset import pack_dataset
+from .sampler import ChunkSampler
 
-__all__ = ['construct_dataset']
\ No newline at end of file
+__all__ = ['construct_dataset', 'collate_sparse_depth', 'pack_dataset', 'ChunkSampler']
\ No newline at end of file
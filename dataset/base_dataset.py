@@ -16,7 +16,9 @@ def construct_dataset(cfg, mode, **kwargs):
             'depth_type': cfg['data']['depth_type'] if 'gt_depth' in cfg['data']['train_requirements'] else None,
             'scale_range': cfg['model']['fusion_level'] if 'fusion_level' in cfg['model'] else -1,
             'with_pose': 'gt_pose' in cfg['data']['train_requirements'],
-            'with_mask': 'mask' in cfg['data']['train_requirements']
+            'with_mask': 'mask' in cfg['data']['train_requirements'],
+            'with_identity_loss': cfg['data']['precompute_identity_loss'],
+            'depth_shape': None if cfg['eval']['eval_original_res'] else kwargs['image_shape']
         }
         
     elif mode == 'val':
@@ -28,14 +30,24 @@ def construct_dataset(cfg, mode, **kwargs):
             'depth_type': cfg['data']['depth_type'] if 'gt_depth' in cfg['data']['val_requirements'] else None,
             'scale_range': cfg['model']['fusion_level'] if 'fusion_level' in cfg['model'] else -1,
             'with_pose': 'gt_pose' in cfg['data']['val_requirements'],
-            'with_mask': 'mask' in cfg['data']['val_requirements']            
+            'with_mask': 'mask' in cfg['data']['val_requirements'],
+            'with_identity_loss': cfg['data']['precompute_identity_loss'],
+            'depth_shape': None if cfg['eval']['eval_original_res'] else kwargs['image_shape']
         }
         
+    # packed dataset, created by pack_dataset.py
+    if cfg['data']['packed_path'] is not None:
+        from dataset.packed_dataset import PackedDataset
+        dataset = PackedDataset(
+            cfg['data']['packed_path'], mode,
+            **dataset_args
+        )
     # DDAD dataset
-    if cfg['data']['dataset'] == 'ddad':
+    elif cfg['data']['dataset'] == 'ddad':
         from dataset.ddad_dataset_sf import DDADdatasetSF
         dataset = DDADdatasetSF(
             cfg['data']['data_path'], mode,
+            frame_cache_size=cfg['data']['frame_cache_size'],
             **dataset_args
         )       
     # NuScenes dataset         
@@ -43,6 +55,7 @@ def construct_dataset(cfg, mode, **kwargs):
         from dataset.nuscenes_dataset import NuScenesdataset
         dataset = NuScenesdataset(
             cfg['data']['data_path'], mode,
+            frame_cache_size=cfg['data']['frame_cache_size'],
             **dataset_args            
         )
     else:
@@ -1,26 +1,84 @@
 # Copyright (c) 2023 42dot. All rights reserved.
 import os
+from collections import OrderedDict
 
 import numpy as np
 import PIL.Image as pil
 
+import torch
 import torch.nn.functional as F
 import torchvision.transforms as transforms
+from torch.utils.data.dataloader import default_collate
+
+from external.dataset import random_color_jitter_transform
+from utils.photometric import compute_photometric_loss
 
 _DEL_KEYS= ['rgb', 'rgb_context', 'rgb_original', 'rgb_context_original', 'intrinsics', 'contexts', 'splitname'] 
 
+_MASK_CACHE = {}
+
 
-def transform_mask_sample(sample, data_transform):
+def transform_mask(mask, image_shape):
     """
-    This function transforms masks to match input rgb images.
+    This function transforms a mask to match input rgb images. [1, h, w]
     """
-    image_shape = data_transform.keywords['image_shape']
     # resize transform
     resize_transform = transforms.Resize(image_shape, interpolation=pil.ANTIALIAS)
-    sample['mask'] = resize_transform(sample['mask'])
+    mask = resize_transform(mask)
     # totensor transform
     tensor_transform = transforms.ToTensor()    
-    sample['mask'] = tensor_transform(sample['mask'])
+    return tensor_transform(mask)
+
+
+def resize_frames(frames, image_shape):
+    """
+    This function resizes uint8 frames (or float frames in [0, 1]) [..., 3, H, W] into float frames in [0, 1] of the image shape.
+    """
+    shape = frames.shape
+    frames = frames.reshape(-1, *shape[-3:])
+    frames = frames.float() if frames.is_floating_point() else frames.float().div_(255)
+    if tuple(shape[-2:]) != tuple(image_shape):
+        frames = F.interpolate(frames, size=tuple(image_shape), mode='bicubic', align_corners=False, antialias=True)
+    return frames.clamp_(0, 1).reshape(*shape[:-2], *image_shape)
+
+
+def jitter_frames(frames, jittering):
+    """
+    This function color-jitters frames [cam, n_frames, 3, h, w], with the same jittering for all frames of each camera.
+    """
+    if not any(jittering):
+        return frames.clone()
+    return torch.stack([random_color_jitter_transform(jittering[:4])(frames[cam])
+                        for cam in range(frames.size(0))], 0)
+
+
+def transform_sample(sample, data_transform):
+    """
+    This function resizes and color-jitters the frames of all cameras at once with tensor ops,
+    in place of the per-camera PIL transforms of packnet-sfm.
+    The current and context frames are stacked into a uint8 tensor [cam, n_frames, 3, H, W].
+    """
+    image_shape = tuple(data_transform.keywords['image_shape'])
+    jittering = data_transform.keywords.get('jittering', ())
+
+    contexts = sample.get('rgb_context', [])
+    frames = torch.from_numpy(np.stack([sample['rgb']] + contexts, 1)).permute(0, 1, 4, 2, 3)
+    orig_h, orig_w = frames.shape[-2:]
+    org_frames = resize_frames(frames, image_shape)
+    aug_frames = jitter_frames(org_frames, jittering)
+
+    # scale intrinsics
+    intrinsics = np.copy(sample['intrinsics'])
+    intrinsics[:, 0] *= image_shape[1] / orig_w
+    intrinsics[:, 1] *= image_shape[0] / orig_h
+
+    sample.update({
+        'intrinsics': intrinsics,
+        'rgb': aug_frames[:, 0],
+        'rgb_original': org_frames[:, 0],
+        'rgb_context': list(aug_frames[:, 1:].unbind(1)),
+        'rgb_context_original': list(org_frames[:, 1:].unbind(1)),
+    })
     return sample
 
 
@@ -33,56 +91,230 @@ def img_loader(path):
             return img.convert('RGB')
 
 
-def mask_loader_scene(path, mask_idx, cam):
+def mask_loader_scene(path, mask_idx, cam, image_shape):
     """
-    This function loads mask that correspondes to the scene and camera.
+    This function loads mask that correspondes to the scene and camera, resized to match input rgb images. [1, h, w]
+    Masks are cached in shared memory per (mask_idx, camera, image shape) for the whole process,
+    and masks loaded before dataloader workers start are shared with the workers.
     """
     fname = os.path.join(path, str(mask_idx), '{}_mask.png'.format(cam.upper()))    
-    with open(fname, 'rb') as f:
-        with pil.open(f) as img:
-            return img.convert('L')
+    key = (fname, tuple(image_shape))
+    if key not in _MASK_CACHE:
+        with open(fname, 'rb') as f:
+            with pil.open(f) as img:
+                mask = transform_mask(img.convert('L'), image_shape)
+        _MASK_CACHE[key] = mask.share_memory_()
+    return _MASK_CACHE[key]
+
+
+class FrameCache:
+    """
+    Bounded LRU cache of decoded frames. Each dataloader worker holds its own cache.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.frames = OrderedDict()
+
+    def get(self, key, loader):
+        """
+        This function returns the cached frame of the key, or loads and caches it by calling the loader.
+        """
+        if self.size <= 0:
+            return loader()
+        if key in self.frames:
+            self.frames.move_to_end(key)
+            return self.frames[key]
+
+        frame = loader()
+        self.frames[key] = frame
+        if len(self.frames) > self.size:
+            self.frames.popitem(last=False)
+        return frame
+
+
+def project_depth_sparse(cam_points, K, shape, to_pixel=np.trunc):
+    """
+    This function projects points in the camera frame [n, 3] into a sparse depth map of (h, w),
+    which is returned as pixel coordinates uv [m, 2] and depth z [m].
+    Points out of the image are dropped, and the nearest point is kept for pixels hit by several points.
+    """
+    h, w = shape
+    cam_points = cam_points[cam_points[:, 2] > 0]
+    z = cam_points[:, 2]
+    uv = to_pixel(cam_points[:, :2] @ K[:2, :2].T / z[:, None] + K[:2, 2])
+
+    in_view = (uv[:, 0] >= 0) & (uv[:, 0] < w) & (uv[:, 1] >= 0) & (uv[:, 1] < h)
+    uv, z = uv[in_view].astype(np.int64), z[in_view]
+
+    # z-buffering, sort points by pixel and depth and keep the first point of each pixel
+    pix = uv[:, 1] * w + uv[:, 0]
+    order = np.lexsort((z, pix))
+    _, first = np.unique(pix[order], return_index=True)
+    nearest = order[first]
+    return uv[nearest].astype(np.uint16), z[nearest].astype(np.float32)
+
+
+def save_depth_sparse(filename, uv, z, shape):
+    """
+    This function saves a sparse depth map as (u, v, z) arrays.
+    The file is written to a temporary file first, so that concurrent readers never see a partial file.
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_file = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.savez_compressed(f, uv=uv, z=z, shape=np.asarray(shape))
+    os.replace(tmp_file, filename)
+
+
+def sparse_to_dense(uv, z, shape):
+    """
+    This function scatters a sparse depth map into a dense depth map. [h, w]
+    """
+    depth = np.zeros(tuple(shape), dtype=np.float32)
+    depth[uv[:, 1], uv[:, 0]] = z
+    return depth
 
 
-def align_dataset(sample, scales, contexts):
+def load_depth(filename):
+    """
+    This function loads a dense depth map from a sparse depth file, or from a dense depth file of earlier versions.
+    """
+    with np.load(filename) as data:
+        if 'depth' in data:
+            return data['depth']
+        return sparse_to_dense(data['uv'], data['z'], data['shape'])
+
+
+def downsample_depth_points(uv, z, shape, image_shape):
+    """
+    This function downsamples a sparse depth map of (h, w) to the image shape, as resize_depth_preserve of packnet-sfm.
+    Points are visited in row-major order, and the last point is kept for pixels hit by several points.
+    """
+    h, w = shape
+    img_h, img_w = image_shape
+    order = np.lexsort((uv[:, 0], uv[:, 1]))
+    uv, z = uv[order], z[order]
+    uv = np.stack([(uv[:, 0] * (img_w / w)).astype(np.int64), (uv[:, 1] * (img_h / h)).astype(np.int64)], 1)
+
+    pix = uv[:, 1] * img_w + uv[:, 0]
+    _, last = np.unique(pix[::-1], return_index=True)
+    last = len(pix) - 1 - last
+    return uv[last], z[last]
+
+
+def load_depth_points(filename, image_shape=None):
+    """
+    This function loads a depth map as a point list of normalized pixel coordinates uv [n, 2] in [-1, 1] and depth z [n],
+    which can be sampled by grid_sample (align_corners=False) at any resolution.
+    If the image shape is given, points are downsampled to the pixels of the image shape, as the dense depth maps 
+    evaluated in published results. Otherwise, points keep the resolution of the original image.
+    """
+    with np.load(filename) as data:
+        if 'depth' in data:
+            depth = np.squeeze(data['depth'])
+            v, u = np.nonzero(depth)
+            uv, z, shape = np.stack([u, v], 1), depth[v, u], depth.shape
+        else:
+            uv, z, shape = data['uv'], data['z'], data['shape']
+    if image_shape is not None:
+        uv, z = downsample_depth_points(uv, z, shape, image_shape)
+        shape = image_shape
+    h, w = shape
+    uv = (uv + 0.5) / np.array([w, h]) * 2 - 1
+    return uv.astype(np.float32), z.astype(np.float32)
+
+
+def pad_depth_points(points):
+    """
+    This function pads point lists to the same length and stacks them into uv [k, n, 2] and z [k, n].
+    Padded points have zero depth, which is out of the evaluation range.
+    """
+    n_points = max(z.shape[-1] for _, z in points)
+    uv = np.zeros((len(points), n_points, 2), dtype=np.float32)
+    z = np.zeros((len(points), n_points), dtype=np.float32)
+    for idx, (pts_uv, pts_z) in enumerate(points):
+        uv[idx, :pts_z.shape[-1]] = pts_uv
+        z[idx, :pts_z.shape[-1]] = pts_z
+    return uv, z
+
+
+def collate_sparse_depth(batch):
+    """
+    This function collates samples, whose sparse depth maps ([cam, n, 2] and [cam, n]) have different numbers of points.
+    """
+    if 'depth_z' in batch[0]:
+        n_points = max(smp['depth_z'].shape[-1] for smp in batch)
+        for smp in batch:
+            pad = n_points - smp['depth_z'].shape[-1]
+            smp['depth_uv'] = np.pad(smp['depth_uv'], ((0, 0), (0, pad), (0, 0)))
+            smp['depth_z'] = np.pad(smp['depth_z'], ((0, 0), (0, pad)))
+    return default_collate(batch)
+
+
+def get_intrinsics_scales(scale_range):
+    """
+    This function returns the scales of the intrinsics consumed by the model,
+    the input scale and the scale of the fusion level (scale_range+1) if the model has a fusion module.
+    """
+    return [0] if scale_range < 0 else [0, scale_range+1]
+
+
+def invert_intrinsics(K):
+    """
+    This function inverts upper triangular intrinsics [..., 4, 4] in closed form.
+    """
+    fx, fy, skew, cx, cy = K[..., 0, 0], K[..., 1, 1], K[..., 0, 1], K[..., 0, 2], K[..., 1, 2]
+    inv_K = np.zeros_like(K)
+    inv_K[..., 0, 0] = 1 / fx
+    inv_K[..., 0, 1] = -skew / (fx * fy)
+    inv_K[..., 0, 2] = (skew * cy - cx * fy) / (fx * fy)
+    inv_K[..., 1, 1] = 1 / fy
+    inv_K[..., 1, 2] = -cy / fy
+    inv_K[..., 2, 2] = 1
+    inv_K[..., 3, 3] = 1
+    return inv_K
+
+
+def compute_identity_losses(sample, contexts):
+    """
+    This function computes the identity reprojection losses between the context and current images [cam, 1, h, w],
+    which only depend on the input images, so that the dataloader workers compute them instead of the training loop.
+    """
+    for frame in contexts:
+        sample[('identity_loss', frame)] = compute_photometric_loss(sample[('color', frame, 0)], sample[('color', 0, 0)])
+    return sample
+
+
+def align_dataset(sample, scales, contexts, identity_loss=False):
     """
     This function reorganize samples to match our trainer configuration.
+    Intrinsics are given at the scales consumed by the model, images only at the input scale.
+    Images of the other scales are resized on the device if the loss needs them.
     """
     K = sample['intrinsics']
-    aug_images = sample['rgb']
-    aug_contexts = sample['rgb_context']
-    org_images = sample['rgb_original']
-    org_contexts= sample['rgb_context_original']    
-
-    n_cam, _, w, h = aug_images.shape
+    n_cam = K.shape[0]
 
     # initialize intrinsics
-    resized_K = np.expand_dims(np.eye(4), 0).repeat(n_cam, axis=0)
+    resized_K = np.tile(np.eye(4, dtype=np.float32), (n_cam, 1, 1))
     resized_K[:, :3, :3] = K
 
-    # augment images and intrinsics in accordance with scales 
+    # intrinsics in accordance with scales
     for scale in scales:
         scaled_K = resized_K.copy()
-        scaled_K[:,:2,:] /= (2**scale)
-        
-        sample[('K', scale)] = scaled_K.copy()
-        sample[('inv_K', scale)]= np.linalg.pinv(scaled_K).copy()
-
-        resized_org = F.interpolate(org_images, 
-                                          size=(w//(2**scale),h//(2**scale)),
-                                          mode = 'bilinear',
-                                          align_corners=False)
-        resized_aug = F.interpolate(aug_images, 
-                                          size=(w//(2**scale),h//(2**scale)), 
-                                          mode = 'bilinear',
-                                          align_corners=False)            
-            
-        sample[('color', 0, scale)] = resized_org
-        sample[('color_aug', 0, scale)] = resized_aug
+        scaled_K[:, :2, :] /= (2**scale)
+        sample[('K', scale)] = scaled_K
+        sample[('inv_K', scale)] = invert_intrinsics(scaled_K)
+
+    sample[('color', 0, 0)] = sample['rgb_original']
+    sample[('color_aug', 0, 0)] = sample['rgb']
 
     # for context data
     for idx, frame in enumerate(contexts):
-        sample[('color', frame, 0)] = org_contexts[idx]        
-        sample[('color_aug',frame, 0)] = aug_contexts[idx]
+        sample[('color', frame, 0)] = sample['rgb_context_original'][idx]
+        sample[('color_aug',frame, 0)] = sample['rgb_context'][idx]
+
+    if identity_loss:
+        compute_identity_losses(sample, contexts)
         
     # delete unused arrays
     for key in list(sample.keys()):
@@ -1,76 +1,235 @@
 # Copyright (c) 2023 42dot. All rights reserved.
+import hashlib
 import os
+import pickle
 
 import numpy as np
 import pandas as pd
 
-from .data_util import transform_mask_sample, mask_loader_scene, align_dataset
+from .data_util import FrameCache, transform_sample, mask_loader_scene, align_dataset, get_intrinsics_scales, \
+                       project_depth_sparse, save_depth_sparse, load_depth, load_depth_points, pad_depth_points
 
-from external.utils import Camera, generate_depth_map, make_list
+from external.utils import Pose, make_list
 from external.dataset import DGPDataset, SynchronizedSceneDataset, stack_sample
 
 
+class CachedSynchronizedSceneDataset(SynchronizedSceneDataset):
+    """
+    SynchronizedSceneDataset, which stores its state in a cache file to skip the construction in subsequent runs.
+    The cached state holds the scene containers, dataset metadata, calibration table, datum index and item index,
+    so a cache hit skips the scene extraction, ontology loading and indexing of the scene dataset json.
+    Scene protos are not cached, they are loaded lazily by the scene containers as before.
+    Only the datums of load_datum_names are loaded by __getitem__, other datums (e.g. lidar) are selected
+    for the synchronization and can be loaded on demand.
+    Loaded datums are kept in a frame cache of frame_cache_size, to be reused by neighboring samples.
+    """
+    def __init__(self, *args, cache_file=None, load_datum_names=None, frame_cache_size=0, **kwargs):
+        self.cache_file = cache_file
+        self.load_datum_names = None if load_datum_names is None else [d.lower() for d in load_datum_names]
+        self.frame_cache = FrameCache(frame_cache_size)
+        local_keys = set(self.__dict__)
+
+        state = self.load_state(cache_file)
+        if state is not None:
+            self.__dict__.update(state)
+        else:
+            super().__init__(*args, **kwargs)
+            self.save_state(cache_file, {k: v for k, v in self.__dict__.items() if k not in local_keys})
+
+    @staticmethod
+    def load_state(cache_file):
+        """
+        This function returns the dataset state stored in the cache file, None if it does not exist.
+        """
+        if cache_file is None or not os.path.exists(cache_file):
+            return None
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+
+    @staticmethod
+    def save_state(cache_file, state):
+        """
+        This function stores the dataset state in the cache file, ignoring write failures.
+        """
+        if cache_file is None:
+            return
+        # write to a temporary file first, so that concurrent processes never read a partial cache
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(state, f)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+
+    def get_datum_data(self, scene_idx, sample_idx_in_scene, datum_name):
+        return self.frame_cache.get((scene_idx, sample_idx_in_scene, datum_name),
+            lambda: super(CachedSynchronizedSceneDataset, self).get_datum_data(scene_idx, sample_idx_in_scene, datum_name))
+
+    def __getitem__(self, index):
+        scene_idx, sample_idx_in_scene, datum_names = self.dataset_item_index[index]
+        if self.load_datum_names is not None:
+            datum_names = [d for d in datum_names if d in self.load_datum_names]
+
+        # [context, datum], in temporal order
+        return [[self.get_datum_data(scene_idx, sample_idx_in_scene + offset, datum_name) for datum_name in datum_names]
+                for offset in range(-self.backward_context, self.forward_context + 1)]
+
+
 class DDADdatasetSF(DGPDataset):
     """
     Superclass for DGP dataset loaders of the packnet-sfm repository.
     """
-    def __init__(self, *args, with_mask, scale_range, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.cameras = kwargs['cameras']
-        self.scales = np.arange(scale_range+2) 
+    def __init__(self, path, split,
+                 cameras=None,
+                 back_context=0,
+                 forward_context=0,
+                 data_transform=None,
+                 depth_type=None,
+                 scale_range=0,
+                 with_pose=False,
+                 with_mask=False,
+                 with_identity_loss=False,
+                 frame_cache_size=0,
+                 depth_shape=None,
+                 ):
+        # DGPDataset.__init__ is not called, since it builds another SynchronizedSceneDataset of the cameras only
+        self.path = path
+        self.split = split
+        self.dataset_idx = 0
+
+        self.bwd = back_context
+        self.fwd = forward_context
+        self.has_context = back_context + forward_context > 0
+
+        self.cameras = cameras
+        self.num_cameras = len(cameras)
+        self.data_transform = data_transform
+        self.scales = get_intrinsics_scales(scale_range)
+
+        self.depth_type = depth_type
+        self.with_depth = depth_type is not None and depth_type != ''
+        # resolution of the ground-truth depth points, None for the original resolution
+        self.depth_shape = depth_shape
+        self.with_input_depth = False
+        self.with_pose = with_pose
 
         ## self-occ masks 
         self.with_mask = with_mask
+        self.with_identity_loss = with_identity_loss
         cur_path = os.path.dirname(os.path.realpath(__file__))
         self.mask_path = os.path.join(cur_path, 'ddad_mask')
         file_name = os.path.join(self.mask_path, 'mask_idx_dict.pkl')
         
+        self.frame_cache_size = frame_cache_size
         self.mask_idx_dict = pd.read_pickle(file_name)
         self.mask_loader = mask_loader_scene
-        
-        datum_names = self.cameras + ['lidar']
-        self.dataset = SynchronizedSceneDataset(self.path,
-                        split=self.split,
-                        datum_names=datum_names,
-                        backward_context=self.bwd,
-                        forward_context=self.fwd,
-                        requested_annotations=None,
-                        only_annotated_datums=False,
-                        )        
-
-    def generate_depth_map_sf(self, sample_idx, datum_idx, filename):
+        self.mask_cache = {}
+        self.image_shape = tuple(data_transform.keywords['image_shape'])
+        # masks are loaded in shared memory before dataloader workers start, to be shared with the workers
+        if self.with_mask:
+            for mask_idx in sorted(set(self.mask_idx_dict.values())):
+                for cam in self.cameras:
+                    self.get_mask(mask_idx, cam)
+        self._dataset = None
+
+    @property
+    def dataset(self):
+        """
+        Synchronized dataset of the cameras and lidar, which is built on its first access.
+        Only camera datums are loaded for each sample, lidar is read when a depth map is generated.
+        """
+        if self._dataset is None:
+            datum_names = self.cameras + ['lidar']
+            self._dataset = CachedSynchronizedSceneDataset(self.path,
+                            split=self.split,
+                            datum_names=datum_names,
+                            backward_context=self.bwd,
+                            forward_context=self.fwd,
+                            requested_annotations=None,
+                            only_annotated_datums=False,
+                            cache_file=self.get_index_cache_file(datum_names),
+                            load_datum_names=self.cameras,
+                            frame_cache_size=self.frame_cache_size,
+                            )
+        return self._dataset
+
+    def get_scene_ids(self):
+        """
+        This function returns the scene id of each sample, to build chunks of consecutive samples within scenes.
+        """
+        return np.array([scene_idx for scene_idx, _, _ in self.dataset.dataset_item_index])
+
+    def get_index_cache_file(self, datum_names):
+        """
+        This function returns the dataset state cache file, keyed by the dataset json, split, datum names and contexts.
+        """
+        json_path = os.path.abspath(self.path)
+        key = ['state', json_path, os.path.getmtime(json_path), self.split, sorted(d.lower() for d in datum_names), self.bwd, self.fwd]
+        key = hashlib.md5(str(key).encode()).hexdigest()
+        return os.path.join(os.path.dirname(json_path), 'index_cache', f'{self.split}_{key}.pkl')
+
+    def get_depth_filename_sf(self, filename):
+        """
+        This function returns the depth map file of a camera filename.
+        """
+        return '{}/{}.npz'.format(
+            os.path.dirname(self.path), filename.format('depth/{}'.format(self.depth_type)))
+
+    def generate_depth_map_sf(self, sample_idx, datum_idx, filename, sparse=False):
         """
         This function follows structure of dgp_dataset/generate_depth_map in packnet-sfm. 
         Due to the version issue with dgp, minor revision was made to get the correct value.
-        """      
-        # generate depth filename
-        filename = '{}/{}.npz'.format(
-            os.path.dirname(self.path), filename.format('depth/{}'.format(self.depth_type)))
-        # load and return if exists
-        if os.path.exists(filename):
-            return np.load(filename, allow_pickle=True)['depth']
-        # otherwise, create, save and return
-        else:
-            # get pointcloud
-            scene_idx, sample_idx_in_scene, datum_indices = self.dataset.dataset_item_index[sample_idx]
-            pc_datum_data, _ = self.dataset.get_point_cloud_from_datum(
-                                scene_idx, sample_idx_in_scene, self.depth_type)
-
-            # create camera
-            camera_rgb = self.get_current('rgb', datum_idx)
-            camera_pose = self.get_current('pose', datum_idx)
-            camera_intrinsics = self.get_current('intrinsics', datum_idx)
-            camera = Camera(K=camera_intrinsics, p_cw=camera_pose.inverse())
-            
-            # generate depth map
-            world_points = pc_datum_data['pose'] * pc_datum_data['point_cloud']
-            depth = generate_depth_map(camera, world_points, camera_rgb.size[::-1])
-            
-            # save depth map
-            os.makedirs(os.path.dirname(filename), exist_ok=True)
-            np.savez_compressed(filename, depth=depth)
-            return depth
+        Depth maps of all cameras of the sample are generated at once, if they are not precomputed.
+        The depth map is returned as a dense map, or as a point list of (uv, z) at the depth shape if sparse.
+        """
+        filename = self.get_depth_filename_sf(filename)
+        if not os.path.exists(filename):
+            self.save_depth_maps(sample_idx)
+        return load_depth_points(filename, self.depth_shape) if sparse else load_depth(filename)
+
+    def save_depth_maps(self, sample_idx, overwrite=False):
+        """
+        This function projects the lidar of a sample into all cameras at once, and saves sparse depth maps of the cameras.
+        Images are not loaded, and the number of saved depth maps is returned.
+        """
+        filenames = [self.get_depth_filename_sf(self.get_filename_sf(sample_idx, cam)) for cam in range(self.num_cameras)]
+        if not overwrite and all(os.path.exists(f) for f in filenames):
+            return 0
+
+        # get pointcloud
+        scene_idx, sample_idx_in_scene, datum_indices = self.dataset.dataset_item_index[sample_idx]
+        pc_datum_data, _ = self.dataset.get_point_cloud_from_datum(
+                            scene_idx, sample_idx_in_scene, self.depth_type)
+        world_points = pc_datum_data['pose'] * pc_datum_data['point_cloud']
+        calibration_key = self.dataset.get_sample(scene_idx, sample_idx_in_scene).calibration_key
+
+        # world -> camera poses, intrinsics and image shapes of the cameras
+        T_cw, K, shapes = [], [], []
+        for cam in range(self.num_cameras):
+            datum = self.dataset.get_datum(scene_idx, sample_idx_in_scene, datum_indices[cam])
+            T_cw.append(Pose.load(datum.datum.image.pose).inverse().matrix)
+            K.append(self.dataset.get_camera_calibration(calibration_key, datum.id.name).K)
+            shapes.append((datum.datum.image.height, datum.datum.image.width))
+        T_cw = np.stack(T_cw, 0)
+
+        # [cam, n, 3]
+        cam_points = np.einsum('cij,nj->cni', T_cw[:, :3, :3], world_points) + T_cw[:, None, :3, 3]
+        for cam in range(self.num_cameras):
+            # pixel coordinates are truncated as in dgp generate_depth_map
+            uv, z = project_depth_sparse(cam_points[cam], K[cam], shapes[cam], np.trunc)
+            save_depth_sparse(filenames[cam], uv, z, shapes[cam])
+        return self.num_cameras
     
+    def get_mask(self, mask_idx, cam):
+        """
+        This function returns the self-occlusion mask of the camera resized to the input images. [1, h, w]
+        """
+        if (mask_idx, cam) not in self.mask_cache:
+            self.mask_cache[mask_idx, cam] = self.mask_loader(self.mask_path, mask_idx, cam, self.image_shape)
+        return self.mask_cache[mask_idx, cam]
+
     def get_filename_sf(self, sample_idx, datum_idx):
         """
         This function is defined to meet dgp version(v1.4)
@@ -89,6 +248,7 @@ class DDADdatasetSF(DGPDataset):
 
         
         sample = []
+        depth_points = []
         contexts = []
         if self.bwd:
             contexts.append(-1)
@@ -112,15 +272,13 @@ class DDADdatasetSF(DGPDataset):
                 'contexts': contexts,
                 'filename': filename,
                 'splitname': '%s_%010d' % (self.split, idx),                
-                'rgb': self.get_current('rgb', cam),              
+                'rgb': np.asarray(self.get_current('rgb', cam)),
                 'intrinsics': self.get_current('intrinsics', cam),
             }
 
-            # if depth is returned
+            # if depth is returned, as a point list which is not transformed
             if self.with_depth:
-                data.update({
-                    'depth': self.generate_depth_map_sf(idx, cam, filename)
-                })
+                depth_points.append(self.generate_depth_map_sf(idx, cam, filename, sparse=True))
             # if depth is returned
             if self.with_input_depth:
                 data.update({
@@ -134,22 +292,23 @@ class DDADdatasetSF(DGPDataset):
             # with mask
             if self.with_mask:
                 data.update({
-                    'mask': self.mask_loader(self.mask_path, mask_idx, self.cameras[cam])
+                    'mask': self.get_mask(mask_idx, self.cameras[cam])
                 })
             # if context is returned
             if self.has_context:
                 data.update({
-                    'rgb_context': self.get_context('rgb', cam)
+                    'rgb_context': [np.asarray(img) for img in self.get_context('rgb', cam)]
                 })
 
             sample.append(data)
 
-        # apply same data transformations for all sensors
+        # stack and apply same data transformations for all sensors at once
+        sample = stack_sample(sample)
         if self.data_transform:
-            sample = [self.data_transform(smp) for smp in sample]
-            sample = [transform_mask_sample(smp, self.data_transform) for smp in sample]
+            sample = transform_sample(sample, self.data_transform)
+        if self.with_depth:
+            sample['depth_uv'], sample['depth_z'] = pad_depth_points(depth_points)
 
-        # stack and align dataset for our trainer
-        sample = stack_sample(sample)
-        sample = align_dataset(sample, self.scales, contexts)
+        # align dataset for our trainer
+        sample = align_dataset(sample, self.scales, contexts, self.with_identity_loss)
         return sample
\ No newline at end of file
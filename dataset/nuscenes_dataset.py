@@ -1,19 +1,23 @@
 # Copyright (c) 2023 42dot. All rights reserved.
+import hashlib
 import os
+import shutil
+from collections import defaultdict
 
 import numpy as np
-import PIL.Image as pil
 
-import torch
 from torch.utils.data import Dataset
 
-from nuscenes.nuscenes import NuScenes
 from pyquaternion import Quaternion
 
-from .data_util import img_loader, mask_loader_scene, align_dataset, transform_mask_sample
+from .data_util import FrameCache, img_loader, mask_loader_scene, align_dataset, get_intrinsics_scales, transform_sample, \
+                       project_depth_sparse, save_depth_sparse, load_depth_points, pad_depth_points
 from external.dataset import stack_sample
 
 
+_INDEX_STR_KEYS = ['token', 'scene_token', 'filename', 'prev_filename', 'next_filename', 'lidar_filename']
+
+
 class NuScenesdataset(Dataset):
     """
     Loaders for NuScenes dataset
@@ -27,15 +31,18 @@ class NuScenesdataset(Dataset):
                  scale_range=[0],
                  with_pose=None,
                  with_mask=None,
+                 with_identity_loss=False,
+                 frame_cache_size=0,
+                 depth_shape=None,
                  ):        
         super().__init__()
-        version = 'v1.0-trainval'
+        self.version = 'v1.0-trainval'
         self.path = path
         self.split = split
         self.dataset_idx = 0
 
         self.cameras = cameras
-        self.scales = np.arange(scale_range+2) 
+        self.scales = get_intrinsics_scales(scale_range)
         self.num_cameras = len(cameras)
 
         self.bwd = back_context
@@ -45,187 +52,229 @@ class NuScenesdataset(Dataset):
         self.data_transform = data_transform
 
         self.with_depth = depth_type is not None
+        # resolution of the ground-truth depth points, None for the original resolution
+        self.depth_shape = depth_shape
         self.with_pose = with_pose
 
         self.loader = img_loader
+        self.frame_cache = FrameCache(frame_cache_size)
 
         self.with_mask = with_mask
+        self.with_identity_loss = with_identity_loss
         cur_path = os.path.dirname(os.path.realpath(__file__))        
         self.mask_path = os.path.join(cur_path, 'nuscenes_mask')
         self.mask_loader = mask_loader_scene
+        self.mask_cache = {}
+        self.image_shape = tuple(data_transform.keywords['image_shape'])
+        # masks are loaded in shared memory before dataloader workers start, to be shared with the workers
+        if self.with_mask:
+            for cam in self.cameras:
+                self.get_mask('', cam)
 
-        self.dataset = NuScenes(version=version, dataroot=self.path, verbose=True)
-        
         # list of scenes for training and validation of model
-        with open('dataset/nuscenes/{}.txt'.format(self.split), 'r') as f:
-            self.filenames = f.readlines()
+        self.split_file = 'dataset/nuscenes/{}.txt'.format(self.split)
+
+        # compact index of the samples, the nuscenes devkit is only loaded to build it
+        self.index = self.load_index()
+
+    def get_index_dir(self):
+        """
+        This function returns the index directory, keyed by the index format, dataset root, version, split file and cameras.
+        """
+        key = ['scene_token', os.path.abspath(self.path), self.version, os.path.abspath(self.split_file),
+               os.path.getmtime(self.split_file), list(self.cameras)]
+        key = hashlib.md5(str(key).encode()).hexdigest()
+        return os.path.join(self.path, 'index_cache', f'{self.split}_{key}')
+
+    def load_index(self):
+        """
+        This function loads the index of the split as memory-mapped arrays, which are shared by dataloader workers.
+        The index is built and saved on the first run, it is kept in memory if it can not be saved.
+        """
+        index_dir = self.get_index_dir()
+        if not os.path.isdir(index_dir):
+            index = self.build_index()
+            # write to a temporary directory first, so that concurrent processes never read a partial index
+            tmp_dir = f'{index_dir}.{os.getpid()}.tmp'
+            try:
+                os.makedirs(tmp_dir, exist_ok=True)
+                for key, v in index.items():
+                    np.save(os.path.join(tmp_dir, f'{key}.npy'), v)
+                os.replace(tmp_dir, index_dir)
+            except OSError:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            # ex. read-only dataset directory
+            if not os.path.isdir(index_dir):
+                return index
+        return {os.path.splitext(f)[0]: np.load(os.path.join(index_dir, f), mmap_mode='r')
+                for f in os.listdir(index_dir)}
+
+    def build_index(self):
+        """
+        This function builds the index of the split with the nuscenes devkit.
+        Per sample, the index holds the file paths, intrinsics, extrinsics and ego poses of the cameras and the lidar.
+        """
+        from nuscenes.nuscenes import NuScenes
+        nusc = NuScenes(version=self.version, dataroot=self.path, verbose=True)
+        with open(self.split_file, 'r') as f:
+            filenames = f.readlines()
+
+        def get_filename(token):
+            return nusc.get('sample_data', token)['filename'] if token else ''
+
+        index = defaultdict(list)
+        for line in filenames:
+            sample_nusc = nusc.get('sample', line.strip().split()[0])
+            lidar_sample = nusc.get('sample_data', sample_nusc['data']['LIDAR_TOP'])
+            index['token'].append(sample_nusc['token'])
+            index['scene_token'].append(sample_nusc['scene_token'])
+            index['lidar_filename'].append(lidar_sample['filename'])
+            index['lidar_extrinsics'].append(self.get_tranformation_mat(
+                nusc.get('calibrated_sensor', lidar_sample['calibrated_sensor_token']), np.float64))
+            index['lidar_ego_pose'].append(self.get_tranformation_mat(
+                nusc.get('ego_pose', lidar_sample['ego_pose_token']), np.float64))
+
+            cam_index = defaultdict(list)
+            for cam in self.cameras:
+                cam_sample = nusc.get('sample_data', sample_nusc['data'][cam])
+                cam_param = nusc.get('calibrated_sensor', cam_sample['calibrated_sensor_token'])
+                cam_index['filename'].append(cam_sample['filename'])
+                cam_index['prev_filename'].append(get_filename(cam_sample['prev']))
+                cam_index['next_filename'].append(get_filename(cam_sample['next']))
+                cam_index['image_shape'].append((cam_sample['height'], cam_sample['width']))
+                cam_index['intrinsics'].append(np.array(cam_param['camera_intrinsic'], dtype=np.float32))
+                cam_index['extrinsics'].append(self.get_tranformation_mat(cam_param))
+                cam_index['ego_pose'].append(self.get_tranformation_mat(
+                    nusc.get('ego_pose', cam_sample['ego_pose_token']), np.float64))
+            for key, v in cam_index.items():
+                index[key].append(v)
+
+        # strings are stored as bytes, [sample] or [sample, cam]
+        return {key: np.array(v, dtype=np.bytes_) if key in _INDEX_STR_KEYS else np.array(v)
+                for key, v in index.items()}
+
+    def get_scene_ids(self):
+        """
+        This function returns the scene id of each sample, to build chunks of consecutive samples within scenes.
+        """
+        return np.unique(self.index['scene_token'], return_inverse=True)[1]
 
-    def get_current(self, key, cam_sample):
+    def get_filename(self, idx, cam_idx, key='filename'):
+        """
+        This function returns the image file of a camera in the sample, or of its previous or next frame.
+        """
+        return self.index[key][idx, cam_idx].decode()
+
+    def get_current(self, key, idx, cam_idx, file_key='filename'):
         """
         This function returns samples for current contexts
         """        
         # get current timestamp rgb sample
         if key == 'rgb':
-            rgb_path = cam_sample['filename']
-            return self.loader(os.path.join(self.path, rgb_path))
+            rgb_path = os.path.join(self.path, self.get_filename(idx, cam_idx, file_key))
+            return self.frame_cache.get(rgb_path, lambda: self.loader(rgb_path))
         # get current timestamp camera intrinsics
         elif key == 'intrinsics':
-            cam_param = self.dataset.get('calibrated_sensor', 
-                                         cam_sample['calibrated_sensor_token'])
-            return np.array(cam_param['camera_intrinsic'], dtype=np.float32)
+            return np.array(self.index['intrinsics'][idx, cam_idx])
         # get current timestamp camera extrinsics
         elif key == 'extrinsics':
-            cam_param = self.dataset.get('calibrated_sensor', 
-                                         cam_sample['calibrated_sensor_token'])
-            return self.get_tranformation_mat(cam_param)
+            return np.array(self.index['extrinsics'][idx, cam_idx])
         else:
             raise ValueError('Unknown key: ' +key)
 
-    def get_context(self, key, cam_sample):
+    def get_context(self, key, idx, cam_idx):
         """
         This function returns samples for backward and forward contexts
         """
         bwd_context, fwd_context = [], []
         if self.bwd != 0:
-            if self.split == 'val': # validation
-                bwd_sample = cam_sample
-            else:
-                bwd_sample = self.dataset.get('sample_data', cam_sample['prev'])
-            bwd_context = [self.get_current(key, bwd_sample)]
+            # validation uses the current frame
+            file_key = 'filename' if self.split == 'val' else 'prev_filename'
+            bwd_context = [self.get_current(key, idx, cam_idx, file_key)]
 
         if self.fwd != 0:
-            if self.split == 'val':
-                fwd_sample = cam_sample
-            else:
-                fwd_sample = self.dataset.get('sample_data', cam_sample['next'])
-            fwd_context = [self.get_current(key, fwd_sample)]
+            file_key = 'filename' if self.split == 'val' else 'next_filename'
+            fwd_context = [self.get_current(key, idx, cam_idx, file_key)]
         return bwd_context + fwd_context
 
-    def generate_depth_map(self, sample, sensor, cam_sample):
+    def get_depth_filename(self, sensor, filename):
+        """
+        This function returns the depth map file of a camera image file.
+        """
+        return '{}/{}.npz'.format(
+                        os.path.join(os.path.dirname(self.path), 'samples'),
+                        'DEPTH_MAP/{}/{}'.format(sensor, filename))
+
+    def generate_depth_map(self, idx, cam_idx):
         """
-        This function returns depth map for nuscenes dataset,
+        This function returns depth map for nuscenes dataset as a point list of (uv, z),
         result of depth map is saved in nuscenes/samples/DEPTH_MAP
+        Depth maps of all cameras of the sample are generated at once, if they are not precomputed.
         """        
-        # generate depth filename
-        filename = '{}/{}.npz'.format(
-                        os.path.join(os.path.dirname(self.path), 'samples'),
-                        'DEPTH_MAP/{}/{}'.format(sensor, cam_sample['filename']))
-                        
-        # load and return if exists
-        if os.path.exists(filename):
-            return np.load(filename, allow_pickle=True)['depth']
-        else:
-            lidar_sample = self.dataset.get(
-                'sample_data', sample['data']['LIDAR_TOP'])
-
-            # lidar points                
-            lidar_file = os.path.join(
-                self.path, lidar_sample['filename'])
-            lidar_points = np.fromfile(lidar_file, dtype=np.float32)
-            lidar_points = lidar_points.reshape(-1, 5)[:, :3]
-
-            # lidar -> world
-            lidar_pose = self.dataset.get(
-                'ego_pose', lidar_sample['ego_pose_token'])
-            lidar_rotation= Quaternion(lidar_pose['rotation'])
-            lidar_translation = np.array(lidar_pose['translation'])[:, None]
-            lidar_to_world = np.vstack([
-                np.hstack((lidar_rotation.rotation_matrix, lidar_translation)),
-                np.array([0, 0, 0, 1])
-            ])
-
-            # lidar -> ego
-            sensor_sample = self.dataset.get(
-                'calibrated_sensor', lidar_sample['calibrated_sensor_token'])
-            lidar_to_ego_rotation = Quaternion(
-                sensor_sample['rotation']).rotation_matrix
-            lidar_to_ego_translation = np.array(
-                sensor_sample['translation']).reshape(1, 3)
-
-            ego_lidar_points = np.dot(
-                lidar_points[:, :3], lidar_to_ego_rotation.T)
-            ego_lidar_points += lidar_to_ego_translation
-
-            homo_ego_lidar_points = np.concatenate(
-                (ego_lidar_points, np.ones((ego_lidar_points.shape[0], 1))), axis=1)
-
-
-            # world -> ego
-            ego_pose = self.dataset.get(
-                    'ego_pose', cam_sample['ego_pose_token'])
-            ego_rotation = Quaternion(ego_pose['rotation']).inverse
-            ego_translation = - np.array(ego_pose['translation'])[:, None]
-            world_to_ego = np.vstack([
-                    np.hstack((ego_rotation.rotation_matrix,
-                               ego_rotation.rotation_matrix @ ego_translation)),
-                    np.array([0, 0, 0, 1])
-                    ])
-
-            # Ego -> sensor
-            sensor_sample = self.dataset.get(
-                'calibrated_sensor', cam_sample['calibrated_sensor_token'])
-            sensor_rotation = Quaternion(sensor_sample['rotation'])
-            sensor_translation = np.array(
-                sensor_sample['translation'])[:, None]
-            sensor_to_ego = np.vstack([
-                np.hstack((sensor_rotation.rotation_matrix, 
-                           sensor_translation)),
-                np.array([0, 0, 0, 1])
-               ])
-            ego_to_sensor = np.linalg.inv(sensor_to_ego)
-            
-            # lidar -> sensor
-            lidar_to_sensor = ego_to_sensor @ world_to_ego @ lidar_to_world
-            homo_ego_lidar_points = torch.from_numpy(homo_ego_lidar_points).float()
-            cam_lidar_points = np.matmul(lidar_to_sensor, homo_ego_lidar_points.T).T
-
-            # depth > 0
-            depth_mask = cam_lidar_points[:, 2] > 0
-            cam_lidar_points = cam_lidar_points[depth_mask]
-
-            # sensor -> image
-            intrinsics = np.eye(4)
-            intrinsics[:3, :3] = sensor_sample['camera_intrinsic']
-            pixel_points = np.matmul(intrinsics, cam_lidar_points.T).T
-            pixel_points[:, :2] /= pixel_points[:, 2:3]
-            
-            # load image for pixel range
-            image_filename = os.path.join(
-                self.path, cam_sample['filename'])
-            img = pil.open(image_filename)
-            h, w, _ = np.array(img).shape
-            
-            # mask points in pixel range
-            pixel_mask = (pixel_points[:, 0] >= 0) & (pixel_points[:, 0] <= w-1)\
-                        & (pixel_points[:,1] >= 0) & (pixel_points[:,1] <= h-1)
-            valid_points = pixel_points[pixel_mask].round().int()
-            valid_depth = cam_lidar_points[:, 2][pixel_mask]
-        
-            depth = np.zeros([h, w])
-            depth[valid_points[:, 1], valid_points[:,0]] = valid_depth
-        
-            # save depth map
-            os.makedirs(os.path.dirname(filename), exist_ok=True)
-            np.savez_compressed(filename, depth=depth)
-            return depth
+        filename = self.get_depth_filename(self.cameras[cam_idx], self.get_filename(idx, cam_idx))
+        if not os.path.exists(filename):
+            self.save_depth_maps(idx)
+        return load_depth_points(filename, self.depth_shape)
+
+    def save_depth_maps(self, idx, overwrite=False):
+        """
+        This function projects the lidar of a sample into all cameras at once, and saves sparse depth maps of the cameras.
+        The number of saved depth maps is returned.
+        """
+        filenames = [self.get_depth_filename(cam, self.get_filename(idx, cam_idx))
+                     for cam_idx, cam in enumerate(self.cameras)]
+        if not overwrite and all(os.path.exists(f) for f in filenames):
+            return 0
+
+        # lidar points                
+        lidar_file = os.path.join(
+            self.path, self.index['lidar_filename'][idx].decode())
+        lidar_points = np.fromfile(lidar_file, dtype=np.float32)
+        lidar_points = lidar_points.reshape(-1, 5)[:, :3]
+
+        # lidar -> ego
+        lidar_to_ego = self.index['lidar_extrinsics'][idx]
+        ego_lidar_points = np.dot(
+            lidar_points[:, :3], lidar_to_ego[:3, :3].T)
+        ego_lidar_points += lidar_to_ego[:3, 3]
+
+        # lidar ego -> world -> camera ego -> sensor, [cam, 4, 4]
+        lidar_to_world = self.index['lidar_ego_pose'][idx]
+        world_to_ego = np.linalg.inv(self.index['ego_pose'][idx])
+        ego_to_sensor = np.linalg.inv(self.index['extrinsics'][idx].astype(np.float64))
+        lidar_to_sensor = ego_to_sensor @ world_to_ego @ lidar_to_world
+
+        # [cam, n, 3]
+        cam_lidar_points = np.einsum('cij,nj->cni', lidar_to_sensor[:, :3, :3], ego_lidar_points) \
+                           + lidar_to_sensor[:, None, :3, 3]
+        intrinsics, shapes = self.index['intrinsics'][idx], self.index['image_shape'][idx]
+        for cam_idx in range(self.num_cameras):
+            uv, z = project_depth_sparse(cam_lidar_points[cam_idx], intrinsics[cam_idx], shapes[cam_idx], np.round)
+            save_depth_sparse(filenames[cam_idx], uv, z, shapes[cam_idx])
+        return self.num_cameras
+
+    def get_mask(self, mask_idx, cam):
+        """
+        This function returns the self-occlusion mask of the camera resized to the input images. [1, h, w]
+        """
+        if (mask_idx, cam) not in self.mask_cache:
+            self.mask_cache[mask_idx, cam] = self.mask_loader(self.mask_path, mask_idx, cam, self.image_shape)
+        return self.mask_cache[mask_idx, cam]
 
-    def get_tranformation_mat(self, pose):
+    def get_tranformation_mat(self, pose, dtype=np.float32):
         """
         This function transforms pose information in accordance with DDAD dataset format
         """
         extrinsics = Quaternion(pose['rotation']).transformation_matrix
         extrinsics[:3, 3] = np.array(pose['translation'])
-        return extrinsics.astype(np.float32)
+        return extrinsics.astype(dtype)
 
     def __len__(self):
-        return len(self.filenames)
+        return len(self.index['token'])
     
     def __getitem__(self, idx):
-        # get nuscenes dataset sample
-        frame_idx = self.filenames[idx].strip().split()[0]
-        sample_nusc = self.dataset.get('sample', frame_idx)
-        
         sample = []
+        depth_points = []
         contexts = []
         if self.bwd:
             contexts.append(-1)
@@ -233,49 +282,45 @@ class NuScenesdataset(Dataset):
             contexts.append(1)
 
         # loop over all cameras            
-        for cam in self.cameras:
-            cam_sample = self.dataset.get(
-                'sample_data', sample_nusc['data'][cam])
-
+        for cam_idx, cam in enumerate(self.cameras):
             data = {
                 'idx': idx,
                 'sensor_name': cam,
                 'contexts': contexts,
-                'filename': cam_sample['filename'],
-                'rgb': self.get_current('rgb', cam_sample),
-                'intrinsics': self.get_current('intrinsics', cam_sample)
+                'filename': self.get_filename(idx, cam_idx),
+                'rgb': np.asarray(self.get_current('rgb', idx, cam_idx)),
+                'intrinsics': self.get_current('intrinsics', idx, cam_idx)
             }
 
-            # if depth is returned            
+            # if depth is returned, as a point list which is not transformed
             if self.with_depth:
-                data.update({
-                    'depth': self.generate_depth_map(sample_nusc, cam, cam_sample)
-                })
+                depth_points.append(self.generate_depth_map(idx, cam_idx))
             # if pose is returned
             if self.with_pose:
                 data.update({
-                    'extrinsics':self.get_current('extrinsics', cam_sample)
+                    'extrinsics':self.get_current('extrinsics', idx, cam_idx)
                 })
             # if mask is returned
             if self.with_mask:
                 data.update({
-                    'mask': self.mask_loader(self.mask_path, '', cam)
+                    'mask': self.get_mask('', cam)
                 })        
             # if context is returned
             if self.has_context:
                 data.update({
-                    'rgb_context': self.get_context('rgb', cam_sample)
+                    'rgb_context': [np.asarray(img) for img in self.get_context('rgb', idx, cam_idx)]
                 })
 
             sample.append(data)
 
-        # apply same data transformations for all sensors
+        # stack and apply same data transformations for all sensors at once
+        sample = stack_sample(sample)
         if self.data_transform:
-            sample = [self.data_transform(smp) for smp in sample]
-            sample = [transform_mask_sample(smp, self.data_transform) for smp in sample]
+            sample = transform_sample(sample, self.data_transform)
+        if self.with_depth:
+            sample['depth_uv'], sample['depth_z'] = pad_depth_points(depth_points)
 
-        # stack and align dataset for our trainer
-        sample = stack_sample(sample)
-        sample = align_dataset(sample, self.scales, contexts)
+        # align dataset for our trainer
+        sample = align_dataset(sample, self.scales, contexts, self.with_identity_loss)
         return sample
                 
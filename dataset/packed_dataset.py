@@ -0,0 +1,292 @@
+# Copyright (c) 2023 42dot. All rights reserved.
+import hashlib
+import json
+import os
+from collections import defaultdict
+
+import numpy as np
+from tqdm import tqdm
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from .data_util import align_dataset, get_intrinsics_scales, jitter_frames
+
+_META_FILE = 'meta.json'
+_INDEX_FILE = 'index.npz'
+_MASK_FILE = 'masks.npy'
+_DEPTH_FILE = 'depth_points.bin'
+
+
+def shard_name(key, shard_idx):
+    """
+    This function returns the file name of a shard.
+    """
+    return f'{key}_{shard_idx:04d}.npy'
+
+
+def digest(array):
+    """
+    This function hashes the content of an array, to store identical frames and masks once.
+    """
+    return hashlib.blake2b(array.tobytes(), digest_size=16).hexdigest()
+
+
+def to_uint8(img):
+    """
+    This function quantizes an image tensor in [0, 1] into a uint8 array.
+    Frames and masks are resized in float, so packed samples differ from the raw loader by up to half an intensity level.
+    """
+    return (torch.as_tensor(img) * 255).round().clamp(0, 255).to(torch.uint8).numpy()
+
+
+class ShardWriter:
+    """
+    Writer of an array, which is stored as .npy shards of a fixed number of rows.
+    """
+    def __init__(self, path, key, shard_size):
+        self.path = path
+        self.key = key
+        self.shard_size = shard_size
+        self.rows = []
+        self.n_rows = 0
+        self.n_shards = 0
+
+    def append(self, row):
+        """
+        This function appends a row and returns its index.
+        """
+        self.rows.append(row)
+        self.n_rows += 1
+        if len(self.rows) == self.shard_size:
+            self.flush()
+        return self.n_rows - 1
+
+    def flush(self):
+        if self.rows:
+            np.save(os.path.join(self.path, shard_name(self.key, self.n_shards)), np.stack(self.rows, 0))
+            self.n_shards += 1
+            self.rows = []
+
+
+class ShardReader:
+    """
+    Reader of an array stored by ShardWriter. Shards are memory-mapped on their first access.
+    """
+    def __init__(self, path, key, shard_size):
+        self.path = path
+        self.key = key
+        self.shard_size = shard_size
+        self.shards = {}
+
+    def __getitem__(self, idx):
+        shard_idx, row = divmod(idx, self.shard_size)
+        if shard_idx not in self.shards:
+            self.shards[shard_idx] = np.load(os.path.join(self.path, shard_name(self.key, shard_idx)), mmap_mode='r')
+        return self.shards[shard_idx][row]
+
+    def __getstate__(self):
+        # memory maps are opened again in each dataloader worker
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+
+@torch.no_grad()
+def pack_dataset(dataset, path, shard_size=64, num_workers=8):
+    """
+    This function packs a surround-view dataset into memory-mappable shards of resized uint8 frames.
+    Frames shared by neighboring samples (as temporal contexts) and self-occlusion masks are stored once,
+    samples refer to them by indices. Sparse depth maps are appended to a flat file of (u, v, z) rows.
+    """
+    assert len(dataset) > 0, f'\tNo samples to pack in the {dataset.split} split'
+    # frames are packed at the resolution of the data transform, with the contexts of the dataset
+    image_shape = list(dataset.image_shape)
+    contexts = ([-1] if dataset.bwd else []) + ([1] if dataset.fwd else [])
+
+    os.makedirs(path, exist_ok=True)
+    loader = DataLoader(dataset, batch_size=None, shuffle=False, num_workers=num_workers)
+    frame_writer = ShardWriter(path, 'frames', shard_size)
+    depth_file = open(os.path.join(path, _DEPTH_FILE), 'wb')
+    n_points = 0
+
+    frame_ids, mask_ids = {}, {}
+    masks = []
+    index = defaultdict(list)
+    meta = defaultdict(list)
+    for sample in tqdm(loader):
+        # [cam, 3, h, w] for the current frame and each context
+        frame_idx = []
+        for frame_id in [0] + contexts:
+            frame = to_uint8(sample[('color', frame_id, 0)])
+            assert list(frame.shape[-2:]) == image_shape, f'\tFrame shape {frame.shape[-2:]} differs from {image_shape}'
+            key = digest(frame)
+            if key not in frame_ids:
+                frame_ids[key] = frame_writer.append(frame)
+            frame_idx.append(frame_ids[key])
+        index['frame_idx'].append(frame_idx)
+        index['intrinsics'].append(np.asarray(sample[('K', 0)], dtype=np.float32)[:, :3, :3])
+
+        if 'extrinsics' in sample:
+            index['extrinsics'].append(np.asarray(sample['extrinsics'], dtype=np.float32))
+        if 'mask' in sample:
+            mask = to_uint8(sample['mask'])
+            key = digest(mask)
+            if key not in mask_ids:
+                mask_ids[key] = len(masks)
+                masks.append(mask)
+            index['mask_idx'].append(mask_ids[key])
+        if 'depth_z' in sample:
+            # [cam, n, 3]
+            points = np.concatenate([np.asarray(sample['depth_uv'], dtype=np.float32),
+                                     np.asarray(sample['depth_z'], dtype=np.float32)[..., None]], -1)
+            depth_file.write(points.tobytes())
+            index['depth_range'].append([n_points, n_points + points.shape[0] * points.shape[1]])
+            n_points = index['depth_range'][-1][1]
+
+        for key in ['idx', 'dataset_idx', 'sensor_name', 'filename']:
+            if key in sample:
+                meta[key].append(int(sample[key]) if key.endswith('idx') else sample[key])
+
+    # chunks of consecutive training samples are built within scenes
+    index['scene_id'] = dataset.get_scene_ids()
+    frame_writer.flush()
+    depth_file.close()
+    np.savez(os.path.join(path, _INDEX_FILE), **{k: np.stack(v, 0) for k, v in index.items()})
+    if masks:
+        np.save(os.path.join(path, _MASK_FILE), np.stack(masks, 0))
+
+    # the meta file is written last, so that incomplete packs are not loaded
+    meta.update({
+        'n_samples': len(index['frame_idx']),
+        'n_frames': frame_writer.n_rows,
+        'shard_size': shard_size,
+        'cameras': list(dataset.cameras),
+        'image_shape': image_shape,
+        'contexts': contexts,
+        'with_depth': 'depth_range' in index,
+        'depth_shape': list(dataset.depth_shape) if 'depth_range' in index and dataset.depth_shape else None,
+    })
+    with open(os.path.join(path, _META_FILE), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+class PackedDataset(Dataset):
+    """
+    Loader of surround-view samples packed by pack_dataset.
+    Frames are read from memory-mapped shards, color jittering and multi-scale alignment are applied on the fly.
+    """
+    def __init__(self, path, split,
+                 cameras=None,
+                 back_context=0,
+                 forward_context=0,
+                 data_transform=None,
+                 depth_type=None,
+                 scale_range=0,
+                 with_pose=None,
+                 with_mask=None,
+                 with_identity_loss=False,
+                 depth_shape=None,
+                 ):
+        super().__init__()
+        self.path = os.path.join(path, split)
+        self.split = split
+        meta_file = os.path.join(self.path, _META_FILE)
+        assert os.path.isfile(meta_file), f'\tCannot find {meta_file}, run pack_dataset.py first'
+        with open(meta_file, 'r') as f:
+            self.meta = json.load(f)
+
+        self.cameras = cameras
+        self.scales = get_intrinsics_scales(scale_range)
+        self.contexts = ([-1] if back_context else []) + ([1] if forward_context else [])
+        self.image_shape = tuple(data_transform.keywords['image_shape'])
+        self.jittering = data_transform.keywords.get('jittering', ())
+
+        self.with_depth = depth_type is not None
+        self.with_pose = with_pose
+        self.with_mask = with_mask
+        self.with_identity_loss = with_identity_loss
+
+        # the packed samples must match the requested inputs
+        assert list(cameras) == self.meta['cameras'], f'\tPacked cameras {self.meta["cameras"]} differ from {cameras}'
+        assert self.image_shape == tuple(self.meta['image_shape']), \
+            f'\tPacked image shape {self.meta["image_shape"]} differs from {self.image_shape}'
+        assert set(self.contexts) <= set(self.meta['contexts']), f'\tPacked contexts are {self.meta["contexts"]}'
+        assert not self.with_depth or self.meta['with_depth'], '\tDepth maps are not packed'
+        packed_depth_shape = self.meta.get('depth_shape')
+        assert not self.with_depth or packed_depth_shape == (list(depth_shape) if depth_shape else None), \
+            f'\tPacked depth points are at the resolution {packed_depth_shape or "of the original images"}, run pack_dataset.py again'
+
+        # position of the current frame and the requested contexts in the frame indices
+        self.frame_pos = [0] + [self.meta['contexts'].index(f) + 1 for f in self.contexts]
+
+        index = np.load(os.path.join(self.path, _INDEX_FILE))
+        self.index = {k: index[k] for k in index.files}
+        assert not self.with_pose or 'extrinsics' in self.index, '\tExtrinsics are not packed'
+        assert not self.with_mask or 'mask_idx' in self.index, '\tMasks are not packed'
+        assert not self.with_depth or 'depth_range' in self.index, '\tDense depth maps are packed, run pack_dataset.py again'
+
+        self.masks = np.load(os.path.join(self.path, _MASK_FILE)) if self.with_mask else None
+        self.frames = ShardReader(self.path, 'frames', self.meta['shard_size'])
+        self.depth = None
+
+    def __len__(self):
+        return self.meta['n_samples']
+
+    def __getstate__(self):
+        # the depth file is memory-mapped again in each dataloader worker
+        state = self.__dict__.copy()
+        state['depth'] = None
+        return state
+
+    def get_scene_ids(self):
+        """
+        This function returns the scene id of each sample, None for packs without scene ids.
+        """
+        return self.index.get('scene_id')
+
+    def load_depth_points(self, idx):
+        """
+        This function loads the sparse depth maps of a sample. [cam, n, 2], [cam, n]
+        """
+        if self.depth is None:
+            self.depth = np.memmap(os.path.join(self.path, _DEPTH_FILE), dtype=np.float32, mode='r').reshape(-1, 3)
+        start, end = self.index['depth_range'][idx]
+        points = np.array(self.depth[start:end]).reshape(len(self.cameras), -1, 3)
+        return points[..., :2], points[..., 2]
+
+    def load_frames(self, idx):
+        """
+        This function loads the current frame and the contexts of a sample. [n_frames, cam, 3, h, w]
+        """
+        frame_idx = self.index['frame_idx'][idx]
+        frames = np.stack([self.frames[frame_idx[pos]] for pos in self.frame_pos], 0)
+        return torch.from_numpy(frames).float().div_(255)
+
+    def __getitem__(self, idx):
+        # [n_frames, cam, 3, h, w]
+        org_frames = self.load_frames(idx)
+        aug_frames = jitter_frames(org_frames.transpose(0, 1), self.jittering).transpose(0, 1)
+
+        sample = {'idx': self.meta['idx'][idx] if 'idx' in self.meta else idx}
+        for key in ['dataset_idx', 'sensor_name', 'filename']:
+            if key in self.meta:
+                sample[key] = self.meta[key][idx]
+
+        sample.update({
+            'intrinsics': self.index['intrinsics'][idx],
+            'rgb': aug_frames[0],
+            'rgb_original': org_frames[0],
+            'rgb_context': list(aug_frames[1:]),
+            'rgb_context_original': list(org_frames[1:]),
+        })
+        if self.with_pose:
+            sample['extrinsics'] = self.index['extrinsics'][idx]
+        if self.with_mask:
+            sample['mask'] = torch.from_numpy(self.masks[self.index['mask_idx'][idx]]).float().div_(255)
+        if self.with_depth:
+            sample['depth_uv'], sample['depth_z'] = self.load_depth_points(idx)
+
+        # align dataset for our trainer
+        return align_dataset(sample, self.scales, self.contexts, self.with_identity_loss)
@@ -0,0 +1,70 @@
+# Copyright (c) 2023 42dot. All rights reserved.
+from itertools import chain
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class ChunkSampler(Sampler):
+    """
+    Sampler of shuffled chunks of consecutive samples within scenes.
+    Each scene (run of equal scene_ids, the whole dataset if None) is split into chunks at a random offset per epoch,
+    the samples at the scene ends which do not fill a chunk are skipped in that epoch.
+    Chunks are interleaved in the round-robin order in which the dataloader assigns batches to its workers,
+    so that each worker loads consecutive samples and reuses their shared frames (temporal contexts) from its frame cache.
+    The order only matches the dataloader if every worker loads the same number of whole batches,
+    so the chunk size must be a multiple of the batch size and each replica gets a multiple of num_workers chunks.
+    """
+    def __init__(self, data_source, chunk_size, batch_size, num_workers, num_replicas=1, rank=0, seed=0, scene_ids=None):
+        assert chunk_size % batch_size == 0, f'\tChunk size {chunk_size} must be a multiple of the batch size {batch_size}'
+        self.n_samples = len(data_source)
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+        # [start, end) of each scene
+        if scene_ids is None:
+            self.scenes = [(0, self.n_samples)]
+        else:
+            scene_ids = np.asarray(scene_ids)
+            assert len(scene_ids) == self.n_samples, f'\t{len(scene_ids)} scene ids for {self.n_samples} samples'
+            bounds = [0] + (np.flatnonzero(scene_ids[1:] != scene_ids[:-1]) + 1).tolist() + [self.n_samples]
+            self.scenes = list(zip(bounds[:-1], bounds[1:]))
+
+        # chunks start at a random offset in each scene, the number of chunks per scene and replica is fixed
+        self.n_total_chunks = sum((end - start) // chunk_size for start, end in self.scenes)
+        self.n_chunks = self.n_total_chunks // num_replicas // self.num_workers * self.num_workers
+        assert self.n_chunks > 0, f'\tToo few chunks of {chunk_size} samples for {self.num_workers} workers on {num_replicas} replicas'
+
+    def __len__(self):
+        return self.n_chunks * self.chunk_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        chunks = []
+        for start, end in self.scenes:
+            n_scene_chunks = (end - start) // self.chunk_size
+            if n_scene_chunks > 0:
+                offset = start + int(torch.randint(end - start - n_scene_chunks * self.chunk_size + 1, (1,), generator=g))
+                chunks.extend(offset + i * self.chunk_size for i in range(n_scene_chunks))
+        chunks = [chunks[i] for i in torch.randperm(self.n_total_chunks, generator=g).tolist()]
+        chunks = chunks[:self.n_chunks * self.num_replicas][self.rank::self.num_replicas]
+
+        # samples of each worker
+        workers = [[] for _ in range(self.num_workers)]
+        for idx, start in enumerate(chunks):
+            workers[idx % self.num_workers].extend(range(start, start + self.chunk_size))
+
+        # interleave the batches of the workers, which all have the same number of batches
+        batches = [[w[i:i + self.batch_size] for i in range(0, len(w), self.batch_size)] for w in workers]
+        batches = chain.from_iterable(zip(*batches))
+        return chain.from_iterable(batches)
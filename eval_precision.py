@@ -0,0 +1,111 @@
+# Copyright (c) 2023 42dot. All rights reserved.
+import argparse
+import copy
+import time
+from collections import defaultdict
+
+import torch
+from torch.utils.data import DataLoader, Subset
+
+import utils
+from dataset import construct_dataset, collate_sparse_depth
+from models import VFDepthPredictor
+
+_NO_DEVICE_KEYS = ['idx', 'dataset_idx', 'sensor_name', 'filename']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='VFDepth reduced precision evaluation script')
+    parser.add_argument('--config_file', default ='./configs/ddad/ddad_surround_fusion.yaml', type=str, help='Config yaml file')
+    parser.add_argument('--weight_path', default = None, type=str, help='Pretrained weight path')
+    parser.add_argument('--precisions', default = ['fp32', 'bf16', 'int8'], nargs='+', choices=['fp32', 'fp16', 'bf16', 'int8'],
+                        help='Precisions to evaluate, compared against fp32')
+    parser.add_argument('--device', default = 'cpu', type=str, help='Inference device (int8 is only supported on cpu)')
+    parser.add_argument('--num_threads', default = None, type=int, help='Number of cpu threads')
+    parser.add_argument('--num_calib', default = 8, type=int, help='Number of samples to calibrate int8 activation ranges')
+    parser.add_argument('--num_samples', default = None, type=int, help='Number of evaluation samples (all if not given)')
+    args = parser.parse_args()
+    return args
+
+
+def to_frames(inputs):
+    """
+    This function converts a batch of the dataset into predictor inputs of (images, K, extrinsics, mask).
+    """
+    for key, ipt in inputs.items():
+        if key not in _NO_DEVICE_KEYS and torch.is_tensor(ipt):
+            inputs[key] = ipt.float()
+    return inputs[('color_aug', 0, 0)], inputs[('K', 0)], inputs['extrinsics'], inputs['mask']
+
+
+def evaluate(predictor, dataloader, logger):
+    """
+    This function computes the average depth metrics and the inference time per sample.
+    """
+    avg_metric = defaultdict(float)
+    duration, n_samples = 0, 0
+    for inputs in dataloader:
+        frames = to_frames(inputs)
+        start = time.time()
+        depth = predictor.predict(*frames)
+        duration += time.time() - start
+        n_samples += depth.size(0)
+
+        outputs = {('cam', cam): {('depth', 0): depth[:, cam, ...]} for cam in range(depth.size(1))}
+        depth_eval_metric, _ = logger.compute_depth_losses(inputs, outputs)
+        for key, v in depth_eval_metric.items():
+            avg_metric[key] += v
+
+    for key in avg_metric.keys():
+        avg_metric[key] /= len(dataloader)
+    return avg_metric, duration / n_samples
+
+
+def eval_precision(cfg, args):
+    cfg = copy.deepcopy(cfg)
+    cfg['eval']['eval_visualize'] = False
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    _augmentation = {
+        'image_shape': (int(cfg['training']['height']), int(cfg['training']['width'])),
+        'jittering': (0.0, 0.0, 0.0, 0.0),
+        'crop_train_borders': (),
+        'crop_eval_borders': ()
+    }
+    eval_dataset = construct_dataset(cfg, 'val', **_augmentation)
+    n_samples = len(eval_dataset) if args.num_samples is None else min(args.num_samples, len(eval_dataset))
+    # calibration samples are taken from the end of the split, apart from the evaluation samples if possible
+    calib_idx = range(max(len(eval_dataset) - args.num_calib, 0), len(eval_dataset))
+    dataloader_opts = {
+        'batch_size': cfg['eval']['eval_batch_size'],
+        'shuffle': False,
+        'num_workers': cfg['eval']['eval_num_workers'],
+        'drop_last': False,
+        'collate_fn': collate_sparse_depth
+    }
+    eval_loader = DataLoader(Subset(eval_dataset, range(n_samples)), **dataloader_opts)
+    calib_loader = DataLoader(Subset(eval_dataset, calib_idx), **dataloader_opts)
+
+    logger = utils.Logger(cfg, use_tb=False)
+    results = {}
+    for precision in args.precisions:
+        print(f'Evaluating {precision}')
+        predictor = VFDepthPredictor(cfg, args.weight_path, args.device, 'fp32' if precision == 'int8' else precision)
+        if precision == 'int8':
+            predictor.quantize([to_frames(inputs) for inputs in calib_loader])
+        results[precision] = evaluate(predictor, eval_loader, logger)
+
+    print('Evaluation result...\n')
+    ref_metric = results['fp32'][0] if 'fp32' in results else None
+    for precision, (metric, sec) in results.items():
+        logger.print_perf(metric, f'{precision:>5s} | {1/sec:6.2f} samples/s')
+        if ref_metric is not None and precision != 'fp32':
+            delta = {k: metric[k] - ref_metric[k] for k in ['abs_rel', 'a1']}
+            logger.print_perf(delta, f'{"":>5s} | diff to fp32  ')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cfg = utils.get_config(args.config_file, mode='eval', weight_path = args.weight_path)
+    eval_precision(cfg, args)
@@ -0,0 +1,115 @@
+# Copyright (c) 2023 42dot. All rights reserved.
+import argparse
+import os
+
+import numpy as np
+import torch
+
+import utils
+from models.predictor import load_model_weights
+from network import FusedDepthNet, FusedPoseNet
+from network.export import DepthExportNet, PoseExportNet
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='VFDepth export script')
+    parser.add_argument('--config_file', default ='./configs/ddad/ddad_surround_fusion.yaml', type=str, help='Config yaml file')
+    parser.add_argument('--weight_path', default = None, type=str, help='Pretrained weight path')
+    parser.add_argument('--calib', required=True, type=str,
+                        help='npz file with K [cam, 3, 3], extrinsics [cam, 4, 4] and optionally image_shape (h, w) of K')
+    parser.add_argument('--static_calib', action='store_true', help='Fold the calibration into the exported graph')
+    parser.add_argument('--format', default = 'torchscript', choices=['torchscript', 'onnx'], help='Export format')
+    parser.add_argument('--output', default = './results/export', type=str, help='Output directory')
+    parser.add_argument('--batch_size', default = 1, type=int, help='Batch size of the exported graph')
+    parser.add_argument('--atol', default = 1e-3, type=float, help='Tolerance of the exported outputs')
+    args = parser.parse_args()
+    return args
+
+
+def load_calib(path, height, width):
+    """
+    This function loads the rig calibration and scales the intrinsics to the network resolution. [1, cam, 4, 4]
+    """
+    calib = np.load(path)
+    n_cam = calib['K'].shape[0]
+    K = np.eye(4)[None].repeat(n_cam, 0)
+    K[:, :3, :3] = calib['K'][:, :3, :3]
+    if 'image_shape' in calib:
+        org_h, org_w = calib['image_shape']
+        K[:, 0] *= width / org_w
+        K[:, 1] *= height / org_h
+    return torch.from_numpy(K).float()[None], torch.from_numpy(calib['extrinsics']).float()[None]
+
+
+def export_net(model, example_inputs, path, fmt, input_names, output_names):
+    """
+    This function exports the wrapped network and returns the outputs of the exported graph.
+    """
+    if fmt == 'torchscript':
+        traced = torch.jit.trace(model, example_inputs, check_trace=False)
+        traced.save(path)
+        outputs = torch.jit.load(path)(*example_inputs)
+    else:
+        torch.onnx.export(model, example_inputs, path, input_names=input_names, output_names=output_names,
+                          opset_version=16)
+        try:
+            import onnxruntime
+        except ImportError:
+            print('\tonnxruntime is not installed, skipping the output check')
+            return None
+        session = onnxruntime.InferenceSession(path)
+        outputs = session.run(None, {name: t.numpy() for name, t in zip(input_names, example_inputs)})
+        outputs = [torch.from_numpy(o) for o in outputs]
+    return outputs if isinstance(outputs, (list, tuple)) else [outputs]
+
+
+@torch.no_grad()
+def export(cfg, args):
+    assert cfg['model']['depth_model'] == 'fusion' and cfg['model']['pose_model'] == 'fusion', '\tOnly fusion models can be exported'
+    # weights are loaded from the trained model
+    cfg['model']['weights_init'] = False
+
+    b, n_cam = args.batch_size, cfg['data']['num_cams']
+    height, width = cfg['training']['height'], cfg['training']['width']
+    K, extrinsics = load_calib(args.calib, height, width)
+    static_calib = dict(K=K, extrinsics=extrinsics) if args.static_calib else {}
+    calib_inputs = () if args.static_calib else (K.repeat(b, 1, 1, 1), extrinsics.repeat(b, 1, 1, 1))
+    calib_names = [] if args.static_calib else ['K', 'extrinsics']
+
+    images = torch.rand(b, n_cam, 3, height, width)
+    next_images = torch.rand(b, n_cam, 3, height, width)
+    mask = torch.ones(b, n_cam, 1, height, width)
+
+    nets = {
+        'depth_net': (FusedDepthNet(cfg), DepthExportNet, (images, mask) + calib_inputs,
+                      ['images', 'mask'] + calib_names, ['depth']),
+        'pose_net': (FusedPoseNet(cfg), PoseExportNet, (images, next_images, mask) + calib_inputs,
+                     ['cur_images', 'next_images', 'mask'] + calib_names, ['axis_angle', 'translation']),
+    }
+
+    os.makedirs(args.output, exist_ok=True)
+    ext = '.pt' if args.format == 'torchscript' else '.onnx'
+    for name, (net, wrapper, example_inputs, input_names, output_names) in nets.items():
+        path = os.path.join(cfg['data']['load_weights_dir'], f'{name}.pth')
+        if not os.path.isfile(path):
+            print(f'\tCannot find {path}, skipping {name}')
+            continue
+        load_model_weights(net, path)
+        model = wrapper(net, height, width, **static_calib).eval()
+
+        eager_outputs = model(*example_inputs)
+        eager_outputs = eager_outputs if isinstance(eager_outputs, (list, tuple)) else [eager_outputs]
+        out_path = os.path.join(args.output, name + ext)
+        outputs = export_net(model, example_inputs, out_path, args.format, input_names, output_names)
+        print(f'Exported {name} to {out_path}')
+
+        if outputs is not None:
+            max_diff = max((o - e).abs().max().item() for o, e in zip(outputs, eager_outputs))
+            assert max_diff <= args.atol, f'\tExported {name} differs from the eager model by {max_diff}'
+            print(f'\tmax difference from the eager model: {max_diff:.2e}')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cfg = utils.get_config(args.config_file, mode='eval', weight_path = args.weight_path)
+    export(cfg, args)
@@ -1,7 +1,8 @@
 # Copyright (c) 2023 42dot. All rights reserved.
 from external.packnet_sfm.packnet_sfm.datasets.transforms import get_transforms
+from external.packnet_sfm.packnet_sfm.datasets.augmentations import random_color_jitter_transform
 from external.packnet_sfm.packnet_sfm.datasets.dgp_dataset import DGPDataset
 from external.packnet_sfm.packnet_sfm.datasets.dgp_dataset import stack_sample
 from external.packnet_sfm.packnet_sfm.datasets.dgp_dataset import SynchronizedSceneDataset
 
-__all__ = ['get_transforms', 'stack_sample', 'DGPDataset', 'SynchronizedSceneDataset']
\ No newline at end of file
+__all__ = ['get_transforms', 'random_color_jitter_transform', 'stack_sample', 'DGPDataset', 'SynchronizedSceneDataset']
\ No newline at end of file
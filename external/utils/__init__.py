@@ -1,6 +1,7 @@
 # Copyright (c) 2023 42dot. All rights reserved.
 from external.dgp.dgp.utils.camera import Camera
 from external.dgp.dgp.utils.camera import generate_depth_map
+from external.dgp.dgp.utils.pose import Pose
 from external.packnet_sfm.packnet_sfm.utils.misc import make_list
 
-__all__ = ['Camera', 'generate_depth_map', 'make_list']
\ No newline at end of file
+__all__ = ['Camera', 'generate_depth_map', 'Pose', 'make_list']
\ No newline at end of file
@@ -1,4 +1,5 @@
 # Copyright (c) 2023 42dot. All rights reserved.
 from .vfdepth import VFDepthAlgo
+from .predictor import VFDepthPredictor
 
-__all__ = ['VFDepthAlgo']
\ No newline at end of file
+__all__ = ['VFDepthAlgo', 'VFDepthPredictor']
\ No newline at end of file
@@ -12,6 +12,7 @@ class BaseModel:
         self.models = None
         self.optimizer = None
         self.lr_scheduler = None
+        self.train_sampler = None
         self.ddp_enable = False
 
     def read_config(self, cfg):
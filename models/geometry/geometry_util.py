@@ -4,7 +4,10 @@ import torch
 import torch.nn as nn
 from pytorch3d.transforms import axis_angle_to_matrix 
 
+from utils.precision import full_precision
+
         
+@full_precision
 def vec_to_matrix(rot_angle, trans_vec, invert=False):
     """
     This function transforms rotation angle and translation vector into 4x4 matrix.
@@ -34,49 +37,56 @@ class Projection(nn.Module):
     """
     This class computes projection and reprojection function. 
     """
-    def __init__(self, batch_size, height, width, device):
+    def __init__(self):
         super().__init__()
-        self.batch_size = batch_size
-        self.width = width
-        self.height = height
-        
-        # initialize img point grid
-        img_points = np.meshgrid(range(width), range(height), indexing='xy')
-        img_points = torch.from_numpy(np.stack(img_points, 0)).float()
-        img_points = torch.stack([img_points[0].view(-1), img_points[1].view(-1)], 0).repeat(batch_size, 1, 1)
-        img_points = img_points.to(device)
-        
-        self.to_homo = torch.ones([batch_size, 1, width*height]).to(device)
-        self.homo_points = torch.cat([img_points, self.to_homo], 1)
+        # homogeneous pixel grids, created lazily for each (height, width, device, dtype)
+        self.homo_points = {}
 
+    def get_homo_points(self, height, width, sample_tensor):
+        """
+        This function returns the homogeneous image point grid [1, 3, height*width], shared over the batch dimension.
+        """
+        key = (height, width, sample_tensor.device, sample_tensor.dtype)
+        if key not in self.homo_points:
+            img_points = np.meshgrid(range(width), range(height), indexing='xy')
+            img_points = torch.from_numpy(np.stack(img_points, 0)).view(1, 2, -1)
+            homo_points = torch.cat([img_points, torch.ones(1, 1, height*width)], 1)
+            self.homo_points[key] = homo_points.to(device=sample_tensor.device, dtype=sample_tensor.dtype)
+        return self.homo_points[key]
+
+    @full_precision
     def backproject(self, invK, depth):
         """
         This function back-projects 2D image points to 3D.
         """
-        depth = depth.view(self.batch_size, 1, -1)
+        b, _, h, w = depth.size()
+        depth = depth.view(b, 1, -1)
 
-        points3D = torch.matmul(invK[:, :3, :3], self.homo_points)
+        points3D = torch.matmul(invK[:, :3, :3], self.get_homo_points(h, w, depth))
         points3D = depth*points3D
-        return torch.cat([points3D, self.to_homo], 1)
+        return torch.cat([points3D, torch.ones_like(depth)], 1)
     
-    def reproject(self, K, points3D, T):
+    @full_precision
+    def reproject(self, K, points3D, T, img_size):
         """
         This function reprojects transformed 3D points to 2D image coordinate.
         """
+        height, width = img_size
+        
         # project points 
         points2D = (K @ T)[:,:3, :] @ points3D
 
         # normalize projected points for grid sample function
         norm_points2D = points2D[:, :2, :]/(points2D[:, 2:, :] + 1e-7)
-        norm_points2D = norm_points2D.view(self.batch_size, 2, self.height, self.width)
+        norm_points2D = norm_points2D.view(points3D.size(0), 2, height, width)
         norm_points2D = norm_points2D.permute(0, 2, 3, 1)
 
-        norm_points2D[..., 0 ] /= self.width - 1
-        norm_points2D[..., 1 ] /= self.height - 1
+        norm_points2D[..., 0 ] /= width - 1
+        norm_points2D[..., 1 ] /= height - 1
         norm_points2D = (norm_points2D-0.5)*2
         return norm_points2D        
 
     def forward(self, depth, T, bp_invK, rp_K):
         cam_points = self.backproject(bp_invK, depth)
-        pix_coords = self.reproject(rp_K, cam_points, T)
+        pix_coords = self.reproject(rp_K, cam_points, T, depth.shape[-2:])
         return pix_coords
\ No newline at end of file
@@ -2,6 +2,7 @@
 import torch
 
 from .geometry_util import vec_to_matrix
+from utils.precision import full_precision
 
 
 class Pose:
@@ -41,6 +42,7 @@ class Pose:
             output[('cam_T_cam', 0, f_i)] = vec_to_matrix(axisangle[:, 0], translation[:, 0], invert=(f_i < 0))            
         return output
         
+    @full_precision
     def distribute_pose(self, poses, exts, exts_inv):
         """
         This function distrubutes pose to each camera by using the canonical pose and camera extrinsics.
@@ -63,6 +65,7 @@ class Pose:
                 outputs[('cam',cam)][('cam_T_cam', 0, f_i)] = cur_T            
         return outputs 
     
+    @full_precision
     def compute_relative_cam_poses(self, inputs, outputs, cam):
         """
         This function computes spatio & spatio-temporal transformation for images from different viewpoints.
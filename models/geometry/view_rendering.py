@@ -4,6 +4,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from .geometry_util import Projection
+from network.blocks import pack_cam_feat, unpack_cam_feat
+from utils.precision import full_precision
 
 
 class ViewRendering(nn.Module):
@@ -22,9 +24,7 @@ class ViewRendering(nn.Module):
                 setattr(self, k, v)
                 
     def init_project_imgs(self, rank):
-        project_imgs = {}
-        project_imgs = Projection(
-                self.batch_size, self.height, self.width, rank)
+        project_imgs = Projection()
         return project_imgs    
     
     def get_mean_std(self, feature, mask):
@@ -58,13 +58,42 @@ class ViewRendering(nn.Module):
         norm_warp = (warp_img - w_mean) / (w_std + 1e-8) * s_std + s_mean
         return norm_warp * warp_mask.float()   
 
+    def get_norm_image(self, src_img, src_mask, warp_img, warp_mask):
+        """
+        Batched version of get_norm_image_single for [batch, n_pairs, c, h, w] inputs.
+        As in get_norm_image_single, a pair is not normalized when any sample of the batch has no overlap. 
+        """
+        warp_mask = warp_mask.detach()
+
+        with torch.no_grad():
+            mask = (src_mask * warp_mask).bool()
+            if mask.size(2) != 3:
+                mask = mask.repeat(1,1,3,1,1)
+
+            mask_sum = mask.sum(dim=(-3,-2,-1))
+            # skip pairs when there is no overlap
+            skip = torch.any(mask_sum == 0, dim=0).view(1, -1, 1, 1, 1)
+
+            b, n_pairs = mask.shape[:2]
+            s_mean, s_std = self.get_mean_std(pack_cam_feat(src_img), pack_cam_feat(mask))
+            w_mean, w_std = self.get_mean_std(pack_cam_feat(warp_img), pack_cam_feat(mask))
+            s_mean, s_std, w_mean, w_std = [unpack_cam_feat(v, b, n_pairs) for v in [s_mean, s_std, w_mean, w_std]]
+
+        norm_warp = (warp_img - w_mean) / (w_std + 1e-8) * s_std + s_mean
+        return torch.where(skip, warp_img, norm_warp * warp_mask.float())
+
     def get_virtual_image(self, src_img, src_mask, tar_depth, tar_invK, src_K, T, scale=0):
         """
         This function warps source image to target image using backprojection and reprojection process. 
         """
         # do reconstruction for target from source   
         pix_coords = self.project(tar_depth, T, tar_invK, src_K)
-        
+        return self.warp_image(src_img, src_mask, pix_coords)
+
+    def warp_image(self, src_img, src_mask, pix_coords):
+        """
+        This function samples source image and mask at the reprojected pixel coordinates.
+        """
         img_warped = F.grid_sample(src_img, pix_coords, mode='bilinear', 
                                     padding_mode='zeros', align_corners=True)
         mask_warped = F.grid_sample(src_mask, pix_coords, mode='nearest', 
@@ -81,6 +110,7 @@ class ViewRendering(nn.Module):
                                         pix_coords < -1).sum(dim=1, keepdim=True) > 0
         return img_warped, (~invalid_mask).float() * mask_warped
 
+    @full_precision
     def get_virtual_depth(self, src_depth, src_mask, src_invK, src_K, tar_depth, tar_invK, tar_K, T, min_depth, max_depth, scale=0):
         """
         This function backward-warp source depth into the target coordinate.
@@ -115,129 +145,140 @@ class ViewRendering(nn.Module):
         depth_warped[~valid_depth_max] = max_depth
         return depth_warped, (~invalid_mask).float() * mask_warped * valid_depth_min * valid_depth_max        
         
-    def forward(self, inputs, outputs, cam, rel_pose_dict):
+    def get_render_pairs(self, outputs, rel_pose_dicts):
+        """
+        This function lists (target cam, source cam, frame_id, transformation) of all images to be rendered.
+        Temporal pairs come first, then spatial and spatio-temporal pairs grouped by (target cam, frame_id).
+        """
+        pairs = []
+        for cam in range(self.num_cams):
+            target_view = outputs[('cam', cam)]
+            for frame_id in self.frame_ids[1:]:
+                pairs.append((cam, cam, frame_id, target_view[('cam_T_cam', 0, frame_id)]))
+
+        groups = []
+        if self.spatio or self.spatio_temporal:
+            for cam in range(self.num_cams):
+                for frame_id in self.frame_ids:
+                    start = len(pairs)
+                    for cur_index in self.rel_cam_list[cam]:
+                        # for partial surround view training
+                        if cur_index >= self.num_cams:
+                            continue
+                        pairs.append((cam, cur_index, frame_id, rel_pose_dicts[cam][(frame_id, cur_index)]))
+                    groups.append((cam, frame_id, start, len(pairs)))
+        return pairs, groups
+
+    def render_images(self, inputs, outputs, pairs, scale):
+        """
+        This function warps source images of all pairs into their target views at once.
+        Each target depth is backprojected once, then all pairs are reprojected and sampled as a single packed batch.
+        output: warped images and masks, [batch, n_pairs, c, h, w]
+        """
+        source_scale = 0
+        tar_idx = [pair[0] for pair in pairs]
+        src_idx = [pair[1] for pair in pairs]
+        b = inputs['mask'].size(0)
+        n_pairs = len(pairs)
+
+        # backproject target depth of each camera. [b, n_cam, 4, h*w]
+        tar_depth = torch.stack([outputs[('cam', cam)][('depth', scale)] for cam in range(self.num_cams)], 1)
+        tar_invK = inputs[('inv_K', source_scale)]
+        cam_points = self.project.backproject(pack_cam_feat(tar_invK), pack_cam_feat(tar_depth))
+        cam_points = unpack_cam_feat(cam_points, b, self.num_cams)
+
+        # reproject all pairs. [b*n_pairs, h, w, 2]
+        src_K = inputs[('K', source_scale)][:, src_idx, ...]
+        T = torch.stack([pair[3] for pair in pairs], 1)
+        pix_coords = self.project.reproject(pack_cam_feat(src_K), pack_cam_feat(cam_points[:, tar_idx, ...]), pack_cam_feat(T), 
+                                             tar_depth.shape[-2:])
+
+        # sample source images and masks
+        src_color = torch.stack([inputs['color', frame_id, source_scale][:, src, ...] for _, src, frame_id, _ in pairs], 1)
+        src_mask = inputs['mask'][:, src_idx, ...]
+        warped_img, warped_mask = self.warp_image(pack_cam_feat(src_color), pack_cam_feat(src_mask), pix_coords)
+        warped_img = unpack_cam_feat(warped_img, b, n_pairs)
+        warped_mask = unpack_cam_feat(warped_mask, b, n_pairs)
+
+        if self.intensity_align:
+            ref_color = inputs['color', 0, source_scale][:, tar_idx, ...]
+            ref_mask = inputs['mask'][:, tar_idx, ...]
+            warped_img = self.get_norm_image(ref_color, ref_mask, warped_img, warped_mask)
+        return warped_img, warped_mask
+
+    def forward(self, inputs, outputs, rel_pose_dicts):
         # predict images for each scale(default = scale 0 only)
         source_scale = 0
+        pairs, groups = self.get_render_pairs(outputs, rel_pose_dicts)
         
-        # ref inputs
-        ref_color = inputs['color', 0, source_scale][:,cam, ...]        
-        ref_mask = inputs['mask'][:, cam, ...]
+        for scale in self.scales:
+            warped_img, warped_mask = self.render_images(inputs, outputs, pairs, scale)
+
+            # temporal learning
+            for i, (cam, _, frame_id, _) in enumerate(pairs[:self.num_cams * len(self.frame_ids[1:])]):
+                outputs[('cam', cam)][('color', frame_id, scale)] = warped_img[:, i, ...]
+                outputs[('cam', cam)][('color_mask', frame_id, scale)] = warped_mask[:, i, ...]
+
+            # spatio-temporal learning, assuming no overlap between warped images
+            for cam, frame_id, start, end in groups:
+                target_view = outputs[('cam', cam)]
+                if start == end:
+                    target_view[('overlap', frame_id, scale)] = torch.zeros_like(inputs['color', 0, source_scale][:, cam, ...])
+                    target_view[('overlap_mask', frame_id, scale)] = torch.zeros_like(inputs['mask'][:, cam, ...])
+                else:
+                    target_view[('overlap', frame_id, scale)] = warped_img[:, start:end, ...].sum(1)
+                    target_view[('overlap_mask', frame_id, scale)] = warped_mask[:, start:end, ...].sum(1)
+
+            if self.aug_depth:
+                for cam in range(self.num_cams):
+                    self.render_aug_depth(inputs, outputs, cam, scale)
+
+    def render_aug_depth(self, inputs, outputs, cam, scale):
+        """
+        This function warps depth maps of the neighboring cameras into the augmented view of the target camera.
+        """
+        source_scale = 0
         ref_K = inputs[('K', source_scale)][:,cam, ...]
         ref_invK = inputs[('inv_K', source_scale)][:,cam, ...]  
-        
-        # output
         target_view = outputs[('cam', cam)]
         
-        for scale in self.scales:           
-            ref_depth = target_view[('depth', scale)]          
-            for frame_id in self.frame_ids[1:]:                
-                # for temporal learning
-                T = target_view[('cam_T_cam', 0, frame_id)]
-                src_color = inputs['color', frame_id, source_scale][:, cam, ...] 
-                src_mask = inputs['mask'][:, cam, ...]
-                warped_img, warped_mask = self.get_virtual_image(
-                    src_color, 
-                    src_mask, 
-                    ref_depth, 
-                    ref_invK, 
-                    ref_K, 
-                    T, 
-                    source_scale
-                )
-                
-                if self.intensity_align:
-                    warped_img = self.get_norm_image_single(
-                        ref_color, 
-                        ref_mask,
-                        warped_img, 
-                        warped_mask
-                    )
-                
-                target_view[('color', frame_id, scale)] = warped_img
-                target_view[('color_mask', frame_id, scale)] = warped_mask            
+        tform_depth = []
+        tform_mask = []
 
-            # spatio-temporal learning
-            if self.spatio or self.spatio_temporal:
-                for frame_id in self.frame_ids:
-                    overlap_img = torch.zeros_like(ref_color)
-                    overlap_mask = torch.zeros_like(ref_mask)       
-                    
-                    for cur_index in self.rel_cam_list[cam]:
-                        # for partial surround view training
-                        if cur_index >= self.num_cams: 
-                            continue
+        aug_ext = inputs['extrinsics_aug'][:, cam, ...]
+        aug_ext_inv = torch.inverse(aug_ext)                
+        aug_K, aug_invK = ref_K, ref_invK
+        aug_depth = target_view[('depth', scale, 'aug')]
 
-                        src_color = inputs['color', frame_id, source_scale][:, cur_index, ...]
-                        src_mask = inputs['mask'][:, cur_index, ...]
-                        src_K = inputs[('K', source_scale)][:, cur_index, ...]                        
-                        
-                        rel_pose = rel_pose_dict[(frame_id, cur_index)]
-                        warped_img, warped_mask = self.get_virtual_image(
-                            src_color, 
-                            src_mask, 
-                            ref_depth, 
-                            ref_invK, 
-                            src_K,
-                            rel_pose, 
-                            source_scale
-                        )
-
-                        if self.intensity_align:
-                            warped_img = self.get_norm_image_single(
-                                ref_color, 
-                                ref_mask,
-                                warped_img, 
-                                warped_mask
-                            )
-
-                        # assuming no overlap between warped images
-                        overlap_img = overlap_img + warped_img
-                        overlap_mask = overlap_mask + warped_mask
-                    
-                    target_view[('overlap', frame_id, scale)] = overlap_img
-                    target_view[('overlap_mask', frame_id, scale)] = overlap_mask
-                    
-            # depth augmentation at a novel view
-            if self.aug_depth:
-                tform_depth = []
-                tform_mask = []
-
-                aug_ext = inputs['extrinsics_aug'][:, cam, ...]
-                aug_ext_inv = torch.inverse(aug_ext)                
-                aug_K, aug_invK = ref_K, ref_invK
-                aug_depth = target_view[('depth', scale, 'aug')]
-
-                for i, curr_index in enumerate(self.rel_cam_list[cam] + [cam]):
-                    # for partial surround view training
-                    if curr_index >= self.num_cams: 
-                        continue
-
-                    src_ext = inputs['extrinsics'][:, curr_index, ...]                        
-                    
-                    src_depth = outputs[('cam', curr_index)][('depth', scale)]
-                    src_mask = inputs['mask'][:, curr_index, ...]                
-                    src_invK = inputs[('inv_K', source_scale)][:,curr_index, ...]
-                    src_K = inputs[('K', source_scale)][:,curr_index, ...]
-
-                    # current view to the novel view
-                    rel_pose = torch.matmul(aug_ext_inv, src_ext)
-                    warp_depth, warp_mask = self.get_virtual_depth(
-                        src_depth, 
-                        src_mask, 
-                        src_invK, 
-                        src_K,
-                        aug_depth, 
-                        aug_invK, 
-                        aug_K, 
-                        rel_pose,
-                        self.min_depth,
-                        self.max_depth
-                    )
-
-                    tform_depth.append(warp_depth)
-                    tform_mask.append(warp_mask)
-
-                target_view[('tform_depth', scale)] = tform_depth
-                target_view[('tform_depth_mask', scale)] = tform_mask
-
-        outputs[('cam', cam)] = target_view
\ No newline at end of file
+        for i, curr_index in enumerate(self.rel_cam_list[cam] + [cam]):
+            # for partial surround view training
+            if curr_index >= self.num_cams: 
+                continue
+
+            src_ext = inputs['extrinsics'][:, curr_index, ...]                        
+            
+            src_depth = outputs[('cam', curr_index)][('depth', scale)]
+            src_mask = inputs['mask'][:, curr_index, ...]                
+            src_invK = inputs[('inv_K', source_scale)][:,curr_index, ...]
+            src_K = inputs[('K', source_scale)][:,curr_index, ...]
+
+            # current view to the novel view
+            rel_pose = torch.matmul(aug_ext_inv, src_ext)
+            warp_depth, warp_mask = self.get_virtual_depth(
+                src_depth, 
+                src_mask, 
+                src_invK, 
+                src_K,
+                aug_depth, 
+                aug_invK, 
+                aug_K, 
+                rel_pose,
+                self.min_depth,
+                self.max_depth
+            )
+
+            tform_depth.append(warp_depth)
+            tform_mask.append(warp_mask)
+
+        target_view[('tform_depth', scale)] = tform_depth
+        target_view[('tform_depth_mask', scale)] = tform_mask
@@ -9,6 +9,7 @@ class BaseLoss(nn.Module):
     def __init__(self, cfg, rank):
         super().__init__()
         self.rank = rank
+        self.log_stats = True
         self.init_weights(cfg)
         self.init_attrib(cfg) # TODO : add more attributes
 
@@ -27,7 +28,11 @@ class BaseLoss(nn.Module):
     def get_logs(self, loss_dict, output, cam):
         """
         This function logs depth and pose information for monitoring training process. 
+        The statistics are only computed if log_stats is set, which the trainer clears for the steps that are not logged.
         """
+        if not self.log_stats:
+            return loss_dict
+
         # log statistics
         depth_log = output[('depth', 0)].clone().detach()
         loss_dict['depth/mean'] = depth_log.mean()
@@ -75,17 +75,17 @@ class DepthSynLoss(MultiCamLoss):
             # for logger
             ##########################
             if scale == 0:
-                loss_dict['reproj_loss'] = reprojection_loss.item()
-                loss_dict['spatio_loss'] = spatio_loss.item()
-                loss_dict['spatio_tempo_loss'] = spatio_tempo_loss.item()
-                loss_dict['depth_loss'] = depthsyn_loss.item()
-                loss_dict['depth_sm_loss'] = depth_sm_loss.item()
-                loss_dict['depth_con_loss'] = depth_con_loss.item()                    
-                loss_dict['smooth'] = smooth_loss.item()
+                loss_dict['reproj_loss'] = reprojection_loss.detach()
+                loss_dict['spatio_loss'] = spatio_loss.detach()
+                loss_dict['spatio_tempo_loss'] = spatio_tempo_loss.detach()
+                loss_dict['depth_loss'] = depthsyn_loss.detach()
+                loss_dict['depth_sm_loss'] = depth_sm_loss.detach()
+                loss_dict['depth_con_loss'] = depth_con_loss.detach()                    
+                loss_dict['smooth'] = smooth_loss.detach()
 
                 # log statistics
                 self.get_logs(loss_dict, target_view, cam)                       
         
         cam_loss /= len(self.scales)
-        loss_dict['cam_loss'] = cam_loss.item()
+        loss_dict['cam_loss'] = cam_loss.detach()
         return cam_loss, loss_dict
\ No newline at end of file
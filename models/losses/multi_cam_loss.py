@@ -2,7 +2,7 @@
 import torch
 from pytorch3d.transforms import matrix_to_euler_angles 
 
-from .loss_util import compute_photometric_loss, compute_masked_loss
+from .loss_util import compute_masked_loss
 from .single_cam_loss import SingleCamLoss
 
 
@@ -13,17 +13,35 @@ class MultiCamLoss(SingleCamLoss):
     def __init__(self, cfg, rank):
         super(MultiCamLoss, self).__init__(cfg, rank)
     
+    def get_photometric_pairs(self, inputs, target_view, cam=0, scale=0):
+        """
+        This function adds the images synthesized from the other cameras to the temporal image pairs.
+        """
+        pairs = super().get_photometric_pairs(inputs, target_view, cam, scale)
+        pairs[('spatio', 0)] = target_view[('overlap', 0, scale)]
+        for frame_id in self.frame_ids[1:]:
+            pairs[('spatio_tempo', frame_id)] = target_view[('overlap', frame_id, scale)]
+        return pairs
+
+    def get_photometric_masks(self, inputs, target_view, cam=0, scale=0):
+        """
+        This function returns the masks of the spatial and spatio-temporal image pairs, which cover the overlap regions only.
+        The spatio-temporal losses are compared across frames, so they share the union of their masks.
+        """
+        ref_mask = inputs['mask'][:, cam, ...]
+        masks = {('spatio', 0): ref_mask * target_view[('overlap_mask', 0, scale)]}
+        spatio_tempo_mask = sum(target_view[('overlap_mask', frame_id, scale)].float() for frame_id in self.frame_ids[1:])
+        for frame_id in self.frame_ids[1:]:
+            masks[('spatio_tempo', frame_id)] = ref_mask * spatio_tempo_mask
+        return masks
+
     def compute_spatio_loss(self, inputs, target_view, cam=None, scale=None, ref_mask=None):
         """
         This function computes spatial loss.
         """        
         # self occlusion mask * overlap region mask
         spatio_mask = ref_mask * target_view[('overlap_mask', 0, scale)]
-        loss_args = {
-            'pred': target_view[('overlap', 0, scale)],
-            'target': inputs['color',0, 0][:,cam, ...]         
-        }        
-        spatio_loss = compute_photometric_loss(**loss_args)
+        spatio_loss = target_view[('photo_loss', 'spatio', 0, scale)]
         
         target_view[('overlap_mask', 0, scale)] = spatio_mask         
         return compute_masked_loss(spatio_loss, spatio_mask) 
@@ -39,12 +57,7 @@ class MultiCamLoss(SingleCamLoss):
             pred_mask = ref_mask * target_view[('overlap_mask', frame_id, scale)]
             pred_mask = pred_mask * reproj_loss_mask 
             
-            loss_args = {
-                'pred': target_view[('overlap', frame_id, scale)],
-                'target': inputs['color',0, 0][:,cam, ...]
-            } 
-            
-            spatio_tempo_losses.append(compute_photometric_loss(**loss_args))
+            spatio_tempo_losses.append(target_view[('photo_loss', 'spatio_tempo', frame_id, scale)])
             spatio_tempo_masks.append(pred_mask)
         
         # concatenate losses and masks
@@ -124,12 +137,12 @@ class MultiCamLoss(SingleCamLoss):
             # for logger
             ##########################
             if scale == 0:
-                loss_dict['reproj_loss'] = reprojection_loss.item()
-                loss_dict['spatio_loss'] = spatio_loss.item()
-                loss_dict['spatio_tempo_loss'] = spatio_tempo_loss.item()
-                loss_dict['smooth'] = smooth_loss.item()
+                loss_dict['reproj_loss'] = reprojection_loss.detach()
+                loss_dict['spatio_loss'] = spatio_loss.detach()
+                loss_dict['spatio_tempo_loss'] = spatio_tempo_loss.detach()
+                loss_dict['smooth'] = smooth_loss.detach()
                 if self.pose_model == 'fsm' and cam != 0:
-                    loss_dict['pose'] = pose_loss.item()
+                    loss_dict['pose'] = pose_loss.detach()
                 
                 # log statistics
                 self.get_logs(loss_dict, target_view, cam)                        
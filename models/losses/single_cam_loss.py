@@ -1,7 +1,9 @@
 # Copyright (c) 2023 42dot. All rights reserved.
 import torch
 
-from .loss_util import compute_photometric_loss, compute_edg_smooth_loss, compute_masked_loss, compute_auto_masks
+from utils.photometric import compute_photometric_loss, compute_fused_photometric_loss, compute_tiled_photometric_loss, \
+                              compute_ssim_stats
+from .loss_util import compute_edg_smooth_loss, compute_masked_loss, compute_auto_masks
 from .base_loss import BaseLoss
 
 _EPSILON = 0.00001
@@ -14,36 +16,84 @@ class SingleCamLoss(BaseLoss):
     def __init__(self, cfg, rank):
         super().__init__(cfg, rank)        
 
+    def get_photometric_pairs(self, inputs, target_view, cam=0, scale=0):
+        """
+        This function returns the images compared against the target image of the camera, keyed by (loss type, frame_id).
+        """
+        pairs = {}
+        for frame_id in self.frame_ids[1:]:
+            pairs[('reproj', frame_id)] = target_view[('color', frame_id, scale)]
+        return pairs
+
+    def get_photometric_masks(self, inputs, target_view, cam=0, scale=0):
+        """
+        This function returns the valid pixel masks of the image pairs, whose losses are only needed on the masks.
+        """
+        return {}
+
+    def compute_identity_losses(self, inputs, target, target_stats):
+        """
+        This function computes identity reprojection losses [b, cam, 1, h, w], which only depend on the input images.
+        They are computed once for all scales, or taken from the dataset if they are precomputed.
+        """
+        identity_losses = {}
+        for frame_id in self.frame_ids[1:]:
+            if ('identity_loss', frame_id) in inputs:
+                identity_losses[frame_id] = inputs[('identity_loss', frame_id)]
+            else:
+                context = inputs[('color', frame_id, 0)]
+                loss = compute_photometric_loss(context.flatten(0, 1), target, target_stats)
+                identity_losses[frame_id] = loss.view(*context.shape[:2], *loss.shape[1:])
+        return identity_losses
+
+    def compute_photometric_losses(self, inputs, outputs):
+        """
+        This function computes the photometric losses of all cameras and image pairs in a single call,
+        by stacking them along the batch dimension. The SSIM statistics of the target images are computed once and shared.
+        The losses are stored in outputs[('cam', cam)][('photo_loss', loss type, frame_id, scale)].
+        """
+        b, num_cams = inputs['color', 0, 0].shape[:2]
+        target = inputs['color', 0, 0].flatten(0, 1)
+        target_stats = compute_ssim_stats(target)
+
+        identity_losses = self.compute_identity_losses(inputs, target, target_stats)
+        photometric_loss = compute_fused_photometric_loss if self.fused_photometric else compute_photometric_loss
+        for scale in self.scales:
+            pairs = [self.get_photometric_pairs(inputs, outputs[('cam', cam)], cam, scale) for cam in range(num_cams)]
+            masks = [self.get_photometric_masks(inputs, outputs[('cam', cam)], cam, scale) 
+                     if self.spatio_tile_size > 0 else {} for cam in range(num_cams)]
+            stack = lambda keys, values: torch.stack([torch.stack([v[key] for v in values], 1).flatten(0, 1) for key in keys], 0)
+
+            # losses of the image pairs with masks are only evaluated on the tiles containing valid pixels
+            keys = [key for key in pairs[0] if key not in masks[0]]
+            tiled_keys = [key for key in pairs[0] if key in masks[0]]
+            losses = {}
+            if keys:
+                losses.update(zip(keys, photometric_loss(stack(keys, pairs), target, target_stats)))
+            if tiled_keys:
+                tiled_losses = compute_tiled_photometric_loss(stack(tiled_keys, pairs), target, stack(tiled_keys, masks), 
+                                                              self.spatio_tile_size, photometric_loss)
+                losses.update(zip(tiled_keys, tiled_losses))
+
+            for cam in range(num_cams):
+                target_view = outputs[('cam', cam)]
+                for key, loss in losses.items():
+                    target_view[('photo_loss', *key, scale)] = loss.view(b, num_cams, *loss.shape[1:])[:, cam, ...]
+                for frame_id, loss in identity_losses.items():
+                    target_view[('photo_loss', 'identity', frame_id, scale)] = loss[:, cam, ...]
+
     def compute_reproj_loss(self, inputs, target_view, cam=0, scale=0, ref_mask=None):
         """
         This function computes reprojection loss using auto mask. 
         """
-        reprojection_losses = []
-        for frame_id in self.frame_ids[1:]:
-            reproj_loss_args = {
-                'pred': target_view[('color', frame_id, scale)],
-                'target': inputs['color',0, 0][:, cam, ...]
-            }
-            reprojection_losses.append(
-                compute_photometric_loss(**reproj_loss_args)
-            )                
-            
+        reprojection_losses = [target_view[('photo_loss', 'reproj', frame_id, scale)] for frame_id in self.frame_ids[1:]]
         reprojection_losses = torch.cat(reprojection_losses, 1)
         reprojection_loss, _ = torch.min(reprojection_losses, dim=1, keepdim=True)
         
-        identity_reprojection_losses = []
-        for frame_id in self.frame_ids[1:]:
-            identity_reproj_loss_args = {
-                'pred': inputs[('color', frame_id, 0)][:, cam, ...],
-                'target': inputs['color',0, 0][:, cam, ...]              
-            }
-            identity_reprojection_losses.append(
-                compute_photometric_loss(**identity_reproj_loss_args)
-            )
-
+        identity_reprojection_losses = [target_view[('photo_loss', 'identity', frame_id, scale)] for frame_id in self.frame_ids[1:]]
         identity_reprojection_losses = torch.cat(identity_reprojection_losses, 1)
         identity_reprojection_losses = identity_reprojection_losses + \
-                                        _EPSILON * torch.randn(identity_reprojection_losses.shape).to(self.rank)
+                                        _EPSILON * torch.randn_like(identity_reprojection_losses)
         identity_reprojection_loss, _ = torch.min(identity_reprojection_losses, dim=1, keepdim=True)             
            
         # find minimum losses
@@ -85,8 +135,8 @@ class SingleCamLoss(BaseLoss):
             # for logger
             ##########################
             if scale == 0:
-                loss_dict['reproj_loss'] = reprojection_loss.item()            
-                loss_dict['smooth'] = smooth_loss.item()
+                loss_dict['reproj_loss'] = reprojection_loss.detach()            
+                loss_dict['smooth'] = smooth_loss.detach()
 
                 # log statistics
                 self.get_logs(loss_dict, target_view, cam)                    
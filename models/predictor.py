@@ -0,0 +1,193 @@
+# Copyright (c) 2023 42dot. All rights reserved.
+import copy
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from dataset.data_util import resize_frames
+from network import FusedDepthNet, MonoDepthNet
+from network.blocks import disp_to_depth
+from network.quantization import quantize_depth_net
+
+_DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+class VFDepthPredictor:
+    """
+    Standalone depth predictor for surround-view frames.
+    Unlike VFDepthAlgo, it does not build datasets, pose networks or losses, and only requires images and calibrations.
+    The network runs in fp32, fp16 or bf16 (precision), or in int8 after calling quantize.
+    """
+    def __init__(self, cfg, weight_path=None, device=None, precision='fp32'):
+        cfg = copy.deepcopy(cfg)
+        # weights are loaded from the trained model
+        cfg['model']['weights_init'] = False
+        # depth synthesis is only needed for training and visualization
+        cfg['training']['aug_depth'] = False
+        cfg['eval']['syn_visualize'] = False
+        self.read_config(cfg)
+
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.dtype = _DTYPES[precision]
+        self.depth_net = self.set_depthnet(cfg)
+        self.load_weights(weight_path or self.load_weights_dir)
+        self.depth_net.to(device=self.device, dtype=self.dtype).eval()
+
+    def read_config(self, cfg):
+        for attr in cfg.keys():
+            for k, v in cfg[attr].items():
+                setattr(self, k, v)
+
+    def set_depthnet(self, cfg):
+        if self.depth_model == 'fusion':
+            return FusedDepthNet(cfg)
+        else:
+            return MonoDepthNet(cfg)
+
+    def load_weights(self, weight_path):
+        path = os.path.join(weight_path, 'depth_net.pth') if os.path.isdir(weight_path) else weight_path
+        load_model_weights(self.depth_net, path)
+
+    def quantize(self, frames, backend='fbgemm'):
+        """
+        This function quantizes the depth network to int8, using the given frames to calibrate activation ranges.
+        frames: iterable of (images, K, extrinsics, mask), a handful of samples is enough
+        """
+        assert self.device.type == 'cpu' and self.dtype == torch.float32, '\tint8 inference is only supported for fp32 models on cpu'
+        calib_inputs = [self.prepare_inputs(*frame)[0] for frame in frames]
+        if self.depth_model != 'fusion':
+            calib_inputs = [inputs[('color_aug', 0, 0)][:, cam, ...] for inputs in calib_inputs for cam in range(self.num_cams)]
+        self.depth_net = quantize_depth_net(self.depth_net, calib_inputs, backend)
+
+    def to_tensor(self, x, b=None, dim=4):
+        """
+        This function converts numpy arrays to tensors on the predictor device, and adds the batch dimension if missing.
+        """
+        x = torch.as_tensor(np.asarray(x) if not torch.is_tensor(x) else x)
+        if b is not None and x.dim() == dim-1:
+            x = x.unsqueeze(0).expand(b, *x.shape).contiguous()
+        return x.to(self.device)
+
+    def prepare_inputs(self, images, K, extrinsics, mask=None):
+        """
+        This function builds the network inputs from raw surround-view frames.
+        images: [batch, cam, 3, h, w] float in [0, 1], or [batch, cam, h, w, 3] uint8 RGB
+        K: [(batch), cam, 3 or 4, 3 or 4] intrinsics at the resolution of the given images
+        extrinsics: [(batch), cam, 4, 4] camera extrinsics, same convention as the training data
+        mask: [(batch), cam, 1, h, w] self-occlusion mask, 1 for valid pixels
+        """
+        images = self.to_tensor(images)
+        if images.size(-1) == 3:
+            images = images.permute(0, 1, 4, 2, 3).contiguous()
+        b, n_cam, _, org_h, org_w = images.size()
+        assert n_cam == self.num_cams, f'\tExpected {self.num_cams} cameras, got {n_cam}'
+
+        # resize images and intrinsics to the network resolution
+        images = resize_frames(images, (self.height, self.width))
+
+        K = self.to_tensor(K, b).float()
+        resized_K = torch.eye(4, device=self.device).repeat(b, n_cam, 1, 1)
+        resized_K[:, :, :3, :3] = K[:, :, :3, :3]
+        resized_K[:, :, 0] *= self.width / org_w
+        resized_K[:, :, 1] *= self.height / org_h
+
+        inputs = {}
+        inputs[('color_aug', 0, 0)] = images.view(b, n_cam, 3, self.height, self.width).to(self.dtype)
+        for scale in range(self.fusion_level+2):
+            scaled_K = resized_K.clone()
+            scaled_K[:, :, :2, :] /= (2**scale)
+            inputs[('K', scale)] = scaled_K
+            inputs[('inv_K', scale)] = torch.inverse(scaled_K)
+
+        inputs['extrinsics'] = self.to_tensor(extrinsics, b).float()
+        inputs['extrinsics_inv'] = torch.inverse(inputs['extrinsics'])
+
+        if mask is None:
+            inputs['mask'] = torch.ones(b, n_cam, 1, self.height, self.width, device=self.device, dtype=self.dtype)
+        else:
+            mask = self.to_tensor(mask, b, dim=5).float()
+            mask = F.interpolate(mask.flatten(0, 1), [self.height, self.width], mode='nearest')
+            inputs['mask'] = mask.view(b, n_cam, 1, self.height, self.width).to(self.dtype)
+        return inputs, (org_h, org_w)
+
+    def to_depth(self, disp_in, K_in, img_size):
+        """
+        This function transforms disparity value into depth map while multiplying the value with the focal length.
+        """
+        disp_in = F.interpolate(disp_in.float(), img_size, mode='bilinear', align_corners=False)
+        return disp_to_depth(disp_in, K_in, self.min_depth, self.max_depth, self.focal_length_scale)
+
+    @torch.no_grad()
+    def predict(self, images, K, extrinsics, mask=None):
+        """
+        This function estimates metric depth maps of surround-view frames.
+        output: [batch, cam, 1, h, w] depth at the resolution of the given images
+        """
+        inputs, img_size = self.prepare_inputs(images, K, extrinsics, mask)
+
+        if self.depth_model == 'fusion':
+            depth_feats = self.depth_net(inputs)
+        else:
+            depth_feats = {}
+            for cam in range(self.num_cams):
+                depth_feats[('cam', cam)] = self.depth_net(inputs[('color_aug', 0, 0)][:, cam, ...])
+
+        depth = []
+        for cam in range(self.num_cams):
+            disp = depth_feats[('cam', cam)][('disp', 0)]
+            depth.append(self.to_depth(disp, inputs[('K', 0)][:, cam, ...], img_size))
+        return torch.stack(depth, 1)
+
+    def stream(self, frames, prefetch_size=2):
+        """
+        This function streams batches of (images, K, extrinsics, mask) through the predictor.
+        Batches are prepared by a background thread, so that loading overlaps with the inference.
+        """
+        for images, K, extrinsics, mask in prefetch(frames, prefetch_size):
+            yield self.predict(images, K, extrinsics, mask)
+
+
+def load_model_weights(model, path):
+    """
+    This function loads network weights on cpu, including weights saved from a DDP model.
+    """
+    assert os.path.isfile(path), f'\tCannot find {path}'
+    print(f'Loading weights from {path}')
+
+    model_dict = model.state_dict()
+    pre_trained_dict = torch.load(path, map_location='cpu')
+    pre_trained_dict = {k.replace('module.', '', 1) if k.startswith('module.') else k: v for k, v in pre_trained_dict.items()}
+    pre_trained_dict = {k: v for k, v in pre_trained_dict.items() if k in model_dict}
+    model_dict.update(pre_trained_dict)
+    model.load_state_dict(model_dict)
+
+
+def prefetch(iterable, size=2):
+    """
+    This function iterates over the iterable in a background thread, keeping up to size items ready.
+    """
+    items = queue.Queue(maxsize=max(size, 1))
+    end = object()
+
+    def worker():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        items.put(end)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    while True:
+        item = items.get()
+        if item is end:
+            break
+        if isinstance(item, Exception):
+            raise item
+        yield item
+    thread.join()
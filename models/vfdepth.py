@@ -7,14 +7,16 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torch.utils.data import DataLoader
 
-from dataset import construct_dataset
+from dataset import construct_dataset, collate_sparse_depth, ChunkSampler
 from network import *
+from network.blocks import disp_to_depth, get_calib_keys
+from utils.precision import full_precision
 
 from .base_model import BaseModel
 from .geometry import Pose, ViewRendering
 from .losses import DepthSynLoss, MultiCamLoss, SingleCamLoss
 
-_NO_DEVICE_KEYS = ['idx', 'dataset_idx', 'sensor_name', 'filename']
+_NO_DEVICE_KEYS = ['idx', 'dataset_idx', 'sensor_name', 'filename', 'calib_keys']
 
 
 class VFDepthAlgo(BaseModel):
@@ -111,10 +113,24 @@ class VFDepthAlgo(BaseModel):
             'shuffle': True,
             'num_workers': self.num_workers,
             'pin_memory': True,
-            'drop_last': True
+            'drop_last': True,
+            'collate_fn': collate_sparse_depth
         }
 
-        if self.ddp_enable:
+        if self.sample_chunk_size > 1:
+            # chunks of consecutive samples share their context frames in the frame cache of each worker
+            dataloader_opts['shuffle'] = False
+            self.train_sampler = ChunkSampler(
+                train_dataset,
+                self.sample_chunk_size,
+                self.batch_size,
+                self.num_workers,
+                num_replicas = self.world_size,
+                rank=rank,
+                scene_ids=train_dataset.get_scene_ids()
+            )
+            dataloader_opts['sampler'] = self.train_sampler
+        elif self.ddp_enable:
             dataloader_opts['shuffle'] = False
             self.train_sampler = torch.utils.data.distributed.DistributedSampler(
                 train_dataset, 
@@ -125,8 +141,10 @@ class VFDepthAlgo(BaseModel):
             dataloader_opts['sampler'] = self.train_sampler
 
         self._dataloaders['train'] = DataLoader(train_dataset, **dataloader_opts)
-        num_train_samples = len(train_dataset)    
-        self.num_total_steps = num_train_samples // (self.batch_size * self.world_size) * self.num_epochs
+        num_train_samples = len(train_dataset) if self.sample_chunk_size <= 1 else len(self.train_sampler) * self.world_size
+        # number of optimizer steps, each of which takes grad_accum_steps batches (or the trailing batches of an epoch)
+        num_batches = num_train_samples // (self.batch_size * self.world_size)
+        self.num_total_steps = -(-num_batches // self.grad_accum_steps) * self.num_epochs
 
     def set_val_dataloader(self, cfg):         
         # Image resizing for the validation data
@@ -145,7 +163,8 @@ class VFDepthAlgo(BaseModel):
             'shuffle': False,
             'num_workers': 0,
             'pin_memory': True,
-            'drop_last': True
+            'drop_last': True,
+            'collate_fn': collate_sparse_depth
         }
 
         self._dataloaders['val']  = DataLoader(val_dataset, **dataloader_opts)
@@ -167,11 +186,26 @@ class VFDepthAlgo(BaseModel):
             'shuffle': False,
             'num_workers': self.eval_num_workers,
             'pin_memory': True,
-            'drop_last': True
+            'drop_last': False,
+            'collate_fn': collate_sparse_depth
         }
 
         self._dataloaders['eval'] = DataLoader(eval_dataset, **dataloader_opts)
 
+    def get_lr_scale(self):
+        """
+        This function returns the learning rate scale for the effective batch (batch_size * world_size * grad_accum_steps),
+        relative to the batch of a single step without gradient accumulation.
+        """
+        if self.lr_scaling == 'linear':
+            return self.grad_accum_steps
+        elif self.lr_scaling == 'sqrt':
+            return self.grad_accum_steps ** 0.5
+        elif self.lr_scaling == 'none':
+            return 1
+        else:
+            raise ValueError('Unknown lr_scaling: ' + self.lr_scaling)
+
     def set_optimizer(self):
         parameters_to_train = []
         for v in self.models.values():
@@ -179,7 +213,7 @@ class VFDepthAlgo(BaseModel):
 
         self.optimizer = optim.Adam(
         parameters_to_train, 
-            self.learning_rate
+            self.learning_rate * self.get_lr_scale()
         )
 
         self.lr_scheduler = optim.lr_scheduler.StepLR(
@@ -192,17 +226,37 @@ class VFDepthAlgo(BaseModel):
         """
         Pass a minibatch through the network and generate images, depth maps, and losses.
         """
+        # calibration keys of the cached projection tables, read on the host
+        if self.depth_model == 'fusion' or self.pose_model == 'fusion':
+            inputs['calib_keys'] = get_calib_keys(inputs[('K', 0)], inputs['extrinsics'])
+
         for key, ipt in inputs.items():
             if key not in _NO_DEVICE_KEYS:
                 if 'context' in key:
                     inputs[key] = [ipt[k].float().to(rank) for k in range(len(inputs[key]))]
                 else:
                     inputs[key] = ipt.float().to(rank)   
+        self.resize_images(inputs)
 
         outputs = self.estimate_vfdepth(inputs)
         losses = self.compute_losses(inputs, outputs)
         return outputs, losses  
 
+    def resize_images(self, inputs):
+        """
+        This function resizes the current images to the scales of the losses on the device,
+        since the dataset only provides the input scale.
+        """
+        images = inputs['color', 0, 0]
+        b, n_cam, _, h, w = images.shape
+        for scale in self.scales:
+            if ('color', 0, scale) not in inputs:
+                resized = F.interpolate(images.flatten(0, 1), 
+                                        size=(h//(2**scale), w//(2**scale)),
+                                        mode='bilinear', 
+                                        align_corners=False)
+                inputs[('color', 0, scale)] = resized.view(b, n_cam, *resized.shape[1:])
+
     def estimate_vfdepth(self, inputs):
         """
         This function sets dataloader for validation in training.
@@ -265,27 +319,23 @@ class VFDepthAlgo(BaseModel):
         This function computes depth map for each viewpoint.
         """                  
         source_scale = 0
+        img_size = inputs['color', 0, source_scale].shape[-2:]
         for cam in range(self.num_cams):
             ref_K = inputs[('K', source_scale)][:, cam, ...]
             for scale in self.scales:
                 disp = outputs[('cam', cam)][('disp', scale)]
-                outputs[('cam', cam)][('depth', scale)] = self.to_depth(disp, ref_K)
+                outputs[('cam', cam)][('depth', scale)] = self.to_depth(disp, ref_K, img_size)
                 if self.aug_depth:
                     disp = outputs[('cam', cam)][('disp', scale, 'aug')]
-                    outputs[('cam', cam)][('depth', scale, 'aug')] = self.to_depth(disp, ref_K)
+                    outputs[('cam', cam)][('depth', scale, 'aug')] = self.to_depth(disp, ref_K, img_size)
     
-    def to_depth(self, disp_in, K_in):        
+    @full_precision
+    def to_depth(self, disp_in, K_in, img_size):        
         """
         This function transforms disparity value into depth map while multiplying the value with the focal length.
         """
-        min_disp = 1/self.max_depth
-        max_disp = 1/self.min_depth
-        disp_range = max_disp-min_disp
-
-        disp_in = F.interpolate(disp_in, [self.height, self.width], mode='bilinear', align_corners=False)
-        disp = min_disp + disp_range * disp_in
-        depth = 1/disp
-        return depth * K_in[:, 0:1, 0:1].unsqueeze(2)/self.focal_length_scale
+        disp_in = F.interpolate(disp_in, img_size, mode='bilinear', align_corners=False)
+        return disp_to_depth(disp_in, K_in, self.min_depth, self.max_depth, self.focal_length_scale)
     
     def compute_losses(self, inputs, outputs):
         """
@@ -295,9 +345,14 @@ class VFDepthAlgo(BaseModel):
         loss_fn = defaultdict(list)
         loss_mean = defaultdict(float)
 
-        # generate image and compute loss per cameara
+        # generate images of all cameras at once
+        self.pred_cam_imgs(inputs, outputs)
+
+        # photometric losses of all cameras at once
+        self.losses.compute_photometric_losses(inputs, outputs)
+        
+        # compute loss per cameara
         for cam in range(self.num_cams):
-            self.pred_cam_imgs(inputs, outputs, cam)
             cam_loss, loss_dict = self.losses(inputs, outputs, cam)
             
             losses += cam_loss  
@@ -312,9 +367,11 @@ class VFDepthAlgo(BaseModel):
         loss_mean['total_loss'] = losses        
         return loss_mean
 
-    def pred_cam_imgs(self, inputs, outputs, cam):
+    def pred_cam_imgs(self, inputs, outputs):
         """
         This function renders projected images using camera parameters and depth information.
         """                  
-        rel_pose_dict = self.pose.compute_relative_cam_poses(inputs, outputs, cam)
-        self.view_rendering(inputs, outputs, cam, rel_pose_dict)  
\ No newline at end of file
+        rel_pose_dicts = {}
+        for cam in range(self.num_cams):
+            rel_pose_dicts[cam] = self.pose.compute_relative_cam_poses(inputs, outputs, cam)
+        self.view_rendering(inputs, outputs, rel_pose_dicts)
\ No newline at end of file
@@ -1,4 +1,5 @@
 # Copyright (c) 2023 42dot. All rights reserved.
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -31,6 +32,31 @@ def unpack_cam_feat(x, b, n_cam):
     return x
 
 
+def disp_to_depth(disp, K, min_depth, max_depth, focal_length_scale):
+    """
+    This function transforms disparity value into depth map while multiplying the value with the focal length.
+    disp: [..., 1, h, w], K: [..., 4, 4]
+    """
+    min_disp = 1/max_depth
+    max_disp = 1/min_depth
+    disp_range = max_disp-min_disp
+
+    disp = min_disp + disp_range * disp
+    depth = 1/disp
+    return depth * K[..., 0:1, 0:1].unsqueeze(-3)/focal_length_scale
+
+
+def get_calib_keys(K, extrinsics):
+    """
+    This function returns a hashable calibration key of each sample, from K and extrinsics [b, n_cam, 4, 4].
+    Keys should be computed from host tensors (e.g. before moving a batch to the device), 
+    since reading device tensors synchronizes with the device.
+    """
+    b = K.size(0)
+    calib = torch.cat([K[:, :, :3, :3].reshape(b, -1), extrinsics[:, :, :3, :].reshape(b, -1)], dim=1)
+    return [tuple(c) for c in calib.tolist()]
+
+
 def upsample(x):
     """
     This function upsamples input tensor by a factor of 2
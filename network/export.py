@@ -0,0 +1,148 @@
+# Copyright (c) 2023 42dot. All rights reserved.
+import copy
+
+import torch
+import torch.nn as nn
+
+from .blocks import disp_to_depth, pack_cam_feat
+
+
+def invert_intrinsics(K):
+    """
+    This function inverts pinhole intrinsics without skew [..., 4, 4] in closed form, so that no matrix inverse is exported.
+    """
+    fx, fy, cx, cy = K[..., 0, 0], K[..., 1, 1], K[..., 0, 2], K[..., 1, 2]
+    zeros, ones = torch.zeros_like(fx), torch.ones_like(fx)
+    rows = [[1/fx, zeros, -cx/fx, zeros],
+            [zeros, 1/fy, -cy/fy, zeros],
+            [zeros, zeros, ones, zeros],
+            [zeros, zeros, zeros, ones]]
+    return torch.stack([torch.stack(row, -1) for row in rows], -2)
+
+
+def invert_extrinsics(T):
+    """
+    This function inverts rigid transformations [..., 4, 4] in closed form, so that no matrix inverse is exported.
+    """
+    R_inv = T[..., :3, :3].transpose(-1, -2)
+    t_inv = -torch.matmul(R_inv, T[..., :3, 3:])
+    return torch.cat([torch.cat([R_inv, t_inv], -1), T[..., 3:, :]], -2)
+
+
+class FusionExportNet(nn.Module):
+    """
+    Tensor-in/tensor-out wrapper of a fusion network for TorchScript tracing and ONNX export.
+    The network is exported at a fixed resolution, with the voxel, pixel and depth grids registered as buffers.
+    If the calibration of the rig is given, projection tables and sampling grids are computed once and stored as buffers.
+    K: [1, cam, 4, 4] intrinsics at the network resolution, extrinsics: [1, cam, 4, 4]
+    """
+    def __init__(self, net, height, width, K=None, extrinsics=None):
+        super().__init__()
+        self.net = copy.deepcopy(net).eval()
+        fusion_net = self.net.fusion_net
+        # calibration-keyed caches and the visible voxel selection depend on tensor values, which can not be traced
+        fusion_net.proj_cache_size = 0
+        fusion_net.sparse_voxel = False
+
+        self.height, self.width = height, width
+        self.fusion_level = fusion_net.fusion_level
+        self.feat_size = (height // (2 ** (self.fusion_level+1)), width // (2 ** (self.fusion_level+1)))
+
+        # the fusion module reads the same tensors from its grid cache, so they are traced as buffers
+        sample_tensor = next(self.net.parameters())
+        self.register_buffer('voxel_pts', fusion_net.get_voxel_pts(sample_tensor), persistent=False)
+        pixel_grid, depth_grid = fusion_net.get_pixel_grids(*self.feat_size, sample_tensor)
+        self.register_buffer('pixel_grid', pixel_grid, persistent=False)
+        self.register_buffer('depth_grid', depth_grid, persistent=False)
+
+        self.static_calib = K is not None
+        if self.static_calib:
+            self.set_calibration(K.to(sample_tensor), extrinsics.to(sample_tensor))
+
+    @torch.no_grad()
+    def set_calibration(self, K, extrinsics):
+        """
+        This function folds a fixed rig calibration into constant projection tables.
+        """
+        fusion_net = self.net.fusion_net
+        self.register_buffer('K', K)
+        self.register_buffer('extrinsics', extrinsics)
+
+        K_lev = self.scale_intrinsics(K)
+        pix_coords, static_mask, v_depth = fusion_net.compute_proj_tables(
+            pack_cam_feat(K_lev), pack_cam_feat(invert_extrinsics(extrinsics)), *self.feat_size)
+        self.register_buffer('pix_coords', pix_coords)
+        self.register_buffer('static_mask', static_mask)
+        self.register_buffer('v_depth', v_depth)
+
+        if fusion_net.model == 'depth':
+            self.register_buffer('proj_grid', fusion_net.compute_image_grid(invert_intrinsics(K_lev), extrinsics, self.feat_size))
+
+    def scale_intrinsics(self, K):
+        """
+        This function scales intrinsics at the network resolution to the fusion level.
+        """
+        return torch.cat([K[:, :, :2, :] / (2 ** (self.fusion_level+1)), K[:, :, 2:, :]], 2)
+
+    def prepare_inputs(self, mask, K, extrinsics):
+        """
+        This function builds the input dictionary of the wrapped network.
+        """
+        b = mask.size(0)
+        inputs = {}
+        if self.static_calib:
+            K = self.K.repeat(b, 1, 1, 1)
+            extrinsics = self.extrinsics.repeat(b, 1, 1, 1)
+            inputs['proj_tables'] = (self.pix_coords.repeat(b, 1, 1, 1), self.static_mask.repeat(b, 1, 1),
+                                     self.v_depth.repeat(b, 1, 1), None)
+            if hasattr(self, 'proj_grid'):
+                inputs['proj_grid'] = self.proj_grid.expand(b, -1, -1, -1, -1)
+
+        K_lev = self.scale_intrinsics(K)
+        inputs[('K', 0)] = K
+        inputs[('K', self.fusion_level+1)] = K_lev
+        inputs[('inv_K', self.fusion_level+1)] = invert_intrinsics(K_lev)
+        inputs['extrinsics'] = extrinsics
+        inputs['extrinsics_inv'] = invert_extrinsics(extrinsics)
+        inputs['mask'] = mask
+        return inputs
+
+
+class DepthExportNet(FusionExportNet):
+    """
+    Export wrapper of FusedDepthNet, which outputs metric depth maps.
+    """
+    def __init__(self, net, height, width, K=None, extrinsics=None):
+        super().__init__(net, height, width, K, extrinsics)
+        # depth synthesis is only needed for training and visualization
+        self.net.aug_depth = self.net.syn_visualize = False
+        self.net.fusion_net.aug_depth = self.net.fusion_net.syn_visualize = False
+
+    def forward(self, images, mask, K=None, extrinsics=None):
+        """
+        images: [batch, cam, 3, h, w], mask: [batch, cam, 1, h, w]
+        K, extrinsics: [batch, cam, 4, 4] at the network resolution, only without a fixed calibration
+        output: [batch, cam, 1, h, w] depth
+        """
+        inputs = self.prepare_inputs(mask, K, extrinsics)
+        inputs[('color_aug', 0, 0)] = images
+        outputs = self.net(inputs)
+
+        disp = torch.stack([outputs[('cam', cam)][('disp', 0)] for cam in range(images.size(1))], 1)
+        return disp_to_depth(disp, inputs[('K', 0)], self.net.min_depth, self.net.max_depth, self.net.focal_length_scale)
+
+
+class PoseExportNet(FusionExportNet):
+    """
+    Export wrapper of FusedPoseNet, which outputs the axis angle and translation of the reference camera.
+    """
+    def forward(self, cur_images, next_images, mask, K=None, extrinsics=None):
+        """
+        cur_images, next_images: [batch, cam, 3, h, w], mask: [batch, cam, 1, h, w]
+        K, extrinsics: [batch, cam, 4, 4] at the network resolution, only without a fixed calibration
+        output: axis angle, translation [batch, 1, 1, 3]
+        """
+        inputs = self.prepare_inputs(mask, K, extrinsics)
+        inputs[('color_aug', 0, 0)] = cur_images
+        inputs[('color_aug', 1, 0)] = next_images
+        return self.net(inputs, [0, 1], None)
@@ -9,6 +9,7 @@ from .blocks import upsample, conv2d, pack_cam_feat, unpack_cam_feat
 from .volumetric_fusionnet import VFNet
 
 from external.layers import ResnetEncoder
+from utils import aug_depth_params
 
 
 class FusedDepthNet(nn.Module):
@@ -51,6 +52,7 @@ class FusedDepthNet(nn.Module):
         
         # packed images for surrounding view
         sf_images = torch.stack([inputs[('color_aug', 0, 0)][:, cam, ...] for cam in range(self.num_cams)], 1)
+        b = sf_images.size(0)
         packed_input = pack_cam_feat(sf_images)
         
         # feature encoder
@@ -62,7 +64,7 @@ class FusedDepthNet(nn.Module):
                         + [F.interpolate(feat, [up_h, up_w], mode='bilinear', align_corners=True) for feat in packed_feats[lev+1:]]        
         
         packed_feats_agg = self.conv1x1(torch.cat(packed_feats_list, dim=1))        
-        feats_agg = unpack_cam_feat(packed_feats_agg, self.batch_size, self.num_cams)
+        feats_agg = unpack_cam_feat(packed_feats_agg, b, self.num_cams)
         
         # fusion_net, backproject each feature into the 3D voxel space
         fusion_dict = self.fusion_net(inputs, feats_agg)        
@@ -70,7 +72,7 @@ class FusedDepthNet(nn.Module):
         feat_in = packed_feats[:lev] + [fusion_dict['proj_feat']]    
         packed_depth_outputs = self.decoder(feat_in)            
             
-        depth_outputs = unpack_cam_feat(packed_depth_outputs, self.batch_size, self.num_cams)
+        depth_outputs = unpack_cam_feat(packed_depth_outputs, b, self.num_cams)
         
         for cam in range(self.num_cams):
             for k in depth_outputs.keys():
@@ -79,19 +81,33 @@ class FusedDepthNet(nn.Module):
         if self.aug_depth:
             feat_in = packed_feats[:lev] + [fusion_dict['proj_feat_aug']]              
             packed_depth_outputs = self.decoder(feat_in)
-            depth_outputs = unpack_cam_feat(packed_depth_outputs, self.batch_size, self.num_cams)
+            depth_outputs = unpack_cam_feat(packed_depth_outputs, b, self.num_cams)
             for cam in range(self.num_cams):
                 for k in depth_outputs.keys():
                     k_aug = k + ('aug',)
                     outputs[('cam', cam)][k_aug] = depth_outputs[k][:, cam, ...]
                     
         if self.syn_visualize:
-            proj_feats = fusion_dict['syn_feat']
-            outputs['disp_vis'] = []
-            for feat in proj_feats:
-                depth_outputs = self.decoder([feat])
-                outputs['disp_vis'] += depth_outputs[('disp', 0)]
+            K = inputs['K', self.fusion_level+1]
+            outputs['disp_vis'] = self.synthesize_views(fusion_dict['voxel_feat'], K, inputs['extrinsics'], [up_h, up_w])
         return outputs
+
+    def synthesize_views(self, voxel_feat, K, extrinsics, img_size):
+        """
+        This function synthesizes disparity maps at novel views of the reference camera.
+        Novel views are projected and decoded in chunks, and each frame is yielded as soon as its chunk is decoded.
+        """
+        b = voxel_feat.size(0)
+        aug_params = aug_depth_params(K)
+        for i in range(0, len(aug_params), self.syn_chunk_size):
+            poses = aug_params[i:i+self.syn_chunk_size]
+            proj_feat = self.fusion_net.project_novel_views(voxel_feat, K, extrinsics, poses, img_size)
+            
+            # [b*n_poses, 1, h, w] -> [n_poses, b, 1, h, w]
+            syn_disp = self.decoder([proj_feat])[('disp', 0)]
+            syn_disp = unpack_cam_feat(syn_disp, b, len(poses)).transpose(0, 1)
+            for disp in syn_disp.reshape(-1, *syn_disp.shape[2:]):
+                yield disp
     
         
 class DepthDecoder(nn.Module):
@@ -64,7 +64,7 @@ class FusedPoseNet(nn.Module):
                         + [F.interpolate(feat, [up_h, up_w], mode='bilinear', align_corners=True) for feat in packed_feats[lev+1:]]           
 
         packed_feats_agg = self.conv1x1(torch.cat(packed_feats_list, dim=1))         
-        feats_agg = unpack_cam_feat(packed_feats_agg, self.batch_size, self.num_cams)
+        feats_agg = unpack_cam_feat(packed_feats_agg, pose_images.size(0), self.num_cams)
     
         # fusion_net, backproject each feature into the 3D voxel space
         bev_feat = self.fusion_net(inputs, feats_agg)        
@@ -0,0 +1,42 @@
+# Copyright (c) 2023 42dot. All rights reserved.
+import copy
+
+import torch
+from torch.ao.quantization import get_default_qconfig
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+# convolutional parts of the depth networks, which dominate the inference time
+# (fusion: encoder, feature aggregation, voxel dimension reduction and decoder, baseline: encoder and decoder)
+_QUANT_MODULES = ['encoder', 'conv1x1', 'fusion_net.reduce_dim', 'decoder', 'depth_encoder', 'depth_decoder']
+
+
+def set_submodule(net, name, module):
+    """
+    This function replaces the submodule of the given (dotted) name.
+    """
+    parent, _, attr = name.rpartition('.')
+    setattr(net.get_submodule(parent) if parent else net, attr, module)
+
+
+@torch.no_grad()
+def quantize_depth_net(net, calib_inputs, backend='fbgemm'):
+    """
+    This function applies static post-training int8 quantization to the convolutional parts of a depth network.
+    Grid sampling and the voxel preprocessing stay in fp32. Quantized modules take and return fp32 tensors.
+    calib_inputs: inputs of the depth network, used to calibrate the activation ranges
+    """
+    torch.backends.quantized.engine = backend
+    net = copy.deepcopy(net).cpu().eval()
+    calib_inputs = list(calib_inputs)
+    names = [name for name in _QUANT_MODULES if hasattr(net, name.split('.')[0])]
+
+    # insert observers, and collect activation ranges
+    qconfig_dict = {'': get_default_qconfig(backend)}
+    for name in names:
+        set_submodule(net, name, prepare_fx(net.get_submodule(name), qconfig_dict))
+    for inputs in calib_inputs:
+        net(inputs)
+
+    for name in names:
+        set_submodule(net, name, convert_fx(net.get_submodule(name)))
+    return net
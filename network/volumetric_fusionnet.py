@@ -1,17 +1,26 @@
 # Copyright (c) 2023 42dot. All rights reserved.
+from collections import OrderedDict
+
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from pytorch3d.transforms import axis_angle_to_matrix
 
-from .blocks import conv2d, conv1d, pack_cam_feat
-from utils import aug_depth_params
+from utils.precision import full_precision
+from .blocks import conv2d, conv1d, get_calib_keys, pack_cam_feat, unpack_cam_feat
 
 
 class VFNet(nn.Module):
     """
     Surround-view fusion module that estimates a single 3D feature using surround-view images
     """
+    # voxel-to-pixel projection tables, shared by the depth and pose fusion modules
+    _proj_tables = OrderedDict()
+    _proj_batch_tables = (None, None)
+    _ray_tables = OrderedDict()
+    _ray_batch_tables = (None, None)
+
     def __init__(self, cfg, feat_in_dim, feat_out_dim, model='depth'):
         super(VFNet, self).__init__()
         self.read_config(cfg) 
@@ -25,19 +34,11 @@ class VFNet(nn.Module):
         voxel_grid = self.create_voxel_grid(self.voxel_str_p, self.voxel_end_p, self.voxel_size)        
         b, _, self.z_dim, self.y_dim, self.x_dim = voxel_grid.size()
         self.n_voxels = self.z_dim * self.y_dim * self.x_dim
-        ones = torch.ones(self.batch_size, 1, self.n_voxels)
+        ones = torch.ones(b, 1, self.n_voxels)
         self.voxel_pts = torch.cat([voxel_grid.view(b, 3, self.n_voxels), ones], dim=1)
 
-        # define grids in pixel space
-        self.img_h = self.height // (2 ** (self.fusion_level+1))
-        self.img_w = self.width // (2 ** (self.fusion_level+1))
-        self.num_pix = self.img_h * self.img_w
-        self.pixel_grid = self.create_pixel_grid(self.batch_size, self.img_h, self.img_w)
-        self.pixel_ones = torch.ones(self.batch_size, 1, self.proj_d_bins, self.num_pix)
-        
-        # define a depth grid for projection
-        depth_bins = torch.linspace(self.proj_d_str, self.proj_d_end, self.proj_d_bins)
-        self.depth_grid = self.create_depth_grid(self.batch_size, self.num_pix, self.proj_d_bins, depth_bins)
+        # voxel, pixel and depth grids matched to the input, created lazily for each (size, device, dtype)
+        self.grids = {}
         
         # depth fusion(process overlap and non-overlap regions)
         if model == 'depth':
@@ -66,8 +67,8 @@ class VFNet(nn.Module):
     
     def create_voxel_grid(self, str_p, end_p, v_size):
         """
-        output: [batch, 3, z_dim, y_dim, x_dim]
-        [b, :, z, y, x] contains (x,y,z) 3D point
+        output: [1, 3, z_dim, y_dim, x_dim]
+        [0, :, z, y, x] contains (x,y,z) 3D point
         """
         grids = [torch.linspace(str_p[i], end_p[i], v_size[i]) for i in range(3)]
 
@@ -76,80 +77,191 @@ class VFNet(nn.Module):
         grids[1] = grids[1].view(1, 1, 1, y_dim, 1)
         grids[2] = grids[2].view(1, 1, z_dim, 1, 1)
         
-        grids = [grid.expand(self.batch_size, 1, z_dim, y_dim, x_dim) for grid in grids]
+        grids = [grid.expand(1, 1, z_dim, y_dim, x_dim) for grid in grids]
         return torch.cat(grids, 1)
     
-    def create_pixel_grid(self, batch_size, height, width):
+    def create_pixel_grid(self, height, width):
         """
-        output: [batch, 3, height * width]
+        output: [1, 3, height * width]
         """
         grid_xy = torch.meshgrid(torch.arange(width), torch.arange(height), indexing='xy')
         pix_coords = torch.stack(grid_xy, axis=0).unsqueeze(0).view(1, 2, height * width)
-        pix_coords = pix_coords.repeat(batch_size, 1, 1)
-        ones = torch.ones(batch_size, 1, height * width)
+        ones = torch.ones(1, 1, height * width)
         pix_coords = torch.cat([pix_coords, ones], 1)
         return pix_coords
 
-    def create_depth_grid(self, batch_size, n_pixels, n_depth_bins, depth_bins):
+    def create_depth_grid(self, n_pixels, n_depth_bins, depth_bins):
+        """
+        output: [1, 1, num_depths, height * width]
+        """
+        depth_layers = depth_bins.view(n_depth_bins, 1).expand(n_depth_bins, n_pixels)
+        return depth_layers.reshape(1, 1, n_depth_bins, n_pixels)
+
+    def get_voxel_pts(self, sample_tensor):
+        """
+        This function returns the voxel points [1, 4, n_voxels] in the device and dtype of the sample tensor.
+        """
+        key = ('voxel', sample_tensor.device, sample_tensor.dtype)
+        if key not in self.grids:
+            self.grids[key] = self.voxel_pts.to(device=sample_tensor.device, dtype=sample_tensor.dtype)
+        return self.grids[key]
+
+    def get_pixel_grids(self, img_h, img_w, sample_tensor):
+        """
+        This function returns the pixel grid [1, 3, n_pixels] and the depth grid [1, 1, n_depthbins, n_pixels] for the image size.
+        """
+        key = ('pixel', img_h, img_w, sample_tensor.device, sample_tensor.dtype)
+        if key not in self.grids:
+            depth_bins = torch.linspace(self.proj_d_str, self.proj_d_end, self.proj_d_bins)
+            grids = (self.create_pixel_grid(img_h, img_w), 
+                     self.create_depth_grid(img_h * img_w, self.proj_d_bins, depth_bins))
+            self.grids[key] = tuple(grid.to(device=sample_tensor.device, dtype=sample_tensor.dtype) for grid in grids)
+        return self.grids[key]
+
+    def get_proj_tables(self, intrinsics, extrinsics_inv, h_dim, w_dim, calib_keys=None):
         """
-        output: [batch, 3, num_depths, height * width]
+        This function returns the voxel-to-pixel projection tables of each camera, packed along the batch dimension.
+        Since the calibration is fixed per vehicle, tables are cached per sample and keyed by (calibration, image size).
+        Calibration keys computed on the host (see get_calib_keys) avoid a device synchronization, 
+        otherwise they are read from the calibration tensors.
+        output: pix_coords [b*n_cam, n_voxels, 1, 2], static_mask [b*n_cam, 1, n_voxels], v_depth [b*n_cam, 1, n_voxels],
+                voxel_idx [n_voxels] (sparse mode only, otherwise None)
+        In sparse mode, the voxels visible to each calibration are found once when its tables are computed, 
+        and the voxel index of a batch is the union of them, computed on the host.
         """
-        depth_layers = []
-        for d in depth_bins:
-            depth_layer = torch.ones((1, n_pixels)) * d
-            depth_layers.append(depth_layer)
-        depth_layers = torch.cat(depth_layers, dim=0).view(1, 1, n_depth_bins, n_pixels)
-        depth_layers = depth_layers.expand(batch_size, 3, n_depth_bins, n_pixels)
-        return depth_layers
+        b, n_cam, _, _ = intrinsics.size()
+        if self.proj_cache_size <= 0:
+            batch_tables = self.compute_proj_tables(pack_cam_feat(intrinsics), pack_cam_feat(extrinsics_inv), h_dim, w_dim)
+            return self.compact_proj_tables(*batch_tables)
+
+        # key of each sample, tables are shared across VFNet instances with the same voxel space
+        if calib_keys is None:
+            calib_keys = get_calib_keys(intrinsics, extrinsics_inv)
+        space = (tuple(self.voxel_str_p), tuple(self.voxel_unit_size), tuple(self.voxel_size), h_dim, w_dim,
+                 intrinsics.device, intrinsics.dtype, self.sparse_voxel)
+        keys = [(space, calib_key) for calib_key in calib_keys]
+
+        # consecutive calls in a single step (pose and depth networks) reuse the packed tables
+        batch_key = (self.sparse_voxel, tuple(keys))
+        if self._proj_batch_tables[0] == batch_key:
+            return self._proj_batch_tables[1]
+
+        tables = self._proj_tables
+        miss = [i for i in range(b) if keys[i] not in tables]
+        if miss:
+            miss_tables = self.compute_proj_tables(pack_cam_feat(intrinsics[miss]), pack_cam_feat(extrinsics_inv[miss]), h_dim, w_dim)
+            miss_tables = [unpack_cam_feat(t, len(miss), n_cam) for t in miss_tables]
+            for j, i in enumerate(miss):
+                entry = tuple(t[j] for t in miss_tables)
+                if self.sparse_voxel:
+                    # voxels visible to at least one camera, kept on the host
+                    entry += (entry[1].any(dim=0).view(-1).cpu().numpy(),)
+                tables[keys[i]] = entry
 
-    def type_check(self, sample_tensor):
+        for key in keys:
+            tables.move_to_end(key)
+        entries = [tables[key] for key in keys]
+        batch_tables = tuple(torch.cat(t, dim=0) for t in zip(*[entry[:3] for entry in entries]))
+        voxel_mask = np.logical_or.reduce([entry[3] for entry in entries]) if self.sparse_voxel else None
+        batch_tables = self.compact_proj_tables(*batch_tables, voxel_mask)
+        
+        self.evict_tables(tables)
+        VFNet._proj_batch_tables = (batch_key, batch_tables)
+        return batch_tables
+
+    def evict_tables(self, tables):
         """
-        This function checks the type of the tensor, so that all the parameters share same device and dtype.
+        This function evicts the least recently used entries of a table cache, 
+        beyond the number of entries (proj_cache_size) or the memory bound (proj_cache_mb).
         """
-        d_dtype, d_device = sample_tensor.dtype, sample_tensor.device
-        if (self.voxel_pts.dtype != d_dtype) or (self.voxel_pts.device != d_device):
-            self.voxel_pts = self.voxel_pts.to(device=d_device, dtype=d_dtype)
-            self.pixel_grid = self.pixel_grid.to(device=d_device, dtype=d_dtype)
-            self.depth_grid = self.depth_grid.to(device=d_device, dtype=d_dtype)
-            self.pixel_ones = self.pixel_ones.to(device=d_device, dtype=d_dtype)    
+        entry_bytes = lambda entry: sum(t.numel() * t.element_size() if torch.is_tensor(t) else t.nbytes for t in entry)
+        n_bytes = sum(entry_bytes(entry) for entry in tables.values())
+        while tables and (len(tables) > self.proj_cache_size or n_bytes > self.proj_cache_mb * 2**20):
+            _, entry = tables.popitem(last=False)
+            n_bytes -= entry_bytes(entry)
 
-    def backproject_into_voxel(self, feats_agg, input_mask, intrinsics, extrinsics_inv):
+    def compact_proj_tables(self, pix_coords, static_mask, v_depth, voxel_mask=None):
+        """
+        This function compacts the projection tables to the voxels visible to at least one camera in the batch (sparse mode).
+        The visible voxels can be given as a host mask [n_voxels], otherwise they are found on the device.
+        """
+        if not self.sparse_voxel:
+            return pix_coords, static_mask, v_depth, None
+        
+        if voxel_mask is None:
+            voxel_idx = torch.nonzero(static_mask.any(dim=0).view(-1)).squeeze(1)
+        else:
+            voxel_idx = torch.from_numpy(np.flatnonzero(voxel_mask))
+            if pix_coords.is_cuda:
+                voxel_idx = voxel_idx.pin_memory()
+            voxel_idx = voxel_idx.to(pix_coords.device, non_blocking=True)
+        return pix_coords[:, voxel_idx], static_mask[:, :, voxel_idx], v_depth[:, :, voxel_idx], voxel_idx
+
+    def scatter_voxel(self, voxel_feat, voxel_idx):
+        """
+        This function scatters compacted voxel features back into the dense voxel space. 
+        [b, feat_dim, n_visible] -> [b, feat_dim, n_voxels]
+        """
+        b, feat_dim, _ = voxel_feat.size()
+        dense_feat = voxel_feat.new_zeros(b, feat_dim, self.n_voxels)
+        return dense_feat.index_copy(2, voxel_idx, voxel_feat)
+
+    @torch.no_grad()
+    @full_precision
+    def compute_proj_tables(self, K, extrinsics_inv, h_dim, w_dim):
+        """
+        This function computes sampling grids, static validity masks and relative depths for packed cameras.
+        K, extrinsics_inv: [n, 4, 4]
+        """
+        # 3D points in the voxel grid -> 3D points referenced at each view. [n, 3, n_voxels]
+        v_pts_local = torch.matmul(extrinsics_inv[:, :3, :], self.get_voxel_pts(extrinsics_inv))
+
+        # calculate pixel coordinate that each point are projected in the image. [n, n_voxels, 1, 2]
+        pix_coords = self.calculate_sample_pixel_coords(K, v_pts_local, w_dim, h_dim)
+
+        # discard points behind the camera or outside of the image. [n, 1, n_voxels]
+        static_mask = self.calculate_static_mask(pix_coords, v_pts_local)
+
+        # relative depth of each voxel. [n, 1, n_voxels]
+        v_depth = v_pts_local[:, 2:3, :] / self.voxel_size[0]
+        return pix_coords, static_mask, v_depth
+
+    def backproject_into_voxel(self, feats_agg, input_mask, intrinsics, extrinsics_inv, proj_tables=None, calib_keys=None):
         """
         This function backprojects 2D features into 3D voxel coordinate using intrinsic and extrinsic of each camera.
         Self-occluded regions are removed by using the projected mask in 3D voxel coordinate.
+        All cameras are sampled at once by packing the camera dimension into the batch dimension.
+        Precomputed projection tables of a fixed calibration can be given instead of the camera parameters.
         """
-        voxel_feat_list = []
-        voxel_mask_list = []
+        b, n_cam, _, h_dim, w_dim = feats_agg.size()
         
-        for cam in range(self.num_cams):
-            feats_img = feats_agg[:, cam, ...]
-            _, _, h_dim, w_dim = feats_img.size()
+        # projection tables of each camera. [b*n_cam, n_voxels, 1, 2], [b*n_cam, 1, n_voxels]
+        # in sparse mode, only the voxels visible to at least one camera are kept
+        if proj_tables is None:
+            proj_tables = self.get_proj_tables(intrinsics, extrinsics_inv, h_dim, w_dim, calib_keys)
+        pix_coords, static_mask, v_depth, voxel_idx = proj_tables
+        # tables follow the precision of the calibration, features may be in reduced precision
+        pix_coords, v_depth = pix_coords.to(feats_agg.dtype), v_depth.to(feats_agg.dtype)
         
-            mask_img = input_mask[:, cam, ...]            
-            mask_img = F.interpolate(mask_img, [h_dim, w_dim], mode='bilinear', align_corners=True)            
-            
-            # 3D points in the voxel grid -> 3D points referenced at each view. [b, 3, n_voxels]
-            ext_inv_mat = extrinsics_inv[:, cam, :3, :]
-            v_pts_local = torch.matmul(ext_inv_mat, self.voxel_pts)
+        feats_img = pack_cam_feat(feats_agg)
+        mask_img = F.interpolate(pack_cam_feat(input_mask).to(feats_agg.dtype), [h_dim, w_dim], mode='bilinear', align_corners=True)
 
-            # calculate pixel coordinate that each point are projected in the image. [b, n_voxels, 1, 2]
-            K_mat = intrinsics[:, cam, :, :]
-            pix_coords = self.calculate_sample_pixel_coords(K_mat, v_pts_local, w_dim, h_dim)
+        # compute validity mask. [b*n_cam, 1, n_voxels]
+        valid_mask = self.calculate_valid_mask(mask_img, pix_coords, static_mask)
+        
+        # retrieve each per-pixel feature. [b*n_cam, feat_dim, n_voxels, 1]
+        feat_warped = F.grid_sample(feats_img, pix_coords, mode='bilinear', padding_mode='zeros', align_corners=True)
+        # concatenate relative depth as the feature. [b*n_cam, feat_dim + 1, n_voxels]
+        feat_warped = torch.cat([feat_warped.squeeze(-1), v_depth], dim=1)
+        feat_warped = feat_warped * valid_mask.to(feat_warped.dtype)
 
-            # compute validity mask. [b, 1, n_voxels]
-            valid_mask = self.calculate_valid_mask(mask_img, pix_coords, v_pts_local)
-            
-            # retrieve each per-pixel feature. [b, feat_dim, n_voxels, 1]
-            feat_warped = F.grid_sample(feats_img, pix_coords, mode='bilinear', padding_mode='zeros', align_corners=True)            
-            # concatenate relative depth as the feature. [b, feat_dim + 1, n_voxels]
-            feat_warped = torch.cat([feat_warped.squeeze(-1), v_pts_local[:, 2:3, :]/(self.voxel_size[0])], dim=1)
-            feat_warped = feat_warped * valid_mask.float()
-            
-            voxel_feat_list.append(feat_warped)
-            voxel_mask_list.append(valid_mask)
+        voxel_feats = unpack_cam_feat(feat_warped, b, n_cam)
+        voxel_masks = unpack_cam_feat(valid_mask, b, n_cam)
+        voxel_feat_list = list(voxel_feats.unbind(1))
+        voxel_mask_list = list(voxel_masks.unbind(1))
         
         # compute overlap region
-        voxel_mask_count = torch.sum(torch.cat(voxel_mask_list, dim=1), dim=1, keepdim=True)
+        voxel_mask_count = torch.sum(voxel_masks, dim=1)
         
         if self.model == 'depth':
             # discriminatively process overlap and non_overlap regions using different MLPs
@@ -158,40 +270,48 @@ class VFNet(nn.Module):
             voxel_feat = voxel_non_overlap + voxel_overlap
             
         elif self.model == 'pose':
-            voxel_feat = torch.sum(torch.stack(voxel_feat_list, dim=1), dim=1, keepdim=False)
-            voxel_feat = voxel_feat/(voxel_mask_count+1e-7)
-            
+            voxel_feat = torch.sum(voxel_feats, dim=1, keepdim=False)
+            voxel_feat = voxel_feat/(voxel_mask_count.to(voxel_feat.dtype)+1e-7)
+
+        if voxel_idx is not None:
+            voxel_feat = self.scatter_voxel(voxel_feat, voxel_idx)
         return voxel_feat
 
+    @full_precision
     def calculate_sample_pixel_coords(self, K, v_pts, w_dim, h_dim):
         """
         This function calculates pixel coords for each point([batch, n_voxels, 1, 2]) to sample the per-pixel feature.
         """        
         cam_points = torch.matmul(K[:, :3, :3], v_pts)
         pix_coords = cam_points[:, :2, :] / (cam_points[:, 2, :].unsqueeze(1) + self.eps)
+        # clamping only affects points far outside of the image, which are masked out anyway
+        pix_coords = torch.clamp(pix_coords, min=-w_dim*2, max=w_dim*2)
 
-        if not torch.all(torch.isfinite(pix_coords)):
-            pix_coords = torch.clamp(pix_coords, min=-w_dim*2, max=w_dim*2)
-
-        pix_coords = pix_coords.view(self.batch_size, 2, self.n_voxels, 1)
+        pix_coords = pix_coords.view(-1, 2, v_pts.size(-1), 1)
         pix_coords = pix_coords.permute(0, 2, 3, 1) 
         pix_coords[:, :, :, 0] = pix_coords[:, :, :, 0] / (w_dim - 1)
         pix_coords[:, :, :, 1] = pix_coords[:, :, :, 1] / (h_dim - 1)
         pix_coords = (pix_coords - 0.5) * 2
         return pix_coords
 
-    def calculate_valid_mask(self, mask_img, pix_coords, v_pts_local):
+    def calculate_static_mask(self, pix_coords, v_pts_local):
         """
-        This function creates valid mask in voxel coordinate by projecting self-occlusion mask to 3D voxel coords. 
+        This function creates the calibration-dependent part of the valid mask in voxel coordinate.
         """
-        # compute validity mask, [b, 1, n_voxels, 1]
-        mask_selfocc = (F.grid_sample(mask_img, pix_coords, mode='nearest', padding_mode='zeros', align_corners=True) > 0.5)
         # discard points behind the camera, [b, 1, n_voxels]
         mask_depth = (v_pts_local[:, 2:3, :] > 0) 
-        # compute validity mask, [b, 1, n_voxels, 1]
+        # discard points outside of the image, [b, 1, n_voxels, 1]
         pix_coords_mask = pix_coords.permute(0, 3, 1, 2)
         mask_oob = ~(torch.logical_or(pix_coords_mask > 1, pix_coords_mask < -1).sum(dim=1, keepdim=True) > 0)
-        valid_mask = mask_selfocc.squeeze(-1) * mask_depth * mask_oob.squeeze(-1)
+        return mask_depth * mask_oob.squeeze(-1)
+
+    def calculate_valid_mask(self, mask_img, pix_coords, static_mask):
+        """
+        This function creates valid mask in voxel coordinate by projecting self-occlusion mask to 3D voxel coords. 
+        """
+        # compute validity mask, [b, 1, n_voxels, 1]
+        mask_selfocc = (F.grid_sample(mask_img, pix_coords, mode='nearest', padding_mode='zeros', align_corners=True) > 0.5)
+        valid_mask = mask_selfocc.squeeze(-1) * static_mask
         return valid_mask
     
     def preprocess_non_overlap(self, voxel_feat_list, voxel_mask_list, voxel_mask_count):
@@ -200,11 +320,11 @@ class VFNet(nn.Module):
         """
         non_overlap_mask = (voxel_mask_count == 1)
         voxel = sum(voxel_feat_list)
-        voxel = voxel * non_overlap_mask.float()
+        voxel = voxel * non_overlap_mask.to(voxel.dtype)
 
         for conv_no in self.conv_non_overlap:
             voxel = conv_no(voxel)
-        return voxel * non_overlap_mask.float()
+        return voxel * non_overlap_mask.to(voxel.dtype)
 
     def preprocess_overlap(self, voxel_feat_list, voxel_mask_list, voxel_mask_count):
         """
@@ -227,44 +347,127 @@ class VFNet(nn.Module):
         voxel = torch.cat([feat1, feat2], dim=1)
         for conv_o in self.conv_overlap:
             voxel = conv_o(voxel)
-        return voxel * overlap_mask.float()
+        return voxel * overlap_mask.to(voxel.dtype)
+
+    def get_ray_tables(self, inv_K, img_h, img_w, calib_keys=None, cache=True):
+        """
+        This function returns the 3D points along the ray of each pixel and depth bin (inv_K @ pixel_grid * depth_grid).
+        The points depend only on the intrinsics, therefore they are cached per sample as the projection tables,
+        keyed by the host calibration keys if given (otherwise read from inv_K), and only the extrinsic transform is recomputed.
+        output: [b*n_cam, n_depthbins * n_pixels, 3]
+        """
+        b, n_cam, _, _ = inv_K.size()
+        inv_K = inv_K[:, :, :3, :3]
+        if self.proj_cache_size <= 0 or not cache:
+            return self.compute_ray_tables(pack_cam_feat(inv_K), img_h, img_w)
+
+        if calib_keys is None:
+            calib_keys = [tuple(k) for k in inv_K.reshape(b, -1).tolist()]
+        space = (img_h, img_w, self.proj_d_str, self.proj_d_end, self.proj_d_bins, inv_K.device, inv_K.dtype)
+        keys = [(space, calib_key) for calib_key in calib_keys]
 
-    def project_voxel_into_image(self, voxel_feat, inv_K, extrinsics):
+        # consecutive calls in a single step (with view augmentation) reuse the packed tables
+        batch_key = tuple(keys)
+        if self._ray_batch_tables[0] == batch_key:
+            return self._ray_batch_tables[1]
+
+        tables = self._ray_tables
+        miss = [i for i in range(b) if keys[i] not in tables]
+        if miss:
+            miss_tables = unpack_cam_feat(self.compute_ray_tables(pack_cam_feat(inv_K[miss]), img_h, img_w), len(miss), n_cam)
+            for j, i in enumerate(miss):
+                tables[keys[i]] = (miss_tables[j],)
+
+        for key in keys:
+            tables.move_to_end(key)
+        ray_points = torch.cat([tables[key][0] for key in keys], dim=0)
+
+        self.evict_tables(tables)
+        VFNet._ray_batch_tables = (batch_key, ray_points)
+        return ray_points
+
+    @torch.no_grad()
+    @full_precision
+    def compute_ray_tables(self, inv_K, img_h, img_w):
+        """
+        This function computes 3D points for each pixel and depth bin of packed cameras. 
+        inv_K: [n, 3, 3]
+        """
+        pixel_grid, depth_grid = self.get_pixel_grids(img_h, img_w, inv_K)
+        cam_points = torch.matmul(inv_K, pixel_grid)
+        cam_points = depth_grid * cam_points.unsqueeze(2) # [n, 3, n_depthbins, n_pixels]
+        return cam_points.flatten(2).transpose(1, 2).contiguous()
+
+    @full_precision
+    def compute_image_grid(self, inv_K, extrinsics, img_size, calib_keys=None, cache=True):
+        """
+        This function computes the 3D sampling grid of the voxel space for the pixel rays of all cameras.
+        output: [b, n_cam * n_depthbins, h, w, 3], value: normalized (x, y, z) point
+        """
+        b, n_cam, _, _ = extrinsics.size()
+        img_h, img_w = img_size
+        
+        # 3D points along the pixel rays of each view. [b*n_cam, n_depthbins * n_pixels, 3]
+        cam_points = self.get_ray_tables(inv_K, img_h, img_w, calib_keys, cache)
+        
+        # apply extrinsic: local 3D point -> global coordinate
+        ext = pack_cam_feat(extrinsics)
+        points = torch.matmul(cam_points, ext[:, :3, :3].transpose(1, 2)) + ext[:, None, :3, 3]
+
+        voxel_str_p = points.new_tensor(self.voxel_str_p)
+        v_length = points.new_tensor(self.voxel_end_p) - voxel_str_p
+        grid = (points - voxel_str_p) / v_length * 2. - 1.
+        return grid.view(b, n_cam * self.proj_d_bins, img_h, img_w, 3)
+
+    def project_voxel_into_image(self, voxel_feat, inv_K, extrinsics, img_size, grid=None, calib_keys=None, cache=True):
         """
         This function projects voxels into 2D image coordinate. 
-        [b, feat_dim, n_voxels] -> [b, feat_dim, d, h, w]
+        All cameras are sampled by a single 3D grid_sample by stacking their depth bins.
+        A precomputed sampling grid of a fixed calibration can be given instead of the camera parameters.
+        Ray tables are cached unless cache is cleared (ex. one-off novel views).
+        [b, feat_dim, n_voxels] -> [b*n_cam, feat_out_dim, h, w]
         """        
-        # define depth bin
-        # [b, feat_dim, n_voxels] -> [b, feat_dim, d, h, w]
+        # [b, feat_dim, n_voxels] -> [b, feat_dim, z, y, x]
         b, feat_dim, _ = voxel_feat.size()
+        n_cam = extrinsics.size(1)
+        img_h, img_w = img_size
         voxel_feat = voxel_feat.view(b, feat_dim, self.z_dim, self.y_dim, self.x_dim) 
         
-        proj_feats = []
-        for cam in range(self.num_cams):
-            # construct 3D point grid for each view
-            cam_points = torch.matmul(inv_K[:, cam, :3, :3], self.pixel_grid)
-            cam_points = self.depth_grid * cam_points.view(self.batch_size, 3, 1, self.num_pix)
-            cam_points = torch.cat([cam_points, self.pixel_ones], dim=1) # [b, 4, n_depthbins, n_pixels]
-            cam_points = cam_points.view(self.batch_size, 4, -1) # [b, 4, n_depthbins * n_pixels]
-            
-            # apply extrinsic: local 3D point -> global coordinate, [b, 3, n_depthbins * n_pixels]
-            points = torch.matmul(extrinsics[:, cam, :3, :], cam_points)
+        # 3D grid_sample [b, n_cam * n_depthbins, h, w, 3]
+        if grid is None:
+            grid = self.compute_image_grid(inv_K, extrinsics, img_size, calib_keys, cache)
+        grid = grid.to(voxel_feat.dtype)
+        
+        # [b, feat_dim, n_cam * n_depthbins, h, w] -> [b*n_cam, feat_dim * n_depthbins, h, w]
+        proj_feat = F.grid_sample(voxel_feat, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+        proj_feat = proj_feat.view(b, feat_dim, n_cam, self.proj_d_bins, img_h, img_w).transpose(1, 2)
+        proj_feat = proj_feat.reshape(b * n_cam, feat_dim * self.proj_d_bins, img_h, img_w)
+        
+        # conv, reduce dimension
+        return self.reduce_dim(proj_feat)
 
-            # 3D grid_sample [b, n_voxels, 3], value: (x, y, z) point
-            grid = points.permute(0, 2, 1) 
-            
-            for i in range(3):
-                v_length = self.voxel_end_p[i] - self.voxel_str_p[i]
-                grid[:, :, i] = (grid[:, :, i] - self.voxel_str_p[i]) / v_length * 2. - 1.
-                
-            grid = grid.view(self.batch_size, self.proj_d_bins, self.img_h, self.img_w, 3)            
-            proj_feat = F.grid_sample(voxel_feat, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
-            proj_feat = proj_feat.view(b, self.proj_d_bins * self.v_dim_o[-1], self.img_h, self.img_w)
-            
-            # conv, reduce dimension
-            proj_feat = self.reduce_dim(proj_feat)
-            proj_feats.append(proj_feat)
-        return proj_feats
+    def project_novel_views(self, voxel_feat, K, extrinsics, poses, img_size):
+        """
+        This function projects voxels into novel views of the reference camera(cam 0), all given poses at once. 
+        poses: list of (roll, pitch, yaw, focal length scale)
+        [b, feat_dim, n_voxels] -> [b*n_poses, feat_out_dim, h, w]
+        """
+        b = voxel_feat.size(0)
+        n_poses = len(poses)
+        
+        # rotated extrinsics, [b, n_poses, 4, 4]
+        angle_mat = axis_angle_to_matrix(torch.tensor([pose[:3] for pose in poses])) # 3x3
+        tform_mat = torch.eye(4).repeat(n_poses, 1, 1)
+        tform_mat[:, :3, :3] = angle_mat
+        tform_mat = tform_mat.to(device=extrinsics.device, dtype=extrinsics.dtype)
+        ext_syn = tform_mat[None] @ extrinsics[:, :1, ...]
+        
+        # zoomed intrinsics, [b, n_poses, 4, 4]
+        f_scale = torch.stack([torch.as_tensor(pose[3], device=K.device, dtype=K.dtype).expand(b) for pose in poses], 1)
+        K_syn = K[:, :1, ...].repeat(1, n_poses, 1, 1)
+        K_syn[:, :, 0, 0] *= f_scale
+        K_syn[:, :, 1, 1] *= f_scale
+        return self.project_voxel_into_image(voxel_feat, torch.inverse(K_syn), ext_syn, img_size, cache=False)
 
     def augment_extrinsics(self, ext):
         """
@@ -297,42 +500,28 @@ class VFNet(nn.Module):
         for cam in range(self.num_cams):
             fusion_dict[('cam', cam)] = {}
         
-        # device, dtype check, match dtype and device
-        sample_tensor = feats_agg[0, 0, ...] # B, n_cam, c, h, w
-        self.type_check(sample_tensor)
+        # features are projected back at the resolution of the aggregated features
+        img_size = feats_agg.shape[-2:]
             
         # backproject each per-pixel feature into 3D space (or sample per-pixel features for each voxel)
-        voxel_feat = self.backproject_into_voxel(feats_agg, mask, K, extrinsics_inv)
+        # projection tables and grids can be given for a fixed calibration (see network.export)
+        voxel_feat = self.backproject_into_voxel(feats_agg, mask, K, extrinsics_inv, inputs.get('proj_tables'), inputs.get('calib_keys'))
             
         if self.model == 'depth':
             # for each pixel, collect voxel features -> output image feature     
-            proj_feats = self.project_voxel_into_image(voxel_feat, inv_K, extrinsics)
-            fusion_dict['proj_feat'] = pack_cam_feat(torch.stack(proj_feats, 1))
+            fusion_dict['proj_feat'] = self.project_voxel_into_image(voxel_feat, inv_K, extrinsics, img_size, 
+                                                                     inputs.get('proj_grid'), inputs.get('calib_keys'))
  
             # with view augmentation
             if self.aug_depth:
                 # extrinsics
                 inputs['extrinsics_aug'] = self.augment_extrinsics(extrinsics)
-                proj_feats = self.project_voxel_into_image(voxel_feat, inv_K, inputs['extrinsics_aug'])
-                fusion_dict['proj_feat_aug'] = pack_cam_feat(torch.stack(proj_feats, 1))
+                fusion_dict['proj_feat_aug'] = self.project_voxel_into_image(voxel_feat, inv_K, inputs['extrinsics_aug'], img_size,
+                                                                             calib_keys=inputs.get('calib_keys'))
 
-            # synthesis visualization
+            # synthesis visualization, novel views are projected later by the synthesis engine
             if self.syn_visualize:
-                def _get_proj_feat(inv_K, ang_x, ang_y, ang_z):
-                    angle_mat = axis_angle_to_matrix(torch.tensor([ang_x, ang_y, ang_z])[None, :]) # 3x3
-                    b, c, _, _ = extrinsics.size()
-                    tform_mat = torch.eye(4)[None, None]
-                    tform_mat[:, :, :3, :3] = angle_mat
-                    tform_mat = tform_mat.repeat(b, c, 1, 1).to(device=extrinsics.device, dtype=extrinsics.dtype)
-                    proj_feats = self.project_voxel_into_image(voxel_feat, inv_K, tform_mat @ extrinsics)
-                    return proj_feats[0]
-
-                fusion_dict['syn_feat'] = []
-                
-                # augmented intrinsics and extrinsics
-                aug_params = aug_depth_params(K)   
-                for param in aug_params:
-                    fusion_dict['syn_feat'] += [_get_proj_feat(*param)]  
+                fusion_dict['voxel_feat'] = voxel_feat
             return fusion_dict      
         
         elif self.model == 'pose':
@@ -0,0 +1,44 @@
+# Copyright (c) 2023 42dot. All rights reserved.
+import argparse
+import os
+
+import utils
+from dataset import construct_dataset, pack_dataset
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='VFDepth dataset packing script')
+    parser.add_argument('--config_file', default ='./configs/ddad/ddad_surround_fusion.yaml', type=str, help='Config yaml file')
+    parser.add_argument('--output', default = None, type=str, help='Output directory (data:packed_path of the config if not given)')
+    parser.add_argument('--splits', default = ['train', 'val'], nargs='+', choices=['train', 'val'], help='Splits to pack')
+    parser.add_argument('--shard_size', default = 64, type=int, help='Number of frames per shard file')
+    parser.add_argument('--num_workers', default = 8, type=int, help='Number of workers loading the raw dataset')
+    args = parser.parse_args()
+    return args
+
+
+def pack(cfg, args):
+    output = args.output if args.output is not None else cfg['data']['packed_path']
+    assert output is not None, '\tOutput directory must be given by --output or data:packed_path of the config'
+    # read the raw dataset, identity losses are computed when loading the packed samples
+    cfg['data']['packed_path'] = None
+    cfg['data']['precompute_identity_loss'] = False
+
+    # images are resized to the training resolution, color jittering is applied when loading the packed samples
+    _augmentation = {
+        'image_shape': (int(cfg['training']['height']), int(cfg['training']['width'])),
+        'jittering': (0.0, 0.0, 0.0, 0.0),
+        'crop_train_borders': (),
+        'crop_eval_borders': ()
+    }
+    for split in args.splits:
+        print(f'Packing {split} split')
+        dataset = construct_dataset(cfg, split, **_augmentation)
+        meta = pack_dataset(dataset, os.path.join(output, split), args.shard_size, args.num_workers)
+        print(f'\t{meta["n_samples"]} samples, {meta["n_frames"]} frames saved to {os.path.join(output, split)}')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cfg = utils.get_config(args.config_file, mode='train')
+    pack(cfg, args)
@@ -0,0 +1,61 @@
+# Copyright (c) 2023 42dot. All rights reserved.
+import argparse
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+import utils
+from dataset import construct_dataset
+
+_dataset = None
+_overwrite = False
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='VFDepth ground-truth depth precomputation script')
+    parser.add_argument('--config_file', default ='./configs/ddad/ddad_surround_fusion.yaml', type=str, help='Config yaml file')
+    parser.add_argument('--splits', default = ['val'], nargs='+', choices=['train', 'val'], help='Splits to precompute')
+    parser.add_argument('--num_workers', default = 8, type=int, help='Number of worker processes')
+    parser.add_argument('--overwrite', action='store_true', help='Overwrite existing depth maps')
+    args = parser.parse_args()
+    return args
+
+
+def init_worker(dataset, overwrite):
+    global _dataset, _overwrite
+    _dataset, _overwrite = dataset, overwrite
+
+
+def save_depth_maps(idx):
+    """
+    This function saves depth maps of all cameras of a sample, in a worker process.
+    """
+    return _dataset.save_depth_maps(idx, _overwrite)
+
+
+def precompute(cfg, args):
+    # depth maps are generated from the raw dataset
+    cfg['data']['packed_path'] = None
+    _augmentation = {
+        'image_shape': (int(cfg['training']['height']), int(cfg['training']['width'])),
+        'jittering': (0.0, 0.0, 0.0, 0.0),
+        'crop_train_borders': (),
+        'crop_eval_borders': ()
+    }
+    for split in args.splits:
+        if 'gt_depth' not in cfg['data'][f'{split}_requirements']:
+            print(f'Skipping {split} split, gt_depth is not in data:{split}_requirements')
+            continue
+
+        print(f'Precomputing depth maps of {split} split')
+        dataset = construct_dataset(cfg, split, **_augmentation)
+        n_samples = len(dataset)
+        with Pool(max(args.num_workers, 1), initializer=init_worker, initargs=(dataset, args.overwrite)) as pool:
+            n_saved = sum(tqdm(pool.imap_unordered(save_depth_maps, range(n_samples), chunksize=4), total=n_samples))
+        print(f'\t{n_saved} depth maps of {n_samples} samples saved')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cfg = utils.get_config(args.config_file, mode='train')
+    precompute(cfg, args)
@@ -0,0 +1,112 @@
+# Copyright (c) 2023 42dot. All rights reserved.
+import argparse
+import os
+
+import cv2
+import numpy as np
+
+import torch
+torch.backends.cudnn.benchmark = True
+
+import utils
+from models import VFDepthPredictor
+
+_IMG_EXTS = ('.jpg', '.jpeg', '.png', '.bmp')
+_VIDEO_EXTS = ('.mp4', '.avi', '.mov', '.mkv')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='VFDepth inference script')
+    parser.add_argument('--config_file', default ='./configs/ddad/ddad_surround_fusion.yaml', type=str, help='Config yaml file')
+    parser.add_argument('--weight_path', default = None, type=str, help='Pretrained weight path')
+    parser.add_argument('--input', required=True, type=str,
+                        help='Directory with an image folder or a video file per camera (named after the cameras in the config)')
+    parser.add_argument('--calib', required=True, type=str, help='npz file with K [cam, 3, 3] and extrinsics [cam, 4, 4]')
+    parser.add_argument('--mask_dir', default = None, type=str, help='Directory with self-occlusion masks, <CAMERA>_mask.png')
+    parser.add_argument('--output', default = './results/predict', type=str, help='Output directory for depth maps')
+    parser.add_argument('--batch_size', default = 1, type=int, help='Number of frames per batch')
+    parser.add_argument('--prefetch', default = 4, type=int, help='Number of batches loaded ahead of the inference')
+    parser.add_argument('--precision', default = 'fp32', choices=['fp32', 'fp16', 'bf16'], help='Inference precision')
+    args = parser.parse_args()
+    return args
+
+
+def camera_source(path, cam):
+    """
+    This function returns a frame iterator of the camera, from an image folder or a video file.
+    """
+    cam_dir = os.path.join(path, cam)
+    if os.path.isdir(cam_dir):
+        fnames = sorted(f for f in os.listdir(cam_dir) if f.lower().endswith(_IMG_EXTS))
+        return (cv2.imread(os.path.join(cam_dir, f)) for f in fnames)
+
+    for f in sorted(os.listdir(path)):
+        name, ext = os.path.splitext(f)
+        if name == cam and ext.lower() in _VIDEO_EXTS:
+            return read_video(os.path.join(path, f))
+    raise FileNotFoundError(f'Cannot find frames of {cam} in {path}')
+
+
+def read_video(path):
+    """
+    This function reads frames of a video file.
+    """
+    cap = cv2.VideoCapture(path)
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            yield frame
+    finally:
+        cap.release()
+
+
+def load_masks(mask_dir, cameras):
+    """
+    This function loads self-occlusion masks of the cameras. [cam, 1, h, w]
+    """
+    if mask_dir is None:
+        return None
+    masks = [cv2.imread(os.path.join(mask_dir, f'{cam.upper()}_mask.png'), cv2.IMREAD_GRAYSCALE) for cam in cameras]
+    return (np.stack(masks, 0)[:, None, ...] > 127).astype(np.float32)
+
+
+def frame_batches(args, cameras):
+    """
+    This function groups synchronized frames of the cameras into batches of (images, K, extrinsics, mask).
+    """
+    calib = np.load(args.calib)
+    K, extrinsics = calib['K'], calib['extrinsics']
+    mask = load_masks(args.mask_dir, cameras)
+
+    batch = []
+    for frames in zip(*[camera_source(args.input, cam) for cam in cameras]):
+        # BGR -> RGB, [cam, h, w, 3]
+        batch.append(np.stack([f[..., ::-1] for f in frames], 0))
+        if len(batch) == args.batch_size:
+            yield np.stack(batch, 0), K, extrinsics, mask
+            batch = []
+    if batch:
+        yield np.stack(batch, 0), K, extrinsics, mask
+
+
+def predict(cfg, args):
+    predictor = VFDepthPredictor(cfg, args.weight_path, precision=args.precision)
+    cameras = cfg['data']['cameras']
+    os.makedirs(args.output, exist_ok=True)
+
+    idx = 0
+    for depth in predictor.stream(frame_batches(args, cameras), args.prefetch):
+        # [batch, cam, h, w]
+        depth = depth.squeeze(2).cpu().numpy()
+        for sample in depth:
+            np.save(os.path.join(args.output, f'{idx:06d}.npy'), sample.astype(np.float32))
+            idx += 1
+    print(f'Saved depth maps of {idx} frames to {args.output}')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cfg = utils.get_config(args.config_file, mode='eval', weight_path = args.weight_path)
+    predict(cfg, args)
@@ -1,4 +1,5 @@
 # Copyright (c) 2023 42dot. All rights reserved.
+import contextlib
 import time
 from collections import defaultdict
 from tqdm import tqdm
@@ -16,6 +17,7 @@ class VFDepthTrainer:
     def __init__(self, cfg, rank, use_tb=True):
         self.read_config(cfg)
         self.rank = rank        
+        self.set_amp()
         if rank == 0:
             self.logger = Logger(cfg, use_tb)
             self.depth_metric_names = self.logger.get_metric_names()
@@ -25,6 +27,47 @@ class VFDepthTrainer:
             for k, v in cfg[attr].items():
                 setattr(self, k, v)
 
+    def set_amp(self):
+        """
+        This function sets autocast and loss scaling for mixed precision training.
+        Only fp16 needs loss scaling, cpu autocast always runs in bf16.
+        """
+        self.device_type = 'cuda' if torch.cuda.is_available() else 'cpu'
+        if self.device_type == 'cpu' or self.amp_dtype == 'bf16':
+            self.autocast_dtype = torch.bfloat16
+        else:
+            self.autocast_dtype = torch.float16
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp and self.autocast_dtype == torch.float16)
+
+    def no_sync(self, model, sync):
+        """
+        This function returns a context that skips the gradient all-reduce of DDP models, 
+        on the micro-steps of gradient accumulation which do not update the models.
+        """
+        stack = contextlib.ExitStack()
+        if self.ddp_enable and not sync:
+            for m in model.models.values():
+                stack.enter_context(m.no_sync())
+        return stack
+
+    def accumulate_losses(self, losses):
+        """
+        This function accumulates the losses of the steps between log checkpoints as device tensors,
+        so that they are only synchronized with the host when they are logged.
+        """
+        for k, v in losses.items():
+            v = v.detach() if torch.is_tensor(v) else v
+            total, count = self.running_losses.get(k, (0, 0))
+            self.running_losses[k] = (total + v, count + 1)
+
+    def pop_running_losses(self):
+        """
+        This function returns the mean losses since the last log checkpoint, and resets the running losses.
+        """
+        losses = {k: float(total / count) for k, (total, count) in self.running_losses.items()}
+        self.running_losses = {}
+        return losses
+
     def learn(self, model):
         """
         This function sets training process.
@@ -35,9 +78,12 @@ class VFDepthTrainer:
             self.val_iter = iter(val_dataloader)
         
         self.step = 0
+        self.running_losses = {}
         start_time = time.time()
+        # throughput is measured between log checkpoints, since the training steps run asynchronously on the device
+        self.last_log_time, self.last_log_step = start_time, 0
         for self.epoch in range(self.num_epochs):
-            if self.ddp_enable:
+            if model.train_sampler is not None:
                 model.train_sampler.set_epoch(self.epoch) 
                 
             self.train(model, train_dataloader, start_time)
@@ -58,14 +104,34 @@ class VFDepthTrainer:
         This function trains models.
         """
         model.set_train()
+        model.optimizer.zero_grad(set_to_none=True)
+        num_batches = len(data_loader)
         for batch_idx, inputs in enumerate(data_loader):         
-            before_op_time = time.time()
+            # gradients are accumulated over grad_accum_steps batches, and all-reduced once per update in DDP
+            # the trailing batches of an epoch form a smaller group, whose losses are averaged over its size
+            group_start = batch_idx - batch_idx % self.grad_accum_steps
+            group_size = min(self.grad_accum_steps, num_batches - group_start)
+            update = batch_idx + 1 == group_start + group_size
+            # statistics of the outputs are only computed once for the steps which are logged
+            log_step = self.rank == 0 and self.logger.is_checkpoint(self.step)
+            model.losses.log_stats = log_step and batch_idx == group_start
+            with self.no_sync(model, update):
+                with torch.autocast(self.device_type, dtype=self.autocast_dtype, enabled=self.amp):
+                    outputs, losses = model.process_batch(inputs, self.rank)
+                self.scaler.scale(losses['total_loss'] / group_size).backward()
+
+            if self.rank == 0:
+                self.accumulate_losses(losses)
+
+            if not update:
+                continue
+
+            self.scaler.step(model.optimizer)
+            self.scaler.update()
             model.optimizer.zero_grad(set_to_none=True)
-            outputs, losses = model.process_batch(inputs, self.rank)
-            losses['total_loss'].backward()
-            model.optimizer.step()
 
-            if self.rank == 0: 
+            if log_step:
+                n_batches = self.running_losses['total_loss'][1]
                 self.logger.update(
                     'train', 
                     self.epoch, 
@@ -73,17 +139,15 @@ class VFDepthTrainer:
                     batch_idx, 
                     self.step,
                     start_time,
-                    before_op_time, 
+                    self.last_log_time, 
                     inputs,
                     outputs,
-                    losses
+                    self.pop_running_losses(),
+                    n_batches,
+                    self.step + 1 - self.last_log_step
                 )
-
-                if self.logger.is_checkpoint(self.step):
-                    self.validate(model)
-
-            if self.ddp_enable:
-                dist.barrier()
+                self.validate(model)
+                self.last_log_time, self.last_log_step = time.time(), self.step + 1
 
             self.step += 1
 
@@ -95,11 +159,12 @@ class VFDepthTrainer:
         This function validates models on validation dataset to monitor training process.
         """
         model.set_val()
+        model.losses.log_stats = True
         inputs = next(self.val_iter)
             
         outputs, losses = model.process_batch(inputs, self.rank)
         
-        if 'depth' in inputs:
+        if 'depth_z' in inputs:
             depth_eval_metric, depth_eval_median = self.logger.compute_depth_losses(inputs, outputs, vis_scale=True)
             self.logger.print_perf(depth_eval_metric, 'metric')
             self.logger.print_perf(depth_eval_median, 'median')
@@ -3,6 +3,7 @@ import os
 import time
 from collections import defaultdict
 
+import cv2
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -106,15 +107,18 @@ class Logger:
     def get_metric_names(self):
         return self._metric_names
     
-    def update(self, mode, epoch, world_size, batch_idx, step, start_time, before_op_time, inputs, outputs, losses):
+    def update(self, mode, epoch, world_size, batch_idx, step, start_time, before_op_time, inputs, outputs, losses,
+               n_batches=1, n_steps=1):
         """
         Display logs with respect to the log frequency
+        The duration since before_op_time can span several batches and optimizer steps, to measure the throughput
+        of asynchronous training steps between two log checkpoints.
         """    
         # iteration duration
         duration = time.time() - before_op_time
 
         if self.is_checkpoint(step):
-            self.log_time(epoch, batch_idx * world_size, duration, losses, start_time)
+            self.log_time(epoch, batch_idx * world_size, duration, losses, start_time, n_batches, n_steps)
             self.log_tb(mode, inputs, outputs, losses, step)
                 
     def is_checkpoint(self, step):
@@ -125,15 +129,17 @@ class Logger:
         late_phase = step % self.late_log_frequency == 0
         return (early_phase or late_phase)
 
-    def log_time(self, epoch, batch_idx, duration, loss, start_time):
+    def log_time(self, epoch, batch_idx, duration, loss, start_time, n_batches=1, n_steps=1):
         """
-        This function prints epoch, iteration, duration, loss and spent time.
+        This function prints epoch, iteration, throughput, loss and spent time.
         """
-        rep_loss = loss['total_loss'].item()
-        samples_per_sec = self.batch_size / duration
+        rep_loss = float(loss['total_loss'])
+        samples_per_sec = self.batch_size * n_batches / duration
+        steps_per_sec = n_steps / duration
         time_sofar = time.time() - start_time
         print(f'epoch: {epoch:2d} | batch: {batch_idx:6d} |' + \
-              f'examples/s: {samples_per_sec:5.1f} | loss: {rep_loss:.3f} | time elapsed: {pretty_ts(time_sofar)}')
+              f'examples/s: {samples_per_sec:5.1f} | steps/s: {steps_per_sec:5.2f} | loss: {rep_loss:.3f} | ' + \
+              f'time elapsed: {pretty_ts(time_sofar)}')
         
     def log_tb(self, mode, inputs, outputs, losses, step):
         """
@@ -184,15 +190,32 @@ class Logger:
                 disp.save(os.path.join(self.cam_paths[cam_id], f'{cur_idx:03d}_disp.jpg'))
             
         if syn_visualize:    
-            syn_disps = outputs['disp_vis']
-            for kdx, syn_disp in enumerate(syn_disps):
-                syn_disp = colormap(syn_disp)[0,...].transpose(1,2,0)
-                syn_disp = pil.fromarray((syn_disp * 255).astype(np.uint8))
-                syn_disp.save(os.path.join(self.syn_path, f'{kdx:03d}_syndisp.jpg'))
+            self.log_syn_result(outputs['disp_vis'])
+
+    def log_syn_result(self, syn_disps):
+        """
+        This function streams synthesized disparity maps into image files or a video file as they are generated.
+        """
+        video = None
+        for kdx, syn_disp in enumerate(syn_disps):
+            syn_disp = colormap(syn_disp)[0,...].transpose(1,2,0)
+            syn_disp = (syn_disp * 255).astype(np.uint8)
+            if self.syn_video:
+                if video is None:
+                    h, w, _ = syn_disp.shape
+                    video_path = os.path.join(self.syn_path, 'syndisp.mp4')
+                    video = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), self.syn_fps, (w, h))
+                video.write(np.ascontiguousarray(syn_disp[..., ::-1]))
+            else:
+                pil.fromarray(syn_disp).save(os.path.join(self.syn_path, f'{kdx:03d}_syndisp.jpg'))
+                
+        if video is not None:
+            video.release()
                 
     def compute_depth_losses(self, inputs, outputs, vis_scale=False):
         """
         This function computes depth metrics, to allow monitoring of training process on validation dataset.
+        Predicted depth maps and masks are sampled at the points of the sparse ground-truth depth maps.
         """
         min_eval_depth = self.eval_min_depth
         max_eval_depth = self.eval_max_depth
@@ -205,17 +228,19 @@ class Logger:
         for cam in range(self.num_cams):
             target_view = outputs['cam', cam]
 
-            depth_gt = inputs['depth'][:, cam, ...]
-            
-            _, _, h, w = depth_gt.shape
+            # [b, n], normalized pixel coordinates [b, 1, n, 2]
+            depth_gt = inputs['depth_z'][:, cam, ...]
+            grid = inputs['depth_uv'][:, cam, None, ...].float()
 
-            depth_pred = target_view[('depth', 0)].to(depth_gt.device)
-            depth_pred = torch.clamp(F.interpolate(
-                        depth_pred, [h, w], mode='bilinear', align_corners=False), 
+            depth_pred = target_view[('depth', 0)].to(depth_gt.device).float()
+            depth_pred = torch.clamp(F.grid_sample(
+                        depth_pred, grid, mode='bilinear', padding_mode='border', align_corners=False)[:, 0, 0, :],
                          min_eval_depth, max_eval_depth)
             depth_pred = depth_pred.detach()
 
-            mask = (depth_gt > min_eval_depth) * (depth_gt < max_eval_depth) * inputs['mask'][:, cam, ...]
+            cam_mask = F.grid_sample(inputs['mask'][:, cam, ...].to(grid.dtype), grid, mode='nearest',
+                                     padding_mode='border', align_corners=False)[:, 0, 0, :]
+            mask = (depth_gt > min_eval_depth) * (depth_gt < max_eval_depth) * cam_mask
             mask = mask.bool()
             
             depth_gt = depth_gt[mask]
@@ -9,6 +9,37 @@ _NUSC_CAM_LIST = ['CAM_FRONT', 'CAM_FRONT_LEFT', 'CAM_FRONT_RIGHT', 'CAM_BACK_LE
 _DDAD_CAM_LIST = ['camera_01', 'camera_05', 'camera_06', 'camera_07', 'camera_08', 'camera_09']
 _REL_CAM_DICT = {0: [1,2], 1: [0,3], 2: [0,4], 3: [1,5], 4: [2,5], 5: [3,4]}
 
+# default values of the optional settings, used when they are not specified in the config file
+_DEFAULT_CFG = {
+    'data': {
+        'packed_path': None,
+        'frame_cache_size': 0,
+        'sample_chunk_size': 1,
+        'precompute_identity_loss': False,
+    },
+    'model': {
+        'proj_cache_size': 16,
+        'proj_cache_mb': 1024,
+        'sparse_voxel': False,
+    },
+    'training': {
+        'amp': False,
+        'amp_dtype': 'fp16',
+        'grad_accum_steps': 1,
+        'lr_scaling': 'none',
+    },
+    'loss': {
+        'fused_photometric': False,
+        'spatio_tile_size': 0,
+    },
+    'eval': {
+        'syn_chunk_size': 8,
+        'syn_video': False,
+        'syn_fps': 30,
+        'eval_original_res': False,
+    },
+}
+
 
 def camera2ind(cameras):
     """
@@ -47,6 +78,9 @@ def get_config(config, mode='train', weight_path=None):
     """
     with open(config, 'r') as stream:
         cfg = yaml.load(stream, Loader=yaml.FullLoader)
+        for attr, defaults in _DEFAULT_CFG.items():
+            for k, v in defaults.items():
+                cfg.setdefault(attr, {}).setdefault(k, v)
 
         cfg_name = os.path.splitext(os.path.basename(config))[0]
         print('Experiment: ', cfg_name)
@@ -0,0 +1,128 @@
+# Copyright (c) 2023 42dot. All rights reserved.
+import torch
+import torch.nn.functional as F
+
+from .precision import full_precision
+
+
+def avg_pool3x3(x):
+    """
+    This function applies 3x3 average pooling on the last two dimensions of a tensor with any leading dimensions.
+    """
+    pooled = F.avg_pool2d(x.flatten(0, -4), kernel_size = 3, stride = 1)
+    return pooled.view(*x.shape[:-2], *pooled.shape[-2:])
+
+
+@full_precision
+def compute_ssim_stats(target):
+    """
+    This function calculates the statistics of target images for the SSIM loss, 
+    which can be shared by all predicted images compared against the same target images.
+    """
+    ref_pad = torch.nn.ReflectionPad2d(1)
+    target = ref_pad(target)
+
+    mu_target = avg_pool3x3(target)
+    musq_target = mu_target.pow(2)
+    sigma_target = avg_pool3x3(target.pow(2))-musq_target
+    return target, mu_target, musq_target, sigma_target
+
+
+@full_precision
+def compute_ssim_loss(pred, target, target_stats=None):
+    """
+    This function calculates SSIM loss between predicted image and target image.
+    Predicted images [..., b, c, h, w] can have leading dimensions of several predictions against the same target images [b, c, h, w].
+    """
+    if target_stats is None:
+        target_stats = compute_ssim_stats(target)
+    target, mu_target, musq_target, sigma_target = target_stats
+
+    ref_pad = torch.nn.ReflectionPad2d(1)
+    padded = ref_pad(pred.flatten(0, -4))
+    pred = padded.view(*pred.shape[:-2], *padded.shape[-2:])
+
+    mu_pred = avg_pool3x3(pred)
+    musq_pred = mu_pred.pow(2)
+    mu_pred_target = mu_pred*mu_target
+
+    sigma_pred = avg_pool3x3(pred.pow(2))-musq_pred
+    sigma_pred_target = avg_pool3x3(pred*target)-mu_pred_target
+
+    C1 = 0.01**2
+    C2 = 0.03**2
+
+    ssim_map = ((2*mu_pred_target + C1)*(2*sigma_pred_target + C2)) \
+                    /((musq_pred + musq_target + C1)*(sigma_pred + sigma_target + C2)+1e-8)    
+    return torch.clamp((1-ssim_map)/2, 0, 1)
+
+
+def compute_photometric_loss(pred=None, target=None, target_stats=None):
+    """
+    This function calculates photometric reconstruction loss (0.85*SSIM + 0.15*L1)
+    """
+    abs_diff = torch.abs(target - pred)
+    l1_loss = abs_diff.mean(-3, True)
+    ssim_loss = compute_ssim_loss(pred, target, target_stats).mean(-3, True)
+    rep_loss = 0.85 * ssim_loss + 0.15 * l1_loss
+    return rep_loss
+
+
+class FusedPhotometricLoss(torch.autograd.Function):
+    """
+    Photometric loss (0.85*SSIM + 0.15*L1), which only saves the predicted and target images for backward, 
+    and recomputes the intermediate SSIM maps in backward instead of keeping them for autograd.
+    Gradients are propagated to the predicted images only.
+    """
+    @staticmethod
+    def forward(ctx, pred, target, target_stats):
+        if target_stats is None:
+            target_stats = compute_ssim_stats(target)
+        ctx.save_for_backward(pred, target)
+        ctx.target_stats = target_stats
+        return compute_photometric_loss(pred, target, target_stats)
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        pred, target = ctx.saved_tensors
+        with torch.enable_grad():
+            pred_fp32 = pred.detach().float().requires_grad_()
+            loss = compute_photometric_loss(pred_fp32, target, ctx.target_stats)
+        grad_pred, = torch.autograd.grad(loss, pred_fp32, grad_loss)
+        return grad_pred.to(pred.dtype), None, None
+
+
+def compute_fused_photometric_loss(pred=None, target=None, target_stats=None):
+    """
+    This function calculates photometric reconstruction loss (0.85*SSIM + 0.15*L1) with FusedPhotometricLoss.
+    """
+    return FusedPhotometricLoss.apply(pred, target, target_stats)
+
+
+def compute_tiled_photometric_loss(pred, target, mask, tile_size, loss_fn=compute_photometric_loss):
+    """
+    This function calculates photometric loss only on the tiles containing valid mask pixels, and zero loss elsewhere. 
+    Predicted images [..., b, c, h, w] and masks [..., b, 1, h, w] can have leading dimensions of several predictions 
+    against the same target images [b, c, h, w].
+    Tiles are evaluated with a margin of one pixel, so that the losses match the full image evaluation inside the tiles.
+    """
+    shape = pred.shape
+    b, _, h, w = target.shape
+    pad_h, pad_w = -h % tile_size, -w % tile_size
+    n_h, n_w = (h + pad_h) // tile_size, (w + pad_w) // tile_size
+    to_tiles = lambda x: F.pad(F.pad(x, (1, 1, 1, 1), mode='reflect'), (0, pad_w, 0, pad_h)) \
+                          .unfold(2, tile_size+2, tile_size).unfold(3, tile_size+2, tile_size)
+
+    # index of the tiles containing valid pixels
+    mask = F.pad(mask.reshape(-1, 1, h, w).float(), (0, pad_w, 0, pad_h))
+    valid = F.max_pool2d(mask, tile_size) > 0
+    idx, _, idx_h, idx_w = valid.nonzero(as_tuple=True)
+
+    # [n_tiles, c, tile_size+2, tile_size+2]
+    pred_tiles = to_tiles(pred.reshape(-1, *shape[-3:]))[idx, :, idx_h, idx_w]
+    target_tiles = to_tiles(target)[idx % b, :, idx_h, idx_w]
+    loss_tiles = loss_fn(pred_tiles, target_tiles)[..., 1:-1, 1:-1]
+
+    loss = loss_tiles.new_zeros(mask.size(0), loss_tiles.size(1), n_h * tile_size, n_w * tile_size)
+    loss.view(*loss.shape[:2], n_h, tile_size, n_w, tile_size).permute(0, 2, 4, 1, 3, 5)[idx, idx_h, idx_w] = loss_tiles
+    return loss[..., :h, :w].reshape(*shape[:-3], -1, h, w)
@@ -0,0 +1,27 @@
+# Copyright (c) 2023 42dot. All rights reserved.
+import contextlib
+import functools
+
+import torch
+
+
+def full_precision(func):
+    """
+    This decorator runs numerically sensitive functions (projections, SSIM) in fp32 under mixed precision training.
+    When autocast is enabled, floating point tensor arguments are cast to fp32 and autocast is disabled inside the function.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        autocast_enabled = {'cuda': torch.is_autocast_enabled(), 'cpu': torch.is_autocast_cpu_enabled()}
+        device_types = [d for d, enabled in autocast_enabled.items() if enabled]
+        if not device_types:
+            return func(*args, **kwargs)
+
+        to_fp32 = lambda a: a.float() if torch.is_tensor(a) and a.is_floating_point() else a
+        args = [to_fp32(a) for a in args]
+        kwargs = {k: to_fp32(v) for k, v in kwargs.items()}
+        with contextlib.ExitStack() as stack:
+            for d in device_types:
+                stack.enter_context(torch.autocast(d, enabled=False))
+            return func(*args, **kwargs)
+    return wrapper
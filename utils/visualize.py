@@ -9,6 +9,7 @@ _DEGTORAD = 0.0174533
 def aug_depth_params(K, n_steps= 75):
     """
     This function augments camera parameters for depth synthesis.
+    Each parameter is given as (roll, pitch, yaw, focal length scale), focal length scale is either 1.0 or a per-sample tensor.
     """
     # augmented parameters for visualization
     aug_params = []
@@ -18,14 +19,14 @@ def aug_depth_params(K, n_steps= 75):
     ang_y, ang_z = 0.0, 0.0
     for angle in roll_aug:
         ang_x = _DEGTORAD * (angle / n_steps * 10.)     
-        aug_params.append([torch.inverse(K), ang_x, ang_y, ang_z])        
+        aug_params.append([ang_x, ang_y, ang_z, 1.0])        
 
     # pitch augmentations
     pitch_aug = [i for i in range(0, 50 + 1, 2)] + [i for i in range(50, -50 - 1, -2)] + [i for i in range(-50, 1, 2)]
     ang_x, ang_z = 0.0, 0.0
     for angle in pitch_aug:
         ang_y = _DEGTORAD * (angle / 10.)                
-        aug_params.append([torch.inverse(K), ang_x, ang_y, ang_z])
+        aug_params.append([ang_x, ang_y, ang_z, 1.0])
         
     # focal length augmentations
     focal_ratio = K[:, 1, 0, 0] / K[:, 0, 0, 0]
@@ -33,27 +34,20 @@ def aug_depth_params(K, n_steps= 75):
     ang_x, ang_y, ang_z = 0.0, 0.0, 0.0
      
     for f_idx in range(100 + 1):
-        f_scale = (f_idx / 100. * focal_ratio_aug + (1 - f_idx / 100.))[:, None]
-        K_aug = K.clone()
-        K_aug[:, :, 0, 0] *= f_scale
-        K_aug[:, :, 1, 1] *= f_scale
-        aug_params.append([torch.inverse(K_aug), ang_x, ang_y, ang_z])
+        f_scale = f_idx / 100. * focal_ratio_aug + (1 - f_idx / 100.)
+        aug_params.append([ang_x, ang_y, ang_z, f_scale])
 
     for f_idx in range(50 + 1):
-        f_scale = (f_idx / 50. * focal_ratio + (1 - f_idx / 50.) * focal_ratio_aug)[:, None]
-        K_aug = K.clone()
-        K_aug[:, :, 0, 0] *= f_scale
-        K_aug[:, :, 1, 1] *= f_scale
-        aug_params.append([torch.inverse(K_aug), ang_x, ang_y, ang_z])
+        f_scale = f_idx / 50. * focal_ratio + (1 - f_idx / 50.) * focal_ratio_aug
+        aug_params.append([ang_x, ang_y, ang_z, f_scale])
 
     # yaw augmentations
     yaw_aug = [i for i in range(360)]
-    inv_K_aug = torch.inverse(K_aug)
     ang_x, ang_y = 0.0, 0.0
     for i in yaw_aug:
         ratio_i = i / 360.
         ang_z = _DEGTORAD * 360 * ratio_i
-        aug_params.append([inv_K_aug, ang_x, ang_y, ang_z])
+        aug_params.append([ang_x, ang_y, ang_z, f_scale])
     return aug_params
     
     